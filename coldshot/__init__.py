@@ -22,7 +22,61 @@ Coldshot:
    structs, rather than a specific final format
 """
 __version__ = '1.0.0a1'
-from .profiler import *
-from .loader import *
-from .externals import *
-from .decorator import *
+import sys, types
+
+# Public names and the sub-module providing each, sub-modules are only 
+# imported when one of their names is first used, so starting the profiler 
+# (e.g. in short-lived worker processes) does not import the loading and 
+# reporting tools.
+LAZY_NAMES = {
+    'timer': 'profiler',
+    'Profiler': 'profiler',
+    'Extractor': 'profiler',
+    'ThreadExtractor': 'profiler',
+    'MemoryExtractor': 'profiler',
+    'TracemallocExtractor': 'profiler',
+    'memory_extractor': 'profiler',
+    'EVENT_TYPES': 'profiler',
+    'ROOT_FUNCTION': 'profiler',
+    'Aggregator': 'profiler',
+    'ShadowStack': 'profiler',
+    'Totals': 'profiler',
+    'DataWriter': 'profiler',
+    'IndexWriter': 'profiler',
+    'Loader': 'loader',
+    'CallStore': 'callstore',
+    'run': 'externals',
+    'runctx': 'externals',
+    'profile': 'decorator',
+}
+SUBMODULES = (
+    'aggregates', 'callbrowser', 'callstore', 'controller', 'cprofdecorator', 'decorator', 
+    'diff', 'eventsfile', 'externals', 'loader', 'profiler', 'query', 'reporter', 
+    'stack', 'timeline', 'webview',
+)
+__all__ = sorted( LAZY_NAMES )
+
+class LazyModule( types.ModuleType ):
+    """Package module which imports sub-modules (and their names) on first access"""
+    def __getattr__( self, name ):
+        if name in SUBMODULES:
+            __import__( '%s.%s'%( self.__name__, name ))
+            return self.__dict__[name]
+        source = LAZY_NAMES.get( name )
+        if source is None:
+            raise AttributeError( name )
+        value = getattr( getattr( self, source ), name )
+        setattr( self, name, value )
+        return value
+    def __dir__( self ):
+        return sorted( set( list( self.__dict__ ) + list( LAZY_NAMES ) + list( SUBMODULES ) ))
+
+def _install():
+    """Replace our (plain) module in sys.modules with a LazyModule"""
+    original = sys.modules[__name__]
+    lazy = LazyModule( __name__, __doc__ )
+    lazy.__dict__.update( original.__dict__ )
+    # our functions use the original module's namespace, keep it alive
+    lazy._original = original
+    sys.modules[__name__] = lazy
+_install()
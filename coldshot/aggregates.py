@@ -0,0 +1,281 @@
+"""Cached function/line aggregates for Coldshot profiles
+
+Loading a large trace requires a full replay of every event, which is far
+too slow to repeat each time a tool wants the cProfile-like totals.  This
+module saves the function-level totals produced by a :py:class:`Loader`
+into a small plain-text file in the profile directory, and restores them
+into a :py:class:`LoaderInfo` without touching the event files.
+
+Record types written (in the same spirit as the index):
+
+    T <funcno> <calls> <time> <child_time> <first_timestamp> <last_timestamp>
+
+        Totals for a function declared in the index
+
+    C <funcno> <childno> <time>
+
+        Time spent in child ``childno`` when called from ``funcno``
+
+    L <funcno> <line> <calls> <time>
+
+        Time spent on a given line of ``funcno``
+
+    M <funcno> <allocated> <freed> <local_allocated> <local_freed>
+
+        Memory totals (bytes) for profiles with memory events
+
+    m <funcno> <line> <allocated> <freed>
+
+        Memory allocated/freed on a given line of ``funcno``
+
+    U <funcno> <cpu_time> <cpu_child_time>
+
+        CPU-time totals for profiles with CPU time (in cpu_timer_unit)
+
+    X <funcno> <exceptions>
+
+        Number of calls which exited by raising an exception
+
+    H <funcno> <min> <max> <bucket>:<count> ...
+
+        Latency histogram of the function's calls (non-empty buckets of a
+        :py:class:`coldshot.stack.LatencyHistogram`)
+
+    E <funcno> <childno> <min> <max> <bucket>:<count> ...
+
+        Latency histogram of the calls ``funcno`` made to ``childno``
+
+    W <funcno> <time> <call_file> <start_index> <thread>
+
+        One of the slowest calls of the function
+
+The snapshots written by aggregate-mode profilers (see
+:py:class:`coldshot.profiler.Aggregator`) use the same records, followed by
+per-thread totals:
+
+    R <thread> <first_timestamp> <last_timestamp>
+
+        A thread which was active during the profile, the times are 64-bit
+        (they do not wrap with the 32-bit event timestamps)
+
+    t <thread> <funcno> <calls> <time> <child_time>
+
+        Totals for a function within a single thread
+
+All times are in the original profiler units.
+"""
+import os, logging
+from . import loader, stack
+log = logging.getLogger( __name__ )
+
+__all__ = ('CACHE_FILENAME','load','populate','save','read','is_current')
+
+CACHE_FILENAME = 'aggregates.coldshot'
+
+def cache_filename( directory ):
+    """Produce the cache filename for the given profile directory"""
+    return os.path.join( directory, CACHE_FILENAME )
+
+def is_current( loader_ ):
+    """Is the cache for the given (index-processed) loader up-to-date?"""
+    filename = cache_filename( loader_.directory )
+    if not os.path.exists( filename ):
+        return False
+    cache_time = os.stat( filename ).st_mtime
+    sources = [loader_.index_filename] + list( loader_.call_files ) + list( 
+        loader_.aggregate_files 
+    )
+    for source in sources:
+        if os.path.exists( source ) and os.stat( source ).st_mtime > cache_time:
+            return False
+    return True
+
+def load( directory, use_cache=True, write_cache=True ):
+    """Load aggregate information for the profile in directory
+
+    directory -- profile directory (as written by the Profiler)
+    use_cache -- if True, use the cached aggregates when they are up-to-date
+    write_cache -- if True, write the cache after doing a full load
+
+    returns LoaderInfo with function/line totals populated (individual calls
+    and thread information is only available on a full load)
+    """
+    loader_ = loader.Loader( directory )
+    loader_.process_index( loader_.index_filename )
+    return populate( loader_, use_cache=use_cache, write_cache=write_cache )
+
+def populate( loader_, use_cache=True, write_cache=True ):
+    """Populate the aggregates for an (index-processed) Loader
+
+    Reads the cache when it is current, otherwise processes the call files
+    (reporting to loader_.progress, if set) and writes the cache.
+
+    returns loader_.info
+    """
+    if use_cache and is_current( loader_ ):
+        read( cache_filename( loader_.directory ), loader_.info )
+        return loader_.info
+    loader_.process_calls()
+    if write_cache:
+        try:
+            save( loader_.info, cache_filename( loader_.directory ) )
+        except (IOError,OSError) as err:
+            log.warn( 'Unable to write aggregate cache for %s: %s', loader_.directory, err )
+    return loader_.info
+
+def save( info, filename ):
+    """Write the aggregates from info into filename"""
+    temporary = filename + '.tmp'
+    with open( temporary, 'w' ) as fh:
+        for key,function in sorted( info.functions.items() ):
+            fh.write( 'T %d %d %d %d %d %d\n'%(
+                key, function.calls, function.time, function.child_time,
+                function.first_timestamp, function.last_timestamp,
+            ))
+            if function.allocated or function.freed:
+                fh.write( 'M %d %d %d %d %d\n'%(
+                    key, function.allocated, function.freed, 
+                    function.local_allocated, function.local_freed,
+                ))
+            if function.exceptions:
+                fh.write( 'X %d %d\n'%( key, function.exceptions ))
+            if function.cpu_time:
+                fh.write( 'U %d %d %d\n'%( key, function.cpu_time, function.cpu_child_time ))
+            for child,delta in sorted( function.child_map.items() ):
+                fh.write( 'C %d %d %d\n'%( key, child, delta ))
+            if function.latency is not None:
+                fh.write( 'H %d %s\n'%( key, format_histogram( function.latency )))
+                for record in function.latency.slowest:
+                    fh.write( 'W %d %d %d %d %d\n'%( (key,) + tuple( record )))
+            for child,histogram in sorted( function.edge_latency.items() ):
+                fh.write( 'E %d %d %s\n'%( key, child, format_histogram( histogram )))
+            for line,line_info in sorted( function.line_map.items() ):
+                fh.write( 'L %d %d %d %d\n'%( key, line, line_info.calls, line_info.time ))
+                if line_info.allocated or line_info.freed:
+                    fh.write( 'm %d %d %d %d\n'%( key, line, line_info.allocated, line_info.freed ))
+    os.rename( temporary, filename )
+    return filename
+
+def read( filename, info ):
+    """Read aggregates from filename into the LoaderInfo info
+
+    Functions which are not declared in info (i.e. not present in the index)
+    are ignored with a warning.
+    """
+    functions = info.functions
+    missing = set()
+    for line in open( filename ):
+        line = line.split()
+        if not line:
+            continue
+        record = line[0]
+        if record in ('R','t'):
+            read_thread( line, info )
+            continue
+        key = int( line[1] )
+        function = functions.get( key )
+        if function is None:
+            if key not in missing:
+                missing.add( key )
+                log.warn( 'Aggregate for undeclared function %s in %s', key, filename )
+            continue
+        if record == 'T':
+            calls,time,child_time,first,last = [int(x) for x in line[2:7]]
+            function.calls += calls
+            function.time += time
+            function.child_time += child_time
+            if first and (not function.first_timestamp or first < function.first_timestamp):
+                function.first_timestamp = first
+            if last > function.last_timestamp:
+                function.last_timestamp = last
+        elif record == 'C':
+            child,delta = int(line[2]),int(line[3])
+            function.child_map[child] = function.child_map.get( child, 0 ) + delta
+        elif record == 'L':
+            lineno,calls,time = [int(x) for x in line[2:5]]
+            line_info = function.line_map.get( lineno )
+            if line_info is None:
+                function.line_map[lineno] = line_info = stack.FunctionLineInfo( lineno )
+            line_info.calls += calls
+            line_info.time += time
+        elif record == 'M':
+            allocated,freed,local_allocated,local_freed = [int(x) for x in line[2:6]]
+            function.allocated += allocated
+            function.freed += freed
+            function.local_allocated += local_allocated
+            function.local_freed += local_freed
+        elif record == 'X':
+            function.exceptions += int( line[2] )
+        elif record == 'U':
+            function.cpu_time += int( line[2] )
+            function.cpu_child_time += int( line[3] )
+        elif record == 'H':
+            if function.latency is None:
+                function.latency = stack.LatencyHistogram()
+            read_histogram( line[2:], function.latency )
+        elif record == 'E':
+            child = int( line[2] )
+            histogram = function.edge_latency.get( child )
+            if histogram is None:
+                function.edge_latency[child] = histogram = stack.LatencyHistogram()
+            read_histogram( line[3:], histogram )
+        elif record == 'W':
+            if function.latency is None:
+                function.latency = stack.LatencyHistogram()
+            function.latency.add_slowest( *[int(x) for x in line[2:6]] )
+        elif record == 'm':
+            lineno,allocated,freed = [int(x) for x in line[2:5]]
+            line_info = function.line_map.get( lineno )
+            if line_info is None:
+                function.line_map[lineno] = line_info = stack.FunctionLineInfo( lineno )
+            line_info.allocated += allocated
+            line_info.freed += freed
+        else:
+            log.error( 'Unrecognized aggregate record: %s', record )
+    return info
+
+def format_histogram( histogram ):
+    """Format a LatencyHistogram as <min> <max> <bucket>:<count> ..."""
+    return ' '.join(
+        ['%d'%( histogram.min, ), '%d'%( histogram.max, )] + 
+        ['%d:%d'%( bucket, count ) for (bucket,count) in histogram.buckets()]
+    )
+
+def read_histogram( fields, histogram ):
+    """Add a formatted histogram (see format_histogram) into histogram"""
+    minimum,maximum = int( fields[0] ),int( fields[1] )
+    if not histogram.count or minimum < histogram.min:
+        histogram.min = minimum
+    histogram.max = max( histogram.max, maximum )
+    for field in fields[2:]:
+        bucket,count = field.split( ':' )
+        histogram.add( int( bucket ), int( count ))
+    return histogram
+
+def read_thread( line, info ):
+    """Process a per-thread (R or t) snapshot record into info"""
+    thread = int( line[1] )
+    thread_stack = info.threads.get( thread )
+    if line[0] == 'R':
+        first,last = int(line[2]),int(line[3])
+        if thread_stack is None:
+            info.threads[thread] = thread_stack = stack.Stack(
+                thread, first & 0xffffffff, info, info.roots['functions'],
+            )
+            thread_stack.start,thread_stack.stop = first,last
+        thread_stack.start = min( thread_stack.start, first )
+        thread_stack.stop = max( thread_stack.stop, last )
+        return
+    function = info.functions.get( int( line[2] ))
+    if thread_stack is None or function is None:
+        return
+    local = thread_stack.functions.get( function.key )
+    if local is None:
+        thread_stack.functions[function.key] = local = stack.FunctionInfo(
+            function.key, function.module, function.name, function.file,
+            function.line, info,
+        )
+    calls,time,child_time = [int(x) for x in line[3:6]]
+    local.calls += calls
+    local.time += time
+    local.child_time += child_time
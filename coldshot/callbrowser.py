@@ -1,18 +1,39 @@
 import wx, random
-from coldshot import stack, loader
+from coldshot import stack, query
 
 class CallTree(wx.TreeCtrl):
     """Allows browsing of a call-tree from Coldshot
+    
+    Functions are shown as soon as the index is read, their totals are 
+    computed in the background and individual calls are only scanned 
+    for when a function/call is expanded.
     """
     def __init__(self, *args, **kwargs):
+        self.directory = kwargs.pop( 'directory', '.profile' )
+        self.progress = kwargs.pop( 'progress', None )
         super(CallTree, self).__init__(*args, **kwargs)
         self.Bind(wx.EVT_TREE_ITEM_EXPANDING, self.OnExpandItem)
-        self.loader = loader.Loader( '.profile', individual_calls=set([('*','*')]))
-        self.loader.load()
+        self.query = query.Query( self.directory )
+        self.function_items = {}
         self.rootID = self.AddRoot('Functions')
-        self.SetPyData( self.rootID, self.loader.info )
+        self.SetPyData( self.rootID, self.query.info )
         self.SetItemHasChildren(self.rootID)
         self.Expand( self.rootID )
+        self.query.start( progress=self.OnLoadProgress, done=self.OnLoaded )
+    
+    def OnLoadProgress( self, records_done, records_total ):
+        """Aggregate loading progress (called from the loading thread)"""
+        if self.progress is not None:
+            wx.CallAfter( self.progress, records_done, records_total )
+    def OnLoaded( self, query ):
+        """Aggregates are complete (called from the loading thread)"""
+        wx.CallAfter( self.RefreshFunctions )
+    def RefreshFunctions( self ):
+        """Update the function labels with their (now loaded) totals"""
+        for function_id,function in self.function_items.values():
+            self.SetItemText( function_id, self.FunctionLabel( function ))
+        if self.progress is not None:
+            self.progress( 1, 1 )
 
     def HasChildren( self, item ):
         """Does this child have children?"""
@@ -27,42 +48,60 @@ class CallTree(wx.TreeCtrl):
             # children are functions 
             if not self.HasChildren( item ):
                 # not already filled out
-                functions = node.functions.values()
+                functions = self.query.functions()
                 functions.sort( key = lambda x: (x.module,x.name))
                 for function in functions:
                     self.AddFunction( item, function )
-        elif isinstance( node, (stack.FunctionInfo, stack.CallInfo) ):
-            # children are individual calls
+        elif isinstance( node, (stack.FunctionInfo, query.CallNode) ):
+            # children are individual calls, scanned on demand
             if not self.HasChildren( item ):
                 if isinstance( node, stack.FunctionInfo):
-                    calls = node.individual_calls[:]
+                    calls = self.query.calls( node )
                 else:
-                    calls = node.children
+                    calls = self.query.children( node )
                 for call in calls:
                     self.AddCall( item, call )
+    def FunctionLabel( self, function ):
+        """Label for a function, including totals once they are loaded"""
+        if self.query.ready.is_set():
+            return '%s.%s (%s calls, %0.5fs)'%( 
+                function.module, function.name, function.calls, function.cumulative,
+            )
+        return '%s.%s'%( function.module, function.name )
     def AddFunction(self, parent_id, function ):
         """Add a single function to the tree"""
-        function_id = self.AppendItem( parent_id, '%s.%s'%( function.module, function.name ))
+        function_id = self.AppendItem( parent_id, self.FunctionLabel( function ))
         self.SetPyData( function_id, function )
-        if function.individual_calls:
-            self.SetItemHasChildren( function_id )
+        # we only know whether it was called once it is expanded
+        self.SetItemHasChildren( function_id )
+        self.function_items[function.key] = (function_id,function)
         return function_id
     def AddCall( self, parent_id, call ):
         """Add a call to the tree"""
         call_id = self.AppendItem( parent_id, '%0.5f [%s:%s] @ %s:%s -> %s.%s:%s'%( call.cumulative, call.start, call.stop, call.start_index, call.stop_index, call.function.module, call.function.name, call.function.line ))
         self.SetPyData( call_id, call )
-        if call.children:
+        if call.may_have_children:
             self.SetItemHasChildren( call_id )
         return call_id
     
 class CallTreeFrame(wx.Frame):
     """Trivial frame wrapper around the call tree"""
     def __init__(self, *args, **kwargs):
+        directory = kwargs.pop( 'directory', '.profile' )
         super(CallTreeFrame, self).__init__(*args, **kwargs)
-        self.tree = CallTree( self )
+        self.CreateStatusBar()
+        self.SetStatusText( 'Loading %s'%( directory, ))
+        self.tree = CallTree( self, directory=directory, progress=self.OnProgress )
+    def OnProgress( self, records_done, records_total ):
+        """Show aggregate loading progress in the status bar"""
+        if records_done >= records_total:
+            self.SetStatusText( 'Loaded' )
+        else:
+            self.SetStatusText( 'Loading %d%%'%( 100 * records_done // (records_total or 1), ))
 
 if __name__ == "__main__":
+    import sys
     app = wx.App(False)
-    frame = CallTreeFrame(None)
+    frame = CallTreeFrame(None, directory=(sys.argv[1:] or ['.profile'])[0])
     frame.Show()
     app.MainLoop()
@@ -0,0 +1,269 @@
+"""SQLite call store for ad-hoc (SQL) queries against Coldshot profiles
+
+Rather than writing one-off scripts against :py:class:`coldshot.eventsfile.EventsFile`
+:py:func:`build` streams a profile's call files once (see
+:py:meth:`coldshot.loader.Loader.stream_calls`) into an SQLite database
+with one row per call, using bulk inserts with journalling disabled and
+creating the indices once the rows are written.
+
+Tables:
+
+    calls -- one row per call
+        (id, function, thread, start, duration, self_time, depth, parent,
+        annotation, call_file, start_index, complete), times are in the
+        profile's timer units, parent is the id of the calling call (NULL
+        for top-level calls), annotation is the annotation id current when
+        the call started (0 for none), call_file/start_index locate the
+        call's start event and complete is 0 for calls still running when
+        the profile ended
+
+    functions -- (id, module, name, file, line) from the index
+
+    annotations -- (id, value) from the index
+
+    meta -- (name, value) e.g. timer_unit, directory, calls
+
+and the ``call_times`` view, which joins calls with their functions and
+converts the times into seconds:
+
+.. code:: bash
+
+    $> coldshot-index test.profile
+    $> coldshot-index --sql "SELECT module, name, count(*), sum(self_seconds)
+        FROM call_times GROUP BY function ORDER BY 4 DESC LIMIT 10" test.profile
+"""
+import os, sqlite3, logging
+from . import loader
+log = logging.getLogger( __name__ )
+
+__all__ = ('STORE_FILENAME','CallStore','build','store_filename','is_current')
+
+STORE_FILENAME = 'calls.sqlite'
+BATCH_SIZE = 10000
+
+SCHEMA = """
+CREATE TABLE meta( name TEXT PRIMARY KEY, value );
+CREATE TABLE functions(
+    id INTEGER PRIMARY KEY, module TEXT, name TEXT, file TEXT, line INTEGER
+);
+CREATE TABLE annotations( id INTEGER PRIMARY KEY, value TEXT );
+CREATE TABLE calls(
+    id INTEGER PRIMARY KEY,
+    function INTEGER,
+    thread INTEGER,
+    start INTEGER,
+    duration INTEGER,
+    self_time INTEGER,
+    depth INTEGER,
+    parent INTEGER,
+    annotation INTEGER,
+    call_file INTEGER,
+    start_index INTEGER,
+    complete INTEGER
+);
+"""
+INDICES = """
+CREATE INDEX calls_function ON calls( function, duration );
+CREATE INDEX calls_thread ON calls( thread, start );
+CREATE INDEX calls_start ON calls( start );
+CREATE INDEX calls_parent ON calls( parent );
+CREATE VIEW call_times AS SELECT
+    calls.*,
+    functions.module AS module,
+    functions.name AS name,
+    calls.duration * {timer_unit!r} AS seconds,
+    calls.self_time * {timer_unit!r} AS self_seconds
+FROM calls JOIN functions ON calls.function = functions.id;
+"""
+
+def store_filename( directory ):
+    """Produce the default call-store filename for a profile directory"""
+    return os.path.join( directory, STORE_FILENAME )
+
+def is_current( directory, filename=None ):
+    """Is the call store for directory newer than its index and call files?"""
+    filename = filename or store_filename( directory )
+    if not os.path.exists( filename ):
+        return False
+    load = loader.Loader( directory )
+    load.process_index( load.index_filename )
+    store_time = os.stat( filename ).st_mtime
+    for source in [load.index_filename] + list( load.call_files ):
+        if os.path.exists( source ) and os.stat( source ).st_mtime > store_time:
+            return False
+    return True
+
+def build( directory, filename=None, batch=BATCH_SIZE, progress=None ):
+    """Build the call store for the profile in directory
+
+    directory -- profile directory (as written by the Profiler)
+    filename -- database to write, default :py:func:`store_filename`,
+        any existing database is replaced once the new one is complete
+    batch -- number of calls inserted per statement batch
+    progress -- if provided, callable( calls_written ) called after each batch
+
+    returns CallStore for the new database
+    """
+    filename = filename or store_filename( directory )
+    load = loader.Loader( directory )
+    load.process_index( load.index_filename )
+    info = load.info
+    temporary = filename + '.tmp'
+    if os.path.exists( temporary ):
+        os.remove( temporary )
+    connection = sqlite3.connect( temporary )
+    try:
+        connection.text_factory = str
+        # a failed build is simply discarded, so durability is not needed
+        connection.execute( 'PRAGMA journal_mode = OFF' )
+        connection.execute( 'PRAGMA synchronous = OFF' )
+        connection.executescript( SCHEMA )
+        root = info.roots['functions']
+        connection.executemany(
+            'INSERT INTO functions VALUES (?,?,?,?,?)',
+            [
+                (key,function.module,function.name,function.filename,function.line)
+                for (key,function) in sorted( info.functions.items() )
+                if function is not root
+            ]
+        )
+        connection.executemany(
+            'INSERT INTO annotations VALUES (?,?)',
+            [
+                (key,note.name)
+                for (key,note) in sorted( info.annotations.items() )
+            ]
+        )
+        written = [0]
+        def insert( rows ):
+            connection.executemany(
+                'INSERT INTO calls VALUES (?,?,?,?,?,?,?,?,?,?,?,?)', rows,
+            )
+            written[0] += len( rows )
+            if progress is not None:
+                progress( written[0] )
+        count = load.stream_calls( insert, batch )
+        connection.executemany(
+            'INSERT INTO meta VALUES (?,?)',
+            [
+                ('directory',os.path.abspath( directory )),
+                ('timer_unit',info.timer_unit),
+                ('calls',count),
+                ('call_files',len( load.call_files )),
+            ]
+        )
+        connection.executescript( INDICES.format( timer_unit=info.timer_unit ))
+        connection.commit()
+    finally:
+        connection.close()
+    if os.name == 'nt' and os.path.exists( filename ):
+        os.remove( filename )
+    os.rename( temporary, filename )
+    return CallStore( filename )
+
+class CallStore( object ):
+    """Query access to a call store built by :py:func:`build`
+
+    filename -- SQLite database filename
+
+    Attributes:
+
+        connection -- sqlite3 connection to the database
+
+        timer_unit -- seconds per timer unit of the profile
+    """
+    def __init__( self, filename ):
+        self.filename = filename
+        self.connection = sqlite3.connect( filename )
+        self.connection.text_factory = str
+        self.timer_unit = self.meta().get( 'timer_unit', 1.0 )
+    def close( self ):
+        self.connection.close()
+    def meta( self ):
+        """Retrieve the meta-data recorded when the store was built"""
+        return dict( self.query( 'SELECT name, value FROM meta' ))
+    def query( self, sql, parameters=() ):
+        """Run an SQL query, returns list of row tuples"""
+        return self.connection.execute( sql, parameters ).fetchall()
+    def columns( self, sql, parameters=() ):
+        """Run an SQL query, returns (column names, rows)"""
+        cursor = self.connection.execute( sql, parameters )
+        return [description[0] for description in cursor.description], cursor.fetchall()
+    def function_id( self, module, name ):
+        """Find the id of a function (None if not present)"""
+        rows = self.query(
+            'SELECT id FROM functions WHERE module = ? AND name = ?', (module,name),
+        )
+        return rows[0][0] if rows else None
+    def calls(
+        self, function=None, thread=None, start=None, stop=None,
+        min_duration=None, parent=None, order='start', limit=None,
+    ):
+        """Find calls matching all of the given (indexed) filters
+
+        function -- function id
+        thread -- thread id
+        start, stop -- range of start timestamps (timer units)
+        min_duration -- shortest duration (seconds) to report
+        parent -- id of the calling call
+        order -- column by which to order the results (prefix with - for
+            descending)
+        limit -- maximum number of calls to return
+
+        returns [(id, function, thread, start, duration, self_time, depth,
+            parent, annotation, call_file, start_index, complete),...]
+        """
+        clauses,parameters = [],[]
+        for column,operator,value in (
+            ('function','=',function),
+            ('thread','=',thread),
+            ('start','>=',start),
+            ('start','<',stop),
+            ('parent','=',parent),
+        ):
+            if value is not None:
+                clauses.append( '%s %s ?'%( column, operator ))
+                parameters.append( value )
+        if min_duration is not None:
+            clauses.append( 'duration >= ?' )
+            parameters.append( int( min_duration / self.timer_unit ))
+        sql = 'SELECT * FROM calls'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join( clauses )
+        column = order.lstrip( '-' )
+        if column not in CALL_COLUMNS:
+            raise ValueError( 'Unknown call column %r, expected one of %s'%( column, CALL_COLUMNS ))
+        sql += ' ORDER BY %s %s'%( column, ['ASC','DESC'][order.startswith('-')] )
+        if limit is not None:
+            sql += ' LIMIT %d'%( limit, )
+        return self.query( sql, parameters )
+    def children( self, call ):
+        """Calls made directly by call (a row or call id)"""
+        if isinstance( call, tuple ):
+            call = call[0]
+        return self.calls( parent=call )
+    def functions( self, order='-seconds', limit=None ):
+        """Per-function totals computed from the calls
+
+        returns [(function, module, name, calls, seconds, self_seconds, max_seconds),...]
+        """
+        column = order.lstrip( '-' )
+        if column not in FUNCTION_COLUMNS:
+            raise ValueError( 'Unknown function column %r, expected one of %s'%( column, FUNCTION_COLUMNS ))
+        sql = """SELECT function, module, name, count(*) AS calls,
+            sum(seconds) AS seconds, sum(self_seconds) AS self_seconds,
+            max(seconds) AS max_seconds
+        FROM call_times GROUP BY function ORDER BY %s %s"""%(
+            column, ['ASC','DESC'][order.startswith('-')],
+        )
+        if limit is not None:
+            sql += ' LIMIT %d'%( limit, )
+        return self.query( sql )
+
+CALL_COLUMNS = (
+    'id','function','thread','start','duration','self_time','depth','parent',
+    'annotation','call_file','start_index','complete',
+)
+FUNCTION_COLUMNS = (
+    'function','module','name','calls','seconds','self_seconds','max_seconds',
+)
@@ -0,0 +1,271 @@
+"""On-demand (signal or control-socket triggered) profiling of a running process
+
+A Controller is installed into a long-running process (e.g. a server) and
+waits for a trigger to start recording:
+
+    * a signal (default ``SIGUSR2``), which toggles recording, or
+
+    * a command on a local (unix-domain) control socket::
+
+        $ echo "start 30" | socat - UNIX-CONNECT:/tmp/server.coldshot
+
+Each recording is written into a new time-stamped capture directory under
+the controller's directory, and stops after the configured duration or
+number of events.  Captures are written as size-bounded segments, and the
+oldest segments/captures are deleted to stay within the disk budget.
+
+.. code:: python
+
+    from coldshot import controller
+    control = controller.Controller(
+        '/var/tmp/profiles', socket_path='/tmp/server.coldshot',
+        duration=30, disk_budget=2*1024**3,
+    )
+    control.install()
+"""
+import os, time, json, signal, socket, threading, shutil, logging
+from . import profiler
+log = logging.getLogger( __name__ )
+
+__all__ = ('Controller',)
+
+CAPTURE_FORMAT = 'capture-%Y%m%d-%H%M%S'
+
+class Controller( object ):
+    """Starts/stops a Profiler on demand
+
+    directory -- base directory into which captures are written
+    signum -- signal which toggles recording (None to disable)
+    socket_path -- if provided, path of a unix-domain control socket
+    duration -- default maximum number of seconds to record (None for no limit)
+    max_events -- default maximum number of events to record (None for no limit)
+    segment_size -- maximum size of each data-file segment in bytes
+    disk_budget -- maximum total bytes for all captures in directory, a new 
+        capture gets the part of the budget not used by the captures kept
+    lines -- if True, record line events as well
+    all_threads -- if True (default), record all threads in the process, 
+        otherwise only the thread which receives the signal
+    """
+    def __init__(
+        self, directory, signum=getattr( signal, 'SIGUSR2', None ), socket_path=None,
+        duration=10.0, max_events=None,
+        segment_size=64*1024*1024, disk_budget=1024*1024*1024,
+        lines=False, all_threads=True,
+    ):
+        self.directory = directory
+        self.signum = signum
+        self.socket_path = socket_path
+        self.duration = duration
+        self.max_events = max_events
+        self.segment_size = segment_size
+        self.disk_budget = disk_budget
+        self.lines = lines
+        self.all_threads = all_threads
+
+        self.profiler = None
+        self.capture = None
+        self.timer = None
+        self.listener = None
+        self.server = None
+        self.previous_handler = None
+        self.lock = threading.RLock()
+        self.pending = None
+
+    @property
+    def active( self ):
+        """Is a capture currently recording?"""
+        return self.profiler is not None and self.profiler.active
+
+    def install( self ):
+        """Install our signal handler and/or control socket"""
+        if self.signum is not None:
+            self.previous_handler = signal.signal( self.signum, self.on_signal )
+        if self.socket_path:
+            self.listen()
+        return self
+    def uninstall( self ):
+        """Remove our signal handler/control socket and stop any capture"""
+        self.stop()
+        if self.signum is not None and self.previous_handler is not None:
+            signal.signal( self.signum, self.previous_handler )
+            self.previous_handler = None
+        if self.server is not None:
+            server,self.server = self.server,None
+            server.close()
+            if os.path.exists( self.socket_path ):
+                os.remove( self.socket_path )
+
+    def on_signal( self, signum, frame ):
+        """Signal handler, toggles recording (or runs a pending socket command)"""
+        pending,self.pending = self.pending,None
+        if pending is not None:
+            command,arguments = pending
+            if command == 'start':
+                self.start( **arguments )
+            else:
+                self.stop()
+        elif self.active:
+            self.stop()
+        else:
+            self.start()
+
+    def start( self, duration=None, max_events=None ):
+        """Start a new capture (no-op if already recording)
+
+        Note: without all_threads the profiler hooks only the thread which 
+        calls start, control socket commands are therefore forwarded to the 
+        main thread via our signal (if we have one).
+
+        returns the capture directory
+        """
+        with self.lock:
+            if self.active:
+                return self.capture
+            # leave room for at least one segment of the new capture
+            kept = self.prune( reserve=self.segment_size or 0 )
+            duration = duration if duration is not None else self.duration
+            max_events = max_events if max_events is not None else self.max_events
+            self.capture = os.path.join( self.directory, time.strftime( CAPTURE_FORMAT ))
+            if os.path.exists( self.capture ):
+                self.capture = '%s-%s'%( self.capture, os.getpid() )
+            self.profiler = profiler.Profiler(
+                self.capture,
+                lines = self.lines,
+                segment_size = self.segment_size,
+                disk_budget = max( self.disk_budget - kept, 1 ) if self.disk_budget else None,
+                max_events = max_events,
+                all_threads = self.all_threads,
+            )
+            self.profiler.start()
+            if duration:
+                self.timer = threading.Timer( duration, self.stop )
+                self.timer.daemon = True
+                self.timer.start()
+            log.info( 'Started profile capture in %s', self.capture )
+            return self.capture
+    def stop( self ):
+        """Stop the current capture (if any)"""
+        with self.lock:
+            if self.timer is not None:
+                timer,self.timer = self.timer,None
+                timer.cancel()
+            if self.profiler is not None:
+                prof,self.profiler = self.profiler,None
+                prof.stop()
+                prof.close()
+                log.info( 'Finished profile capture in %s', self.capture )
+                return self.capture
+        return None
+
+    def status( self ):
+        """Report our current status as a dictionary"""
+        result = {
+            'active': self.active,
+            'capture': self.capture,
+            'directory': self.directory,
+        }
+        if self.profiler is not None:
+            result['events'] = self.profiler.events
+        return result
+
+    def captures( self ):
+        """Find our capture directories, oldest first"""
+        if not os.path.isdir( self.directory ):
+            return []
+        return sorted([
+            os.path.join( self.directory, name )
+            for name in os.listdir( self.directory )
+            if name.startswith( 'capture-' )
+        ])
+    def prune( self, reserve=0 ):
+        """Delete the oldest (inactive) captures until we are within our disk budget
+        
+        reserve -- bytes of the budget to leave free (for a new capture)
+        
+        returns the total size of the captures kept
+        """
+        if not self.disk_budget:
+            return 0
+        captures = [(path,directory_size( path )) for path in self.captures()]
+        total = sum([ size for (path,size) in captures ], 0)
+        for path,size in captures:
+            if total + reserve <= self.disk_budget:
+                break
+            if self.active and path == self.capture:
+                continue
+            shutil.rmtree( path, True )
+            total -= size
+        return total
+
+    def listen( self ):
+        """Open our control socket and start a listener thread"""
+        if os.path.exists( self.socket_path ):
+            os.remove( self.socket_path )
+        self.server = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        self.server.bind( self.socket_path )
+        os.chmod( self.socket_path, 0o600 )
+        self.server.listen( 1 )
+        self.listener = threading.Thread( target=self.serve, name='coldshot-controller' )
+        self.listener.daemon = True
+        self.listener.start()
+    def serve( self ):
+        """Accept and process control connections (runs in listener thread)"""
+        while self.server is not None:
+            try:
+                connection,address = self.server.accept()
+            except (socket.error,AttributeError):
+                return
+            try:
+                request = connection.makefile( 'r' ).readline()
+                response = self.command( request )
+                connection.sendall( (json.dumps( response ) + '\n').encode( 'utf-8' ))
+            except Exception as err:
+                log.exception( 'Failure processing control command' )
+            finally:
+                connection.close()
+    def command( self, request ):
+        """Process a textual command: start [seconds [events]], stop or status"""
+        words = request.split()
+        if not words:
+            return {'error': 'empty command'}
+        command = words[0].lower()
+        if command == 'start':
+            arguments = {}
+            if len(words) > 1:
+                arguments['duration'] = float( words[1] )
+            if len(words) > 2:
+                arguments['max_events'] = int( words[2] )
+            self.dispatch( 'start', arguments )
+        elif command == 'stop':
+            self.dispatch( 'stop', {} )
+        elif command != 'status':
+            return {'error': 'unknown command %r'%( command, )}
+        return self.status()
+    def dispatch( self, command, arguments ):
+        """Run command on the main thread if we need to, otherwise in this thread"""
+        if (
+            not self.all_threads and 
+            self.signum is not None and self.previous_handler is not None
+        ):
+            self.pending = (command,arguments)
+            os.kill( os.getpid(), self.signum )
+            # wait (briefly) for the main thread to act on the signal
+            for i in range( 50 ):
+                if self.pending is None:
+                    break
+                time.sleep( 0.01 )
+        elif command == 'start':
+            self.start( **arguments )
+        else:
+            self.stop()
+
+def directory_size( path ):
+    """Calculate total size of the files in path"""
+    total = 0
+    for directory,subdirectories,files in os.walk( path ):
+        for name in files:
+            try:
+                total += os.stat( os.path.join( directory, name )).st_size
+            except OSError:
+                pass
+    return total
@@ -0,0 +1,225 @@
+"""Differential comparison of two Coldshot profiles
+
+Functions are matched between the two profiles by (module, name, line),
+where line is the line on which the function is declared in its file.  If a
+function has moved within its file, it is matched on (module, name) when
+that is unambiguous.  Line-level timings are matched by their offset from
+the start of the function, so edits above a function do not break matching.
+
+.. code:: python
+
+    from coldshot import diff
+    deltas = diff.diff( 'before.profile', 'after.profile' )
+    for delta in diff.regressions( deltas ):
+        print delta
+"""
+import json
+from . import aggregates
+try:
+    basestring
+except NameError:
+    basestring = str
+
+__all__ = ('FunctionStats','FunctionDelta','aggregate','diff','regressions','report')
+
+class FunctionStats( object ):
+    """Snapshot of the statistics for a single function (times in seconds)"""
+    __slots__ = ('module','name','line','calls','cumulative','local','lines')
+    def __init__( self, module, name, line, calls=0, cumulative=0.0, local=0.0, lines=None ):
+        self.module = module
+        self.name = name
+        self.line = line
+        self.calls = calls
+        self.cumulative = cumulative
+        self.local = local
+        self.lines = lines or {}
+    @property
+    def key( self ):
+        return (self.module,self.name,self.line)
+    @classmethod
+    def from_function( cls, function ):
+        """Create from a :py:class:`coldshot.stack.FunctionInfo`"""
+        timer_unit = function.loader.timer_unit
+        lines = {}
+        for line,line_info in function.line_map.items():
+            lines[line - function.line] = (line_info.calls, line_info.time * timer_unit)
+        return cls(
+            function.module, function.name, function.line,
+            function.calls, function.cumulative, function.local,
+            lines,
+        )
+
+class FunctionDelta( object ):
+    """Difference between two profiles for a single function
+
+    Attributes:
+
+        key -- (module,name,line) of the function (line from after if present)
+
+        before/after -- FunctionStats (or None if not present in the profile)
+
+        calls/cumulative/local -- after - before for the given metric
+
+        lines -- [(offset,calls_delta,time_delta),...] for changed lines
+    """
+    def __init__( self, before, after ):
+        self.before = before
+        self.after = after
+        self.key = (after or before).key
+        empty = FunctionStats( *self.key )
+        before = before or empty
+        after = after or empty
+        self.calls = after.calls - before.calls
+        self.cumulative = after.cumulative - before.cumulative
+        self.local = after.local - before.local
+        self.lines = []
+        for offset in sorted( set( before.lines ) | set( after.lines )):
+            before_calls,before_time = before.lines.get( offset, (0,0.0) )
+            after_calls,after_time = after.lines.get( offset, (0,0.0) )
+            self.lines.append( (offset, after_calls - before_calls, after_time - before_time) )
+    @property
+    def ratio( self ):
+        """Relative change in cumulative time (after/before - 1)"""
+        if self.before is None or not self.before.cumulative:
+            if self.cumulative:
+                return float( 'inf' )
+            return 0.0
+        return self.cumulative / self.before.cumulative
+    def significant( self, min_time=0.001, min_ratio=0.05, min_calls=1 ):
+        """Is this change above the given noise thresholds?"""
+        if abs( self.calls ) >= min_calls and min_calls > 0:
+            return True
+        for delta,base in [
+            (self.cumulative,self.before.cumulative if self.before else 0.0),
+            (self.local,self.before.local if self.before else 0.0),
+        ]:
+            if abs( delta ) >= min_time and (not base or abs( delta/base ) >= min_ratio):
+                return True
+        return False
+    def regressed( self, min_time=0.001, min_ratio=0.05 ):
+        """Did cumulative time increase beyond the noise thresholds?"""
+        return self.cumulative >= min_time and self.ratio >= min_ratio
+    def as_dict( self ):
+        """Produce a json-compatible representation of the delta"""
+        result = {
+            'module': self.key[0],
+            'name': self.key[1],
+            'line': self.key[2],
+            'calls': self.calls,
+            'cumulative': self.cumulative,
+            'local': self.local,
+            'lines': [
+                {'offset':offset,'calls':calls,'time':time}
+                for (offset,calls,time) in self.lines
+            ],
+        }
+        for name,stats in [('before',self.before),('after',self.after)]:
+            if stats is None:
+                result[name] = None
+            else:
+                result[name] = {
+                    'calls': stats.calls,
+                    'cumulative': stats.cumulative,
+                    'local': stats.local,
+                }
+        return result
+    def __repr__( self ):
+        return '<%s %s:%s:%s %+d calls %+0.6fs cumulative %+0.6fs local>'%(
+            self.__class__.__name__,
+            self.key[0], self.key[1], self.key[2],
+            self.calls, self.cumulative, self.local,
+        )
+
+def aggregate( source, use_cache=True ):
+    """Produce {(module,name,line): FunctionStats} for source
+
+    source -- a profile directory, a LoaderInfo, or an existing aggregate
+        mapping (which is returned unchanged)
+    use_cache -- if True, profile directories use/write their cached aggregates,
+        if False the directories are not modified
+    """
+    if isinstance( source, dict ):
+        return source
+    if isinstance( source, (bytes,basestring) ):
+        source = aggregates.load( source, use_cache=use_cache, write_cache=use_cache )
+    result = {}
+    for function in source.functions.values():
+        if function.key == 0xffffffff:
+            # the synthetic root is not a function in the profile
+            continue
+        stats = FunctionStats.from_function( function )
+        result[stats.key] = stats
+    return result
+
+def _match( before, after ):
+    """Match keys in before to keys in after, yield (before,after) pairs"""
+    unmatched_before = set( before ) - set( after )
+    unmatched_after = set( after ) - set( before )
+    for key in set( before ) & set( after ):
+        yield before[key], after[key]
+    # Functions which moved within their files...
+    by_name = {}
+    for key in unmatched_after:
+        by_name.setdefault( key[:2], [] ).append( key )
+    for key in sorted( unmatched_before ):
+        candidates = by_name.get( key[:2], [] )
+        if len( candidates ) == 1:
+            other = candidates.pop()
+            unmatched_after.discard( other )
+            yield before[key], after[other]
+        else:
+            yield before[key], None
+    for key in sorted( unmatched_after ):
+        yield None, after[key]
+
+def diff( before, after, min_time=0.001, min_ratio=0.05, min_calls=1, use_cache=True ):
+    """Compare two profiles and return significant FunctionDelta records
+
+    before/after -- profile directories, LoaderInfo instances or aggregates
+    min_time -- minimum absolute change (seconds) in cumulative or local time
+    min_ratio -- minimum relative change in cumulative or local time
+    min_calls -- minimum absolute change in call count (0 to ignore calls)
+
+    returns list of FunctionDelta sorted by decreasing absolute change in
+    cumulative time
+    """
+    before = aggregate( before, use_cache=use_cache )
+    after = aggregate( after, use_cache=use_cache )
+    result = []
+    for old,new in _match( before, after ):
+        delta = FunctionDelta( old, new )
+        if delta.significant( min_time=min_time, min_ratio=min_ratio, min_calls=min_calls ):
+            result.append( delta )
+    result.sort( key=lambda x: (-abs(x.cumulative),x.key) )
+    return result
+
+def regressions( deltas, min_time=0.001, min_ratio=0.05 ):
+    """Filter deltas to those where cumulative time regressed"""
+    return [
+        delta for delta in deltas
+        if delta.regressed( min_time=min_time, min_ratio=min_ratio )
+    ]
+
+def report( deltas, lines=False, format='text' ):
+    """Format deltas as a textual report or json document"""
+    if format == 'json':
+        return json.dumps( [delta.as_dict() for delta in deltas], indent=1, sort_keys=True )
+    header = '%s %s %s %s %s %s'%(
+        'Namespace'.rjust(30),'Line','Name'.ljust(20),'Calls'.rjust(9),
+        'Cumtime'.rjust(12),'Local'.rjust(12),
+    )
+    report = [ header, '' ]
+    for delta in deltas:
+        report.append( '%s %s %s % +9d % +12.6f % +12.6f'%(
+            delta.key[0][-30:].rjust(30),
+            str(delta.key[2]).ljust(4),
+            delta.key[1].ljust(20),
+            delta.calls,
+            delta.cumulative,
+            delta.local,
+        ))
+        if lines:
+            for (offset,calls,time) in delta.lines:
+                if calls or time:
+                    report.append( '    % +5d % +9d % +12.6f'%( offset, calls, time ))
+    return '\n'.join( report )
@@ -6,6 +6,7 @@ cdef class MappedFile:
     cdef long filesize
     cdef object fh 
     cdef object mm
+    cdef public bint swapendian
     cdef public long record_count
     
 cdef class EventsFile(MappedFile):
@@ -17,5 +18,6 @@ cdef class CallsIterator:
     cdef long stop
     cdef long step
 
+cdef void swap_records( event_info * records, long count )
 cdef uint16_t swap_16( uint16_t input )
 cdef uint32_t swap_32( uint32_t input )
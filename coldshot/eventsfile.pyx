@@ -4,7 +4,10 @@ Provides the mechanisms required to get a pointer into a set of structures
 stored on disk which describe the events observed by the Profiler.
 
 A MappedFile instance allows you to iterate over the (native endian) records 
-stored in a given ``coldshot.data``.
+stored in a given ``coldshot.data``.  Data-files are written in the byte-order 
+of the profiled machine (declared by the ``bigendian`` field of the index's 
+prefix record), pass ``swapendian=True`` to load a file written with the other 
+byte-order, the whole file is then converted to native order when mapped.
 
 .. code:: python
 
@@ -22,12 +25,21 @@ cdef class MappedFile:
     Each MappedFile sub-class has a particular record-type associated with the 
     data-pointer.  That record-type determines what will be produced by the 
     iterator for the file.
+    
+    filename -- file to map 
+    swapendian -- if True, the records were written with the opposite 
+        byte-order to ours, they are mapped copy-on-write (the file itself 
+        is never modified) and converted in place
     """
-    def __cinit__( self, filename ):
+    def __cinit__( self, filename, swapendian=False ):
         self.filename = filename
+        self.swapendian = swapendian
         self.fh = open( filename, 'rb' )
         self.filesize = os.stat( filename ).st_size 
-        self.mm = mmap.mmap( self.fh.fileno(), self.filesize, prot=mmap.PROT_READ )
+        if swapendian:
+            self.mm = mmap.mmap( self.fh.fileno(), self.filesize, access=mmap.ACCESS_COPY )
+        else:
+            self.mm = mmap.mmap( self.fh.fileno(), self.filesize, prot=mmap.PROT_READ )
         self.get_pointer( self.mm )
     def close( self ):
         """Close our memory map and file handle"""
@@ -55,6 +67,8 @@ cdef class EventsFile(MappedFile):
         c_level = <mmap_object *>mm
         self.records = <event_info *>(c_level[0].data)
         self.record_count = self.filesize // sizeof( event_info )
+        if self.swapendian:
+            swap_records( self.records, self.record_count )
     def __iter__( self ):
         """Iterate over all of the records in the events file"""
         return CallsIterator( self, 0, self.record_count, 1 )
@@ -96,6 +110,17 @@ cdef class CallsIterator:
         """Iterate over a sliced calls iterator"""
         return CallsIterator( self.records, self.position, self.stop, self.step )
 
+cdef void swap_records( event_info * records, long count ):
+    """Byte-swap every field of count records in place (bulk conversion)"""
+    cdef long i
+    cdef event_info * record
+    for i in range( count ):
+        record = &records[i]
+        record.thread = swap_16( record.thread )
+        record.line = swap_16( record.line )
+        record.function = swap_32( record.function )
+        record.timestamp = swap_32( record.timestamp )
+
 def byteswap_16( input ):
     return swap_16( input )
 def byteswap_32( input ):
@@ -1,7 +1,11 @@
-"""Top level (mainloop-like) operations"""
-from . import profiler, loader, reporter, eventsfile
-import tempfile, atexit, sys
+"""Top level (mainloop-like) operations
+
+Only the profiler is imported up-front, the loading and reporting tools 
+are imported by the entry points which need them.
+"""
+from . import profiler
 from optparse import OptionParser
+import atexit, sys
 try:
     unicode 
 except NameError:
@@ -29,7 +33,10 @@ def run( code, filename=None, lines=False ):
     """
     return runctx( code, {}, {}, filename, lines=lines )
     
-def runctx( code, globals=None, locals=None, prof_dir=None, lines=False ):
+def runctx( 
+    code, globals=None, locals=None, prof_dir=None, lines=False, memory=None, cpu=False,
+    aggregate=False, snapshot_interval=None, instrument=False,
+):
     """Run exec-able code under the profiler
     
     code -- exec-able code (string, code, file) to run 
@@ -45,17 +52,27 @@ def runctx( code, globals=None, locals=None, prof_dir=None, lines=False ):
             # do something with prof...
         finally:
             shutil.rmtree( prof.writer.directory )
+    memory -- if provided, record memory allocation events (see Profiler)
+    cpu -- if True, record per-thread CPU time (see Profiler)
+    aggregate -- if True, record totals in memory rather than events (see Profiler)
+    snapshot_interval -- seconds between aggregate-mode snapshots
+    instrument -- if True, measure time spent in the callbacks (see Profiler)
     
     returns profiler.Profiler instance (if execution was successful), or 
         raises any errors encountered in the execution
     """
     if prof_dir is None:
+        import tempfile
         prof_dir = tempfile.mkdtemp( prefix='coldshot-', suffix = '-profile' )
     if globals is None:
         globals = {}
     if locals is None:
         locals = globals 
-    prof = profiler.Profiler( as_8_bit(prof_dir), lines=lines )
+    prof = profiler.Profiler( 
+        as_8_bit(prof_dir), lines=lines, memory=memory, cpu=cpu, 
+        aggregate=aggregate, snapshot_interval=snapshot_interval,
+        instrument=instrument,
+    )
     atexit.register( prof.stop )
     prof.start()
     try:
@@ -86,6 +103,34 @@ so it should not be run on long-running processes."""
         default = False,
         help='Perform line-level tracing (requires an extra 2.5MB/s of disk space)',
     )
+    parser.add_option(
+        '-M', '--memory', dest='memory',
+        action = 'store_true',
+        default = False,
+        help='Record memory allocated/freed by each call (and line)',
+    )
+    parser.add_option(
+        '-C', '--cpu', dest='cpu',
+        action = 'store_true',
+        default = False,
+        help='Record per-thread CPU time as well as wall-clock time for each call',
+    )
+    parser.add_option(
+        '-A', '--aggregate', dest='aggregate',
+        action = 'store_true',
+        default = False,
+        help='Keep function/line totals in memory rather than writing events (constant disk use)',
+    )
+    parser.add_option(
+        '--snapshot-interval', dest='snapshot_interval', type='float', default=None,
+        help='With --aggregate, seconds between snapshots of the totals while running',
+    )
+    parser.add_option(
+        '--instrument', dest='instrument',
+        action = 'store_true',
+        default = False,
+        help='Measure the time spent in the profiler\'s callbacks (see --view=stats, adds overhead)',
+    )
     parser.disable_interspersed_args()
     return parser
     
@@ -114,15 +159,140 @@ def profile_main():
         '__name__': '__main__',
         '__package__': None,
     }
-    runctx(code, globals, None, prof_dir=options.output, lines=options.lines)
+    runctx(
+        code, globals, None, prof_dir=options.output, lines=options.lines,
+        memory=options.memory or None, cpu=options.cpu,
+        aggregate=options.aggregate, snapshot_interval=options.snapshot_interval,
+        instrument=options.instrument,
+    )
     return 0
 
+def report_options():
+    """Create an option parser for the report operation"""
+    from . import reporter
+    usage = "%prog [options] profile_directory"
+    description = """Print a tabular report on a coldshot profile directory"""
+    parser = OptionParser( 
+        usage=usage, add_help_option=True, description=description,
+    )
+    parser.add_option(
+        '-n', '--limit', dest='limit', metavar='INTEGER', default=50,
+        type='int',
+        help='Report only the top N rows (0 for all rows)',
+    )
+    parser.add_option(
+        '-s', '--sort', dest='sort', metavar='COLUMN', default=[],
+        action='append',
+        help='Sort by the given column, prefix with - for descending (repeatable, default -time)',
+    )
+    parser.add_option(
+        '-c', '--columns', dest='columns', metavar='COLUMNS', 
+        default=','.join( reporter.DEFAULT_COLUMNS ),
+        help='Comma-separated columns to report (%s)'%( ','.join(sorted(reporter.COLUMNS)), ),
+    )
+    parser.add_option(
+        '-m', '--module', dest='modules', metavar='MODULE', default=None,
+        action='append',
+        help='Only report functions in the given module/package (repeatable)',
+    )
+    parser.add_option(
+        '-t', '--thread', dest='threads', metavar='THREAD', default=None,
+        action='append', type='int',
+        help='Only report functions run in the given thread (repeatable)',
+    )
+    parser.add_option(
+        '-a', '--annotation', dest='annotations', metavar='ANNOTATION', default=None,
+        action='append',
+        help='Report the functions run while the given annotation was active (repeatable)',
+    )
+    parser.add_option(
+        '-v', '--view', dest='view', metavar='VIEW', default='functions',
+        type='choice', choices=['functions','modules','threads','annotations','spans','lines','files','stats'],
+        help='Report functions (default), modules, threads, annotations, the slowest annotated spans, annotated source for the hottest functions (lines) or files, or the profiler\'s own counters (stats)',
+    )
+    parser.add_option(
+        '-l', '--lines', dest='lines', action='store_true', default=False,
+        help='Include per-line timings for each function (text format only)',
+    )
+    parser.add_option(
+        '-M', '--memory', dest='memory', action='store_true', default=False,
+        help='Add the memory columns (%s) for profiles recorded with --memory'%( 
+            ','.join(reporter.MEMORY_COLUMNS), 
+        ),
+    )
+    parser.add_option(
+        '-C', '--cpu', dest='cpu', action='store_true', default=False,
+        help='Add the CPU-time columns (%s) for profiles recorded with --cpu'%( 
+            ','.join(reporter.CPU_COLUMNS), 
+        ),
+    )
+    parser.add_option(
+        '-L', '--latency', dest='latency', action='store_true', default=False,
+        help='Add the call-duration percentile columns (%s)'%( 
+            ','.join(reporter.LATENCY_COLUMNS), 
+        ),
+    )
+    parser.add_option(
+        '-f', '--format', dest='format', metavar='FORMAT', default='text',
+        type='choice', choices=list(reporter.FORMATS),
+        help='Output format (%s)'%( ', '.join(reporter.FORMATS), ),
+    )
+    return parser
+
 def report_main():
     """Load the data-set and print a basic report"""
-    load = loader.Loader( sys.argv[1] )
+    from . import loader, reporter
+    parser = report_options()
+    options,args = parser.parse_args()
+    if len(args) != 1:
+        parser.error( "Need a profile directory to report on" )
+        return 1
+    if options.view in ('lines','files'):
+        from . import aggregates
+        lines = reporter.LineReporter( 
+            aggregates.load( args[0] ), 
+            limit=options.limit or None,
+        )
+        if options.view == 'lines':
+            print( lines.function_report() )
+        else:
+            print( lines.file_report() )
+        return 0
+    load = loader.Loader( 
+        args[0], 
+        thread_functions = options.threads is not None or options.view == 'threads',
+    )
     load.load()
-    report = reporter.Reporter( load )
-    print( report.report() )
+    columns = [column.strip() for column in options.columns.split(',') if column.strip()]
+    if options.memory:
+        columns.extend([ column for column in reporter.MEMORY_COLUMNS if column not in columns ])
+    if options.cpu:
+        columns.extend([ column for column in reporter.CPU_COLUMNS if column not in columns ])
+    if options.latency:
+        columns.extend([ column for column in reporter.LATENCY_COLUMNS if column not in columns ])
+    report = reporter.Reporter( 
+        load, 
+        sort = options.sort or ('-time','module','name'),
+        limit = options.limit or None,
+        columns = columns,
+        modules = options.modules,
+        threads = options.threads,
+        annotations = options.annotations,
+        lines = options.lines,
+        format = options.format,
+    )
+    if options.view == 'modules':
+        print( report.module_report() )
+    elif options.view == 'threads':
+        print( report.thread_report() )
+    elif options.view == 'annotations':
+        print( report.annotation_report() )
+    elif options.view == 'spans':
+        print( report.span_report() )
+    elif options.view == 'stats':
+        print( report.stats_report() )
+    else:
+        print( report.report() )
     return 0
 
 def raw_options():
@@ -143,17 +313,23 @@ def raw_options():
         '-S', '--stop', dest='stop', metavar='INTEGER', default=None,
         type="int",
     )
+    parser.add_option(
+        '-x', '--swap-endian', dest='swapendian', default=False,
+        action='store_true',
+        help='Data-file was written on a machine of the other byte-order',
+    )
     return parser
 
     
 def raw_events_main():
     """Load the data-set and print each record as a python dictionary"""
+    from . import eventsfile
     parser = raw_options()
     options,args = parser.parse_args()
     if args:
         options.input = args[0]
         args = args[1:]
-    scanner = eventsfile.EventsFile( options.input )
+    scanner = eventsfile.EventsFile( options.input, options.swapendian )
     
     depth = 0
     for line in scanner[options.start:(options.stop or scanner.record_count)]:
@@ -164,3 +340,190 @@ def raw_events_main():
             depth -= 1
         if depth < 0:
             depth = 0
+
+def timeline_options():
+    usage = """%prog [options] profile_directory"""
+    description = """Report per-thread run timelines, busy time, context switches and 
+the time during which other threads held the GIL"""
+    parser = OptionParser( 
+        usage=usage, add_help_option=True, description=description,
+    )
+    parser.add_option(
+        '-w', '--width', dest='width', metavar='INTEGER', default=None,
+        type='int',
+        help='Width of the timeline strips (characters for text, pixels for html)',
+    )
+    parser.add_option(
+        '-o', '--html', dest='html', metavar='FILENAME', default=None,
+        help='Write an HTML timeline to the given file instead of a textual report',
+    )
+    return parser
+
+def timeline_main():
+    """Load the data-set and report on per-thread timelines"""
+    from . import loader, timeline
+    parser = timeline_options()
+    options,args = parser.parse_args()
+    if len(args) != 1:
+        parser.error( "Need a profile directory to report on" )
+        return 1
+    load = loader.Loader( args[0] )
+    load.load()
+    lines = timeline.Timeline( load.info )
+    if options.html:
+        with open( options.html, 'w' ) as fh:
+            fh.write( lines.html( width=options.width or 800 ))
+    else:
+        print( lines.report( width=options.width or 60 ))
+    return 0
+
+def index_options():
+    usage = """%prog [options] profile_directory"""
+    description = """Build an SQLite call store (one row per call) from a coldshot 
+profile directory in a single pass, and optionally run SQL queries against 
+it (tables calls, functions, annotations, meta and the call_times view)."""
+    parser = OptionParser( 
+        usage=usage, add_help_option=True, description=description,
+    )
+    parser.add_option(
+        '-o', '--output', dest='output', metavar='FILENAME', default=None,
+        help='Database to write (default calls.sqlite in the profile directory)',
+    )
+    parser.add_option(
+        '-q', '--sql', dest='sql', metavar='SQL', default=[],
+        action='append',
+        help='Run the given SQL query against the store and print the rows (repeatable)',
+    )
+    parser.add_option(
+        '-f', '--force', dest='force', action='store_true', default=False,
+        help='Rebuild the store even if it is newer than the profile',
+    )
+    return parser
+
+def index_main():
+    """Build (and query) the SQLite call store for a profile"""
+    from . import callstore
+    parser = index_options()
+    options,args = parser.parse_args()
+    if len(args) != 1:
+        parser.error( "Need a profile directory to index" )
+        return 1
+    filename = options.output or callstore.store_filename( args[0] )
+    if options.force or not callstore.is_current( args[0], filename ):
+        store = callstore.build( args[0], filename )
+        if not options.sql:
+            print( '%s calls written to %s'%( store.meta()['calls'], filename ))
+    else:
+        store = callstore.CallStore( filename )
+    try:
+        for sql in options.sql:
+            columns,rows = store.columns( sql )
+            print( '\t'.join( columns ))
+            for row in rows:
+                print( '\t'.join([ str( value ) for value in row ]))
+    finally:
+        store.close()
+    return 0
+
+def diff_options():
+    usage = """%prog [options] before.profile after.profile"""
+    description = """Compare two coldshot profile directories, reporting changes in 
+calls, cumulative, local and per-line time which exceed the noise thresholds."""
+    parser = OptionParser( 
+        usage=usage, add_help_option=True, description=description,
+    )
+    parser.add_option(
+        '-t', '--min-time', dest='min_time', metavar='SECONDS', default=0.001,
+        type='float',
+        help='Ignore changes in time smaller than this many seconds',
+    )
+    parser.add_option(
+        '-r', '--min-ratio', dest='min_ratio', metavar='FRACTION', default=0.05,
+        type='float',
+        help='Ignore changes in time smaller than this fraction of the original time',
+    )
+    parser.add_option(
+        '-c', '--min-calls', dest='min_calls', metavar='INTEGER', default=1,
+        type='int',
+        help='Ignore changes in call-count smaller than this (0 to ignore call counts)',
+    )
+    parser.add_option(
+        '-l', '--lines', dest='lines', action='store_true', default=False,
+        help='Include per-line changes in the textual report',
+    )
+    parser.add_option(
+        '-j', '--json', dest='json', action='store_true', default=False,
+        help='Produce a machine-readable (json) report',
+    )
+    parser.add_option(
+        '-f', '--fail-on-regression', dest='fail', action='store_true', default=False,
+        help='Exit with status 1 if any function regressed beyond the thresholds',
+    )
+    parser.add_option(
+        '--no-cache', dest='use_cache', action='store_false', default=True,
+        help='Do not use (or write) cached aggregates in the profile directories',
+    )
+    return parser
+
+def diff_main():
+    """Compare two profiles and report significant differences"""
+    from . import diff
+    parser = diff_options()
+    options,args = parser.parse_args()
+    if len(args) != 2:
+        parser.error( "Need a before and after profile directory" )
+        return 1
+    deltas = diff.diff( 
+        args[0], args[1], 
+        min_time=options.min_time, 
+        min_ratio=options.min_ratio, 
+        min_calls=options.min_calls,
+        use_cache=options.use_cache,
+    )
+    print( diff.report( deltas, lines=options.lines, format=['text','json'][options.json] ))
+    if options.fail and diff.regressions( deltas, min_time=options.min_time, min_ratio=options.min_ratio ):
+        return 1
+    return 0
+
+def serve_options():
+    usage = """%prog [options] profile_directory"""
+    description = """Serve a coldshot profile directory as a local web viewer with 
+sortable function tables, caller/callee and line views and per-call drill-down."""
+    parser = OptionParser( 
+        usage=usage, add_help_option=True, description=description,
+    )
+    parser.add_option(
+        '-H', '--host', dest='host', metavar='ADDRESS', default='127.0.0.1',
+        help='Address on which to listen (default 127.0.0.1, use 0.0.0.0 to allow remote access)',
+    )
+    parser.add_option(
+        '-p', '--port', dest='port', metavar='PORT', default=8000,
+        type='int',
+        help='Port on which to listen (default 8000)',
+    )
+    parser.add_option(
+        '--no-cache', dest='use_cache', action='store_false', default=True,
+        help='Do not use (or write) cached aggregates in the profile directory',
+    )
+    return parser
+
+def serve_main():
+    """Serve a profile over HTTP until interrupted"""
+    from . import webview
+    parser = serve_options()
+    options,args = parser.parse_args()
+    if len(args) != 1:
+        parser.error( "Need a profile directory to serve" )
+        return 1
+    server = webview.make_server( 
+        args[0], options.host, options.port, use_cache=options.use_cache,
+    )
+    host,port = server.server_address[:2]
+    print( 'Serving %s on http://%s:%s/'%( args[0], host, port ))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
@@ -21,14 +21,33 @@ cdef public class Loader [object Coldshot_Loader, type Coldshot_Loader_Type ]:
         
         index_filename -- filename from which the index was loaded
         
-        call_files -- list of call files to load (defined in the index)
+        call_files -- list of call files to load (defined in the index), 
+            call files are processed in order, with per-thread stacks carried 
+            over from one file to the next (i.e. segments), profiles recorded 
+            with per-thread writers have one (or more) files per thread
+        
+        aggregate_files -- list of snapshot files (aggregate-mode profiles, 
+            see :py:mod:`coldshot.aggregates`) read into info after the 
+            call files have been processed
         
         info -- LoaderInfo instance populated by the loading process
+        
+        progress -- if not None, callable( records_done, records_total ) 
+            called periodically while processing the call files
+        
+        latency_edges -- (constructor argument) if True, record a latency 
+            histogram for each caller/callee edge as well as each function, 
+            see :py:class:`coldshot.stack.LatencyHistogram`
+        
+        thread_functions -- (constructor argument) if True, keep per-thread 
+            function totals in each :py:class:`coldshot.stack.Stack` (needed 
+            for per-thread function reports, costs time on every call)
     """
     cdef public object directory
     
     cdef public object index_filename
     cdef public list call_files 
+    cdef public list aggregate_files
     
     cdef public int version 
     
@@ -37,14 +56,32 @@ cdef public class Loader [object Coldshot_Loader, type Coldshot_Loader_Type ]:
     # function IDs for which individual call records should be retained...
     cdef public set individual_calls
     
-    def __cinit__( self, directory, individual_calls=None ):
+    # range of timestamps seen in all processed call files
+    cdef public uint32_t lowest_ts
+    cdef public uint32_t highest_ts
+    
+    # progress reporting for (background) loading
+    cdef public object progress
+    cdef public long records_done
+    cdef public long records_total
+    
+    def __cinit__( 
+        self, directory, individual_calls=None, progress=None, 
+        latency_edges=False, thread_functions=False,
+    ):
         self.directory = directory
         self.index_filename = os.path.join( directory, profiler.Profiler.INDEX_FILENAME )
         
         self.individual_calls = individual_calls or set()
         self.call_files = []
+        self.aggregate_files = []
+        self.lowest_ts = 0xffffffff
+        self.highest_ts = 0
+        self.progress = progress
         
         self.info = LoaderInfo()
+        self.info.latency_edges = latency_edges
+        self.info.thread_functions = thread_functions
 
     def load( self ):
         """Scan our data-files for basic index information"""
@@ -55,10 +92,16 @@ cdef public class Loader [object Coldshot_Loader, type Coldshot_Loader_Type ]:
         """Remove quoting to get the original name"""
         return urllib.unquote( name )
     def process_index( self, index_filename ):
-        """Process the plain-text index file to load our declarations"""
-        for line in open(index_filename):
-            line = line.strip( '\n' )
-            line = line.split()
+        """Process the plain-text index file to load our declarations
+        
+        When profiling multiple threads a function declaration can be written 
+        before the declaration of its file (writes release the GIL), so 
+        prefix and file declarations are processed first.
+        """
+        lines = [line.split() for line in open(index_filename)]
+        lines = [line for line in lines if line]
+        lines.sort( key = lambda line: line[0] not in ('P','F') )
+        for line in lines:
             if line[0] == 'P':
                 # prefix/metadata declaration...
                 for variable in line[2:]:
@@ -66,11 +109,13 @@ cdef public class Loader [object Coldshot_Loader, type Coldshot_Loader_Type ]:
                     if key == 'bigendian':
                         self.info.bigendian = value == 'True'
                         if self.info.bigendian != (sys.byteorder == 'big'):
-                            self.info.swap_endian = True
+                            self.info.swapendian = True
                     elif key == 'version':
                         self.version = int(value)
                     elif key == 'timer_unit':
                         self.info.timer_unit = float( value )
+                    elif key == 'cpu_timer_unit':
+                        self.info.cpu_timer_unit = float( value )
             elif line[0] == 'F':
                 # code-file declaration
                 fileno,filename = line[1:3]
@@ -97,13 +142,33 @@ cdef public class Loader [object Coldshot_Loader, type Coldshot_Loader_Type ]:
             elif line[0] == 'D':
                 # data-file declaration...
                 if line[1] == 'calls':
-                    self.call_files.append( line[2] )
+                    self.call_files.append( self.data_filename( self.unquote( line[2] )) )
+                elif line[1] == 'aggregate':
+                    self.aggregate_files.append( self.data_filename( self.unquote( line[2] )) )
                 else:
                     log.error( "Unrecognized data-file type: %s %s", line[1], line[2] )
             elif line[0] == 'A':
                 # annotation added...
                 self.info.add_annotation( int(line[1]), self.unquote(line[2]))
+            elif line[0] == 'S':
+                # profiler counter, later (stop) records replace earlier ones
+                value = line[2]
+                self.info.profiler_stats[self.unquote( line[1] )] = (
+                    float( value ) if '.' in value or 'e' in value else int( value )
+                )
         self.info.individual_calls = self.convert_individual_calls()
+    def data_filename( self, filename ):
+        """Resolve a data-file declared in the index
+        
+        The profiler records the path as it was given to the profiler, so 
+        relative paths (or profiles which have been moved) are resolved 
+        relative to our directory.
+        """
+        if not os.path.exists( filename ):
+            local = os.path.join( self.directory, os.path.basename( filename ))
+            if os.path.exists( local ):
+                return local
+        return filename
     def convert_individual_calls( self ):
         """Convert the individual calls mapping into id-based mapping and add to info"""
         # Now need to convert anything which is name-based into ID-based references 
@@ -121,16 +186,6 @@ cdef public class Loader [object Coldshot_Loader, type Coldshot_Loader_Type ]:
                 # query by ID, likely from a GUI with such access...
                 result.add( key )
         return result 
-    cdef uint16_t swap_16( self, uint16_t input ):
-        """Do a 16-bit integer endian swap"""
-        if self.info.swapendian:
-            return swap_16( input )
-        return input 
-    cdef uint32_t swap_32( self, uint32_t input ):
-        """Do a 32-bit integer endian swap"""
-        if self.info.swapendian:
-            return swap_32( input )
-        return input
     cdef uint32_t extract_function( self, uint32_t input ):
         """Extract function from packed input"""
         cdef uint32_t function_mask = 0x00ffffff
@@ -143,8 +198,41 @@ cdef public class Loader [object Coldshot_Loader, type Coldshot_Loader_Type ]:
     
     def process_calls( self ):
         """Process all of our call files"""
+        cdef FunctionInfo root = self.info.roots[ 'functions' ]
+        call_files = [
+            call_file for call_file in self.call_files 
+            if os.path.exists( call_file )
+        ]
         for call_file in self.call_files:
+            if call_file not in call_files:
+                # e.g. segment pruned to keep within a disk budget
+                log.warn( 'Data-file %s is missing, skipping', call_file )
+        self.records_done = 0
+        self.records_total = sum([ 
+            os.stat( call_file ).st_size // sizeof( event_info )
+            for call_file in call_files
+        ], 0)
+        for call_file in call_files:
+            # slowest-call records refer to the call file by index
+            self.info.call_file = self.call_files.index( call_file )
             self.process_call_file( call_file )
+        if self.progress is not None:
+            self.progress( self.records_done, self.records_total )
+        for stack in self.info.threads.values():
+            stack.finish()
+        if self.highest_ts >= self.lowest_ts:
+            # root needs to finalize...
+            root.last_timestamp = self.highest_ts
+            root.first_timestamp = self.lowest_ts 
+            root.record_call( self.highest_ts )
+            root.record_time_spent( self.highest_ts - self.lowest_ts )
+        if self.aggregate_files:
+            from . import aggregates
+            for aggregate_file in self.aggregate_files:
+                if os.path.exists( aggregate_file ):
+                    aggregates.read( aggregate_file, self.info )
+                else:
+                    log.warn( 'Snapshot %s is missing, skipping', aggregate_file )
     def process_call_file( self, calls_filename ):
         """Process a EventsFile to extract basic cProfile-like information
         
@@ -157,7 +245,7 @@ cdef public class Loader [object Coldshot_Loader, type Coldshot_Loader_Type ]:
         # State-lookup speedups.
         cdef uint16_t current_thread = 0# whether we need to load new thread info
         cdef uint32_t current_function = 0 # the function currently being processed...
-        cdef Stack stack # current stack (thread)
+        cdef Stack stack = None # current stack (thread)
         cdef FunctionInfo function_info # current function 
         cdef CallInfo call_info # temp for function being called...
         cdef CallInfo root_call
@@ -170,38 +258,60 @@ cdef public class Loader [object Coldshot_Loader, type Coldshot_Loader_Type ]:
         cdef uint32_t timestamp = 0
         cdef uint32_t flags = 0
         cdef uint16_t line = 0
+        
+        # counter records apply to the (same thread's) next event
+        cdef long long value = 0
+        cdef long long memory = 0
+        cdef long long cpu = -1
 
-        # Canonical state storage...
-        cdef dict stacks = {}
+        # Canonical state storage (carried across call files)...
+        cdef dict stacks = self.info.threads
         cdef FunctionInfo root = self.info.roots[ 'functions' ]
         
         # The source data...
-        cdef EventsFile calls_data = EventsFile( calls_filename )
+        cdef EventsFile calls_data = EventsFile( calls_filename, self.info.swapendian )
         
         function_info = None
         
         current_thread = 0
         
-        cdef uint32_t lowest_ts = 0xffffffff
-        cdef uint32_t highest_ts = 0
+        cdef uint32_t lowest_ts = self.lowest_ts
+        cdef uint32_t highest_ts = self.highest_ts
+        cdef uint32_t last_ts = 0
+        
+        cdef object progress = self.progress
         
         for i in range( calls_data.record_count ):
-            thread = self.swap_16( calls_data.records[i].thread )
-            timestamp = self.swap_32( calls_data.records[i].timestamp )
-            line = self.swap_16( calls_data.records[i].line )
+            if progress is not None and (i & 0xffff) == 0:
+                progress( self.records_done + i, self.records_total )
+            thread = calls_data.records[i].thread
+            timestamp = calls_data.records[i].timestamp
+            line = calls_data.records[i].line
             
-            function = self.swap_32( calls_data.records[i].function )
+            function = calls_data.records[i].function
             flags = self.extract_flags( function )
             function = self.extract_function( function )
             
+            if flags == 4: # counter, 56-bit signed value 
+                value = (<long long>function << 32) | timestamp
+                if value & 0x0080000000000000LL:
+                    value -= 0x0100000000000000LL
+                if line == 0: # memory allocated/freed
+                    memory += value
+                elif line == 1: # thread cpu clock
+                    cpu = value
+                continue
+            
             if timestamp < lowest_ts:
                 lowest_ts = timestamp
             if timestamp > highest_ts:
                 highest_ts = timestamp
                 
-            if thread != current_thread:
-                # we are following a thread context switch, 
-                # we should *likely* track that somewhere...
+            if stack is None or thread != current_thread:
+                # we are following a thread context switch, the previous 
+                # thread's run ended with its last event...
+                if stack is not None:
+                    stack.record_switch_out( last_ts )
                 stack = stacks.get( thread )
                 if stack is None:
                     stacks[thread] = stack = Stack( thread, timestamp, self.info, root )
@@ -209,6 +319,13 @@ cdef public class Loader [object Coldshot_Loader, type Coldshot_Loader_Type ]:
                     stack.record_context_switch(timestamp)
                 current_thread = thread
             
+            if memory:
+                stack.memory( memory )
+                memory = 0
+            if cpu >= 0:
+                stack.cpu = cpu
+                cpu = -1
+            
             if flags == 1: # call...
                 stack.push( self.info.functions[function], timestamp, i )
             elif flags == 2: # return 
@@ -218,13 +335,240 @@ cdef public class Loader [object Coldshot_Loader, type Coldshot_Loader_Type ]:
             elif flags == 0: # line...
                 stack.line( self.info.functions[function], timestamp, line )
             elif flags == 3: # annotation
-                stack.annotation( function, timestamp, line )
-        # root needs to finalize...
-        root.last_timestamp = highest_ts
-        root.first_timestamp = lowest_ts 
-        root.record_call( highest_ts )
-        root.record_time_spent( highest_ts - lowest_ts )
-        
-        self.info.threads.update( stacks )
+                stack.annotation( function, timestamp, line, i )
+            elif flags == 5: # exception (the following return exits the call)
+                stack.exception( self.info.functions[function] )
+            elif flags == 6: # generator yield 
+                stack.suspend( timestamp, i )
+            elif flags == 7: # generator resume
+                stack.resume( self.info.functions[function], timestamp, i )
+            last_ts = timestamp
+        if stack is not None:
+            stack.record_switch_out( last_ts )
+        self.lowest_ts = lowest_ts
+        self.highest_ts = highest_ts
+        self.records_done += calls_data.record_count
         calls_data.close()
     
+    def scan_calls( 
+        self, calls_filename, long start=0, long stop=-1, long thread=-1, 
+        long depth=-1, long function=-1,
+    ):
+        """Scan a range of a call file for calls without building aggregates
+        
+        Used for on-demand (query) loading, only the index needs to have 
+        been processed.
+        
+        calls_filename -- call file to scan
+        start, stop -- range of record indices to scan (stop -1 for the end)
+        thread -- if >= 0, only report calls from this thread
+        depth -- if >= 0, only report calls at this depth in the scanned 
+            range (i.e. 0 is the top-level calls within the range)
+        function -- if >= 0, only report calls of this function id
+        
+        Generator yields end a call (and resumes start a new one), calls 
+        returning before the range began are ignored, calls which have not 
+        returned by the end of the range are reported with a stop index of -1.
+        
+        returns [(function,thread,start_index,stop_index,start_ts,stop_ts),...]
+            in start_index order
+        """
+        cdef EventsFile calls_data = EventsFile( calls_filename, self.info.swapendian )
+        cdef uint16_t record_thread
+        cdef uint32_t record_function
+        cdef uint32_t timestamp
+        cdef uint32_t flags
+        cdef long i
+        cdef dict stacks = {}
+        cdef dict last_ts = {}
+        cdef list stack
+        cdef list result = []
+        cdef tuple entry
+        try:
+            if stop < 0 or stop > calls_data.record_count:
+                stop = calls_data.record_count
+            for i in range( max( start, 0 ), stop ):
+                record_thread = calls_data.records[i].thread
+                if thread >= 0 and record_thread != thread:
+                    continue
+                record_function = calls_data.records[i].function
+                flags = self.extract_flags( record_function )
+                if flags == 1 or flags == 7: # call or resume
+                    record_function = self.extract_function( record_function )
+                    timestamp = calls_data.records[i].timestamp
+                    stack = stacks.get( record_thread )
+                    if stack is None:
+                        stacks[record_thread] = stack = []
+                    stack.append( (record_function,i,timestamp) )
+                elif flags == 2 or flags == 6: # return or yield
+                    timestamp = calls_data.records[i].timestamp
+                    last_ts[record_thread] = timestamp
+                    stack = stacks.get( record_thread )
+                    if not stack:
+                        continue
+                    entry = stack.pop()
+                    if depth >= 0 and len(stack) != depth:
+                        continue
+                    if function >= 0 and entry[0] != function:
+                        continue
+                    result.append( (entry[0],record_thread,entry[1],i,entry[2],timestamp) )
+            for record_thread,stack in stacks.items():
+                for position,entry in enumerate( stack ):
+                    if depth >= 0 and position != depth:
+                        continue
+                    if function >= 0 and entry[0] != function:
+                        continue
+                    result.append( (
+                        entry[0],record_thread,entry[1],-1,entry[2],
+                        last_ts.get( record_thread, entry[2] ),
+                    ))
+        finally:
+            calls_data.close()
+        result.sort( key = lambda record: record[2] )
+        return result
+    def stream_calls( self, callback, long batch=10000 ):
+        """Stream one row per call from all of our call files (one pass)
+        
+        Only the index needs to have been processed.  Per-thread stacks are 
+        carried from one call file to the next, generator calls are merged 
+        into a single call (time suspended is excluded from the duration) 
+        and calls still running at the end are reported as incomplete.
+        
+        callback -- callable( rows ) called with lists of at most batch rows
+        
+        Rows are tuples of:
+        
+            (id, function, thread, start, duration, self_time, depth, 
+            parent, annotation, call_file, start_index, complete)
+        
+        where id numbers the calls in order of their start event, times are 
+        in timer units, parent is the id of the calling call (None for 
+        top-level calls), annotation is the id of the annotation current 
+        when the call started (0 for none) and call_file/start_index locate 
+        the call's start event.
+        
+        returns number of rows produced
+        """
+        cdef EventsFile calls_data
+        cdef uint16_t thread
+        cdef uint32_t function
+        cdef uint32_t timestamp
+        cdef uint32_t flags
+        cdef long i
+        cdef long call_file
+        cdef long row = 0
+        cdef StreamedCall call
+        cdef StreamedCall parent
+        cdef dict stacks = {}
+        cdef dict suspended = {}
+        cdef dict annotations = {}
+        cdef dict last_ts = {}
+        cdef list stack
+        cdef list rows = []
+        cdef long produced = 0
+        for call_file,calls_filename in enumerate( self.call_files ):
+            if not os.path.exists( calls_filename ):
+                log.warn( 'Data-file %s is missing, skipping', calls_filename )
+                continue
+            calls_data = EventsFile( calls_filename, self.info.swapendian )
+            try:
+                for i in range( calls_data.record_count ):
+                    function = calls_data.records[i].function
+                    flags = self.extract_flags( function )
+                    if flags == 0 or flags == 4 or flags == 5:
+                        # lines, counters and exceptions do not start/end calls
+                        continue
+                    function = self.extract_function( function )
+                    thread = calls_data.records[i].thread
+                    timestamp = calls_data.records[i].timestamp
+                    last_ts[thread] = timestamp
+                    stack = stacks.get( thread )
+                    if stack is None:
+                        stacks[thread] = stack = []
+                    if flags == 3: # annotation, 0 pops the annotation stack
+                        notes = annotations.setdefault( thread, [] )
+                        if function:
+                            notes.append( function )
+                        elif notes:
+                            notes.pop()
+                        continue
+                    if flags == 7: # generator resume
+                        waiting = suspended.get( (thread,function) )
+                        if waiting:
+                            call = waiting.pop()
+                            call.suspended_time += timestamp - call.suspend_start
+                            call.resumed = timestamp
+                            stack.append( call )
+                            continue
+                    if flags == 1 or flags == 7: # call (or resume of an unknown generator)
+                        call = StreamedCall()
+                        call.row = row
+                        row += 1
+                        call.function = function
+                        call.start = call.resumed = timestamp
+                        call.depth = len( stack )
+                        call.call_file = call_file
+                        call.start_index = i
+                        notes = annotations.get( thread )
+                        if notes:
+                            call.annotation = notes[-1]
+                        if stack:
+                            call.parent = (<StreamedCall>stack[-1]).row
+                        stack.append( call )
+                        continue
+                    # return or yield
+                    if not stack:
+                        # call started before the recording did
+                        continue
+                    call = stack.pop()
+                    if stack:
+                        parent = stack[-1]
+                        parent.child_time += timestamp - call.resumed
+                    if flags == 6: # yield, finished when resumed (or at the end)
+                        call.suspend_start = timestamp
+                        suspended.setdefault( (thread,call.function), [] ).append( call )
+                        continue
+                    rows.append( call.as_row( thread, timestamp, True ))
+                    if len( rows ) >= batch:
+                        produced += len( rows )
+                        callback( rows )
+                        rows = []
+            finally:
+                calls_data.close()
+        for (thread,function),calls in sorted( suspended.items() ):
+            for call in calls:
+                rows.append( call.as_row( thread, call.suspend_start, True ))
+        for thread,stack in sorted( stacks.items() ):
+            for call in stack:
+                rows.append( call.as_row( thread, last_ts[thread], False ))
+        if rows:
+            produced += len( rows )
+            callback( rows )
+        return produced
+    
+
+cdef class StreamedCall:
+    """A call in progress while streaming calls (see Loader.stream_calls)"""
+    cdef public long row
+    cdef public uint32_t function
+    cdef public uint32_t start
+    cdef public uint32_t resumed
+    cdef public uint32_t suspend_start
+    cdef public uint32_t suspended_time
+    cdef public uint32_t child_time
+    cdef public long depth
+    cdef public object parent
+    cdef public uint32_t annotation
+    cdef public long call_file
+    cdef public long start_index
+    cdef tuple as_row( self, uint16_t thread, uint32_t stop, bint complete ):
+        """Produce the (database) row for the call, which stopped at stop"""
+        cdef uint32_t duration = stop - self.start - self.suspended_time
+        cdef uint32_t local = 0
+        if duration > self.child_time:
+            local = duration - self.child_time
+        return (
+            self.row, self.function, thread, self.start, duration, local,
+            self.depth, self.parent, self.annotation, self.call_file,
+            self.start_index, complete,
+        )
@@ -1,5 +1,6 @@
 /* Hack to hide Python API versions from the Cython code */
 #include "Python.h"
+#include "frameobject.h"
 
 void coldshot_unset_trace() {
     PyEval_SetTrace(NULL, NULL);
@@ -7,3 +8,111 @@ void coldshot_unset_trace() {
 void coldshot_unset_profile() {
     PyEval_SetProfile(NULL, NULL);
 }
+
+/* Install (or with func == NULL, remove) profile/trace callbacks on every 
+   thread-state of the current interpreter, rather than just the calling 
+   thread's (which is all PyEval_SetProfile/PyEval_SetTrace do).
+
+   The calling thread is set via the regular API so that the interpreter's 
+   global "tracing possible" bookkeeping stays correct; other thread-states 
+   are updated in-place, mirroring what PyEval_SetProfile does for the 
+   current thread.  Must be called with the GIL held.
+
+   Python 3.12+ provides PyEval_SetProfileAllThreads/PyEval_SetTraceAllThreads 
+   for this.  On 3.10 and 3.11 thread-states cannot safely be updated from 
+   another thread, so only the calling thread is updated.
+
+   Returns the number of thread-states updated, or -1 if only the calling 
+   thread could be updated although other threads exist.
+*/
+#if PY_VERSION_HEX < 0x030A0000
+static void coldshot_set_tstate(PyThreadState *tstate, Py_tracefunc func, PyObject *arg, int trace) {
+    PyObject *previous;
+    Py_XINCREF(arg);
+    if (trace) {
+        previous = tstate->c_traceobj;
+        tstate->c_tracefunc = NULL;
+        tstate->c_traceobj = NULL;
+        tstate->use_tracing = tstate->c_profilefunc != NULL;
+        Py_XDECREF(previous);
+        tstate->c_tracefunc = func;
+        tstate->c_traceobj = arg;
+    } else {
+        previous = tstate->c_profileobj;
+        tstate->c_profilefunc = NULL;
+        tstate->c_profileobj = NULL;
+        tstate->use_tracing = tstate->c_tracefunc != NULL;
+        Py_XDECREF(previous);
+        tstate->c_profilefunc = func;
+        tstate->c_profileobj = arg;
+    }
+    tstate->use_tracing = (tstate->c_profilefunc != NULL) || (tstate->c_tracefunc != NULL);
+}
+#endif
+
+static int coldshot_set_all(Py_tracefunc func, PyObject *arg, int trace) {
+    PyThreadState *current = PyThreadState_Get();
+    PyThreadState *tstate = PyInterpreterState_ThreadHead(current->interp);
+    int count = 1;
+#if PY_VERSION_HEX >= 0x030C0000
+    if (trace) {
+        PyEval_SetTraceAllThreads(func, arg);
+    } else {
+        PyEval_SetProfileAllThreads(func, arg);
+    }
+    for (; tstate != NULL; tstate = PyThreadState_Next(tstate)) {
+        if (tstate != current) {
+            count += 1;
+        }
+    }
+#else
+    if (trace) {
+        PyEval_SetTrace(func, arg);
+    } else {
+        PyEval_SetProfile(func, arg);
+    }
+    for (; tstate != NULL; tstate = PyThreadState_Next(tstate)) {
+        if (tstate != current) {
+#if PY_VERSION_HEX < 0x030A0000
+            coldshot_set_tstate(tstate, func, arg, trace);
+            count += 1;
+#else
+            count = -1;
+#endif
+        }
+    }
+#endif
+    return count;
+}
+
+int coldshot_set_profile_all(Py_tracefunc func, PyObject *arg) {
+    return coldshot_set_all(func, arg, 0);
+}
+int coldshot_set_trace_all(Py_tracefunc func, PyObject *arg) {
+    return coldshot_set_all(func, arg, 1);
+}
+int coldshot_unset_profile_all() {
+    return coldshot_set_all(NULL, NULL, 0);
+}
+int coldshot_unset_trace_all() {
+    return coldshot_set_all(NULL, NULL, 1);
+}
+
+/* Bytes currently allocated from the C library's allocator (heap and 
+   mmap-ed blocks), used for memory-allocation events.  Returns -1 if 
+   allocator statistics are not available on this platform.
+*/
+#if defined(__GLIBC__)
+#include <malloc.h>
+#endif
+PY_LONG_LONG coldshot_allocated_bytes(void) {
+#if defined(__GLIBC__) && (__GLIBC__ > 2 || (__GLIBC__ == 2 && __GLIBC_MINOR__ >= 33))
+    struct mallinfo2 info = mallinfo2();
+    return (PY_LONG_LONG)(info.uordblks + info.hblkhd);
+#elif defined(__GLIBC__)
+    struct mallinfo info = mallinfo();
+    return (PY_LONG_LONG)((unsigned int)info.uordblks + (unsigned int)info.hblkhd);
+#else
+    return -1;
+#endif
+}
@@ -1,5 +1,11 @@
 /* Hack to hide Python API versions from the Cython code */
 #include "Python.h"
+#include "frameobject.h"
 
 void coldshot_unset_trace();
 void coldshot_unset_profile();
+int coldshot_set_profile_all(Py_tracefunc func, PyObject *arg);
+int coldshot_set_trace_all(Py_tracefunc func, PyObject *arg);
+int coldshot_unset_profile_all();
+int coldshot_unset_trace_all();
+PY_LONG_LONG coldshot_allocated_bytes(void);
@@ -52,17 +52,79 @@ cdef extern from 'frameobject.h':
         PyThreadState *f_tstate
         PyFrameObject *f_back
         void * f_globals
+        void * f_stacktop
+        int f_lasti
         int f_lineno
 
 # timers, from line_profiler
 cdef extern from "timers.h":
     PY_LONG_LONG hpTimer()
     double hpTimerUnit()
+    PY_LONG_LONG cpuTimer()
+    double cpuTimerUnit()
 
 # pretty much the same code as line-profiler
 cdef extern from 'lowlevel.h':
     void coldshot_unset_trace()
     void coldshot_unset_profile()
+    int coldshot_set_profile_all(Py_tracefunc func, object arg)
+    int coldshot_set_trace_all(Py_tracefunc func, object arg)
+    int coldshot_unset_profile_all()
+    int coldshot_unset_trace_all()
+    PY_LONG_LONG coldshot_allocated_bytes()
+
+# a call on an aggregate-mode shadow stack
+cdef struct shadow_frame:
+    uint32_t function
+    void * totals # (borrowed) Totals for the function
+    uint32_t start # timestamp of the call
+    uint32_t resumed # timestamp the call was (re)started (generators)
+    uint32_t suspended # time the call has spent suspended (generators)
+    uint32_t line_start # timestamp the current line started
+    uint16_t line # current line
+
+cdef class Totals(object):
+    cdef public long calls
+    cdef public PY_LONG_LONG time
+    cdef public PY_LONG_LONG child_time
+    cdef public long first
+    cdef public long last
+    cdef public long exceptions
+    cdef public dict children
+    cdef public dict lines
+
+cdef class ShadowStack(object):
+    cdef public uint16_t thread
+    cdef shadow_frame * frames
+    cdef public long depth
+    cdef long capacity
+    cdef public PY_LONG_LONG first
+    cdef public PY_LONG_LONG last
+    cdef public dict functions
+    cdef public Totals root
+    cdef public dict suspended
+    
+    cdef Totals totals( self, uint32_t function )
+    cdef shadow_frame * push( self, uint32_t function, uint32_t timestamp, uint16_t line ) except NULL
+    cdef pop( self, uint32_t timestamp )
+    cdef record_line( self, shadow_frame * frame, uint32_t timestamp )
+    cdef line( self, uint32_t function, uint32_t timestamp, uint16_t line )
+    cdef suspend( self, uint32_t timestamp )
+    cdef resume( self, uint32_t function, uint32_t timestamp, uint16_t line )
+    cdef record_child( self, uint32_t function, uint32_t delta )
+
+cdef class Aggregator(object):
+    cdef public dict stacks
+    cdef ShadowStack current
+    cdef event( 
+        self, 
+        uint16_t thread, 
+        uint32_t function, 
+        uint32_t timestamp, 
+        PY_LONG_LONG elapsed,
+        uint16_t line, 
+        uint32_t flags,
+    )
 
 cdef class Profiler(object):
     cdef public dict files
@@ -71,19 +133,71 @@ cdef class Profiler(object):
     cdef public IndexWriter index
     cdef public DataWriter calls
     cdef public ThreadExtractor threads
+    cdef public MemoryExtractor memory
+    cdef PY_LONG_LONG last_memory
+    cdef public bint cpu
     
     cdef public PY_LONG_LONG internal_start
     cdef public PY_LONG_LONG internal_discount
     
+    cdef public object directory
+    cdef public long segment_size
+    cdef public long disk_budget
+    cdef public long max_events
+    cdef public long events
+    cdef public Aggregator aggregator
+    cdef public object snapshot_filename
+    cdef public PY_LONG_LONG snapshot_interval
+    cdef public PY_LONG_LONG last_snapshot
+    cdef public long snapshots
+    cdef public long segment
+    cdef public list segments
+    
+    # self-instrumentation counters, see Profiler.stats()
+    cdef PY_LONG_LONG event_counts[8]
+    cdef public long new_functions
+    cdef public long new_files
+    cdef public long new_annotations
+    cdef public PY_LONG_LONG bytes_written
+    cdef public long flushes
+    cdef public long write_errors
+    cdef public long dropped
+    cdef public long pruned
+    cdef public bint instrument
+    cdef public PY_LONG_LONG callback_time
+    cdef public PY_LONG_LONG registration_time
+    cdef public PY_LONG_LONG flush_time
+    
     cdef uint32_t RETURN_FLAGS 
     cdef uint32_t CALL_FLAGS 
     cdef uint32_t LINE_FLAGS
     cdef uint32_t ANNOTATION_FLAGS
+    cdef uint32_t COUNTER_FLAGS
+    cdef uint32_t EXCEPTION_FLAGS
+    cdef uint32_t YIELD_FLAGS
+    cdef uint32_t RESUME_FLAGS
     
-    cdef bint active
+    cdef public bint active
+    cdef public bint closed
     cdef bint lines
     cdef bint internal
+    cdef public bint all_threads
+    cdef public bint per_thread
+    cdef public uint16_t current_thread
+    cdef public dict writers
     
+    cdef rotate( self )
+    cdef DataWriter thread_writer( self, uint16_t thread )
+    cdef write_counter( self, uint16_t thread, uint16_t kind, PY_LONG_LONG value )
+    cdef install( self )
+    cdef write_event( 
+        self, 
+        uint16_t thread, 
+        uint32_t function, 
+        uint32_t timestamp, 
+        uint16_t line, 
+        uint32_t flags,
+    )
     cdef uint32_t file_to_number( self, PyCodeObject code )
     cdef uint32_t annotation_to_number( self, object key )
     cdef uint16_t thread_id( self, PyFrameObject frame )
@@ -92,19 +206,29 @@ cdef class Profiler(object):
     cdef write_call( self, PyFrameObject frame )
     cdef write_c_call( self, PyFrameObject frame, PyCFunctionObject * func )
     cdef write_return( self, PyFrameObject frame )
+    cdef write_frame_event( self, PyFrameObject frame, uint32_t flags )
+    cdef write_exception( self, PyFrameObject frame, uint32_t function )
     cdef write_line( self, PyFrameObject frame )
     cdef public uint32_t timestamp( self )
+    cdef PY_LONG_LONG elapsed( self )
 
 cdef class Extractor( object ):
-    cdef dict members 
+    cdef public dict members 
     cdef long new_id( self, object key )
 
 cdef class ThreadExtractor( Extractor ):
     cdef uint16_t extract( self, PyFrameObject frame, Profiler profiler )
 
+cdef class MemoryExtractor( Extractor ):
+    cdef PY_LONG_LONG extract( self )
+
+cdef class TracemallocExtractor( MemoryExtractor ):
+    cdef object get_traced_memory
+
 cdef class DataWriter(object):
     cdef bint opened
-    cdef bytes filename
+    cdef public bytes filename
+    cdef public long bytes_written
     cdef FILE * fd 
     cdef _close( self )
     cdef FILE * open_file( self, bytes filename )
@@ -120,4 +244,6 @@ cdef class DataWriter(object):
 cdef class IndexWriter(object):
     cdef object fh
     cdef bint should_close # note: means "we should close it", not "has been opened"
+    cdef bint closed
+    cdef object lock
 
@@ -1,22 +1,58 @@
 """Coldshot Profiler implementation
 """
 from cpython cimport PY_LONG_LONG
-import os, weakref, sys, logging
-try:
-    from urllib import parse as urllib
-except ImportError as error:
-    import urllib
+from cpython.ref cimport PyObject
+from cpython.dict cimport PyDict_GetItem
+from libc.stdlib cimport malloc, realloc, free
+import os, weakref, sys, logging, time, threading
+if sys.version_info[0] >= 3:
+    from urllib.parse import quote
+else:
+    # Python 2's urllib imports socket and ssl, which would dominate the 
+    # time taken to import the profiler, this is urllib.quote( value, '/' )
+    _SAFE = (
+        'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_.-/'
+    )
+    _QUOTED = dict([
+        (chr(i), chr(i) if chr(i) in _SAFE else '%%%02X'%( i, ))
+        for i in range( 256 )
+    ])
+    def quote( value ):
+        """Quote an 8-bit string as urllib.quote does (for the index)"""
+        return ''.join( map( _QUOTED.__getitem__, value ))
 from coldshot cimport *
 log = logging.getLogger( __name__ )
 
 CALL_INFO_SIZE = sizeof( event_info )
 TIMER_UNIT = hpTimerUnit()
+CPU_TIMER_UNIT = cpuTimerUnit()
+
+# kinds of counter records (stored in the line field of a counter event)
+COUNTER_MEMORY = 0
+COUNTER_CPU = 1
+
+# caller of top-level calls in aggregate mode (the Loader's root function)
+DEF ROOT = 0xffffffff
+ROOT_FUNCTION = ROOT
+
+# event types, indexed by the event's flags (see Profiler.stats)
+EVENT_TYPES = (
+    'line','call','return','annotation','counter','exception','yield','resume',
+)
     
 __all__ = [
     'timer',
     'Profiler',
     'Extractor',
     'ThreadExtractor',
+    'MemoryExtractor',
+    'TracemallocExtractor',
+    'memory_extractor',
+    'EVENT_TYPES',
+    'ROOT_FUNCTION',
+    'Aggregator',
+    'ShadowStack',
+    'Totals',
     'DataWriter',
     'IndexWriter',
 ]
@@ -33,6 +69,7 @@ cdef class DataWriter(object):
         self.filename = filename 
         self.fd = self.open_file( self.filename )
         self.opened = True
+        self.bytes_written = 0
     def flush( self ):
         """Flush our file descriptor's buffers"""
         if self.opened:
@@ -58,17 +95,27 @@ cdef class DataWriter(object):
             raise IOError( "Unable to open output file: %s", filename )
         return fd
     cdef ssize_t write_void( self, void * data, ssize_t size ):
-        """Write size bytes from data into our file"""
+        """Write size bytes from data into our file
+        
+        returns number of items written, 0 if the write failed (or we are 
+        closed), errors are counted by the Profiler rather than raised from 
+        within the profiling callbacks
+        """
         cdef ssize_t written
         if not self.opened:
-            raise IOError( """Attempt to write to un-opened (or closed) file %s"""%( self.filename, ))
+            return 0
         written = fwrite( data, size, 1, self.fd )
-        if written != 1:
-            raise IOError( """Unable to write to file: %s"""%( self.filename, ))
+        if written == 1:
+            self.bytes_written += size
         return written
     def write( self, thread, function, timestamp, line, flags ):
         """Write a record to the file (for testing)"""
-        return self.write_callinfo( thread, function, timestamp, line, flags )
+        if not self.opened:
+            raise IOError( """Attempt to write to un-opened (or closed) file %s"""%( self.filename, ))
+        written = self.write_callinfo( thread, function, timestamp, line, flags )
+        if written != 1:
+            raise IOError( """Unable to write to file: %s"""%( self.filename, ))
+        return written
     cdef ssize_t write_callinfo( 
         self, 
         uint16_t thread, 
@@ -84,7 +131,7 @@ cdef class DataWriter(object):
             uint32_t function # high byte is flags...
             uint32_t timestamp # 1/10**6 seconds
         
-        returns number of records written (should always be 1)
+        returns number of records written (1, or 0 on failure)
         """
         cdef event_info local 
         cdef ssize_t written
@@ -103,11 +150,12 @@ cdef class IndexWriter(object):
     
     Record types written:
     
-        P COLDSHOTBinary v<version> byteswap=<boolean>
+        P COLDSHOTBinary version=<version> bigendian=<boolean> timer_unit=<float> cpu_timer_unit=<float>
         
-            Prefix record, declares version, byteswap=True means the file 
-            was written on a big-endian machine (currently ignored, which 
-            means profiles are not portable across architectures)
+            Prefix record, declares version and timer units, bigendian=True 
+            means the data-files were written on a big-endian machine (they 
+            are in the writer's native byte-order), loaders on machines of 
+            the other byte-order convert the data-files when mapping them
         
         D calls <filename>
         
@@ -125,6 +173,11 @@ cdef class IndexWriter(object):
         
             Declares a function number, builtin functions will always have 
             fileno:lineno of 0:0
+        
+        S <name> <value>
+        
+            Profiler self-instrumentation counter (see Profiler.stats), 
+            written on each stop, the last value for a name is current
     
     Formatting:
     
@@ -144,47 +197,72 @@ cdef class IndexWriter(object):
         else:
             self.fh = file 
             self.should_close = False
+        # writes release the GIL, other (profiled) threads may be writing 
+        # declarations while we are closed
+        self.lock = threading.Lock()
+    def write( self, message ):
+        """Write a (text) record, ignored once we have been closed"""
+        with self.lock:
+            if not self.closed:
+                self.fh.write( message.encode('utf-8') )
     def prefix( self, version=1 ):
         """Write our version prefix to the data-file"""
-        message = 'P COLDSHOTBinary version=%d bigendian=%s timer_unit=%f\n'%( 
+        message = 'P COLDSHOTBinary version=%d bigendian=%s timer_unit=%f cpu_timer_unit=%r\n'%( 
             version, sys.byteorder=='big', 
-            TIMER_UNIT 
+            TIMER_UNIT, CPU_TIMER_UNIT,
         )
-        self.fh.write( message.encode('utf-8') )
+        self.write( message )
     def write_datafile( self, datafile, type='calls' ):
         """Record the presence of a data-file to be parsed"""
-        datafile = urllib.quote( datafile )
+        datafile = quote( datafile )
         message = 'D %(type)s %(datafile)s\n'%locals()
-        self.fh.write( message.encode('utf-8') )
+        self.write( message )
     def write_file( self, fileno, filename ):
         """Record presence of a source file and its identifier"""
-        message = 'F %d %s\n'%( fileno, urllib.quote( filename ))
-        self.fh.write( message.encode('utf-8') )
+        message = 'F %d %s\n'%( fileno, quote( filename ))
+        self.write( message )
     def write_func( self, funcno, fileno, lineno, bytes module, bytes name ):
         """Record presence of function and function id into the index"""
-        name = urllib.quote( name )
-        module = urllib.quote( module )
+        name = quote( name )
+        module = quote( module )
         message = 'f %(funcno)d %(fileno)d %(lineno)d %(module)s %(name)s\n'%locals()
-        self.fh.write( message.encode('utf-8') )
+        self.write( message )
     def write_annotation( self, funcno, description ):
         if isinstance( description, unicode ):
             description = description.encode( 'utf-8' )
         if not isinstance( description, str ):
             description = str( description )
-        description = urllib.quote( description )
+        description = quote( description )
         message = 'A %(funcno)d %(description)s\n'%locals()
-        self.fh.write( message.encode('utf-8') )
+        self.write( message )
+    def write_stats( self, stats ):
+        """Record the profiler's (self-instrumentation) counters"""
+        message = ''.join([
+            'S %s %s\n'%( 
+                quote( name ), 
+                repr( value ) if isinstance( value, float ) else '%d'%( value, ),
+            )
+            for name,value in sorted( stats.items() )
+        ])
+        self.write( message )
     def flush( self ):
         """Flush our buffer"""
-        self.fh.flush()
+        with self.lock:
+            if not self.closed:
+                self.fh.flush()
     def close( self ):
         """Close our file"""
-        if self.should_close:
-            self.should_close = False
-            self.fh.close()
+        with self.lock:
+            self.closed = True
+            if self.should_close:
+                self.should_close = False
+                self.fh.close()
 
 cdef class Extractor( object ):
-    """Extractors are objects which are used to extract data-points at run-time"""
+    """Extractors are objects which are used to extract data-points at run-time
+    
+    members -- key:id mapping of the ids allocated by new_id
+    """
     def __cinit__( self ):
         self.members = {}
     cdef long new_id( self, object key ):
@@ -211,6 +289,374 @@ cdef class ThreadExtractor( Extractor ):
         """
         return self.new_id( <long>(frame.f_tstate.thread_id) )
 
+cdef class MemoryExtractor( Extractor ):
+    """Extracts the number of bytes currently allocated by the process
+    
+    The default implementation uses the C library's allocator statistics 
+    (mallinfo on glibc), which see Python's small-object arenas being 
+    allocated/released rather than individual objects.  The figure is 
+    process-wide, not per-thread.
+    """
+    cdef PY_LONG_LONG extract( self ):
+        """Return the currently allocated bytes"""
+        return coldshot_allocated_bytes()
+
+cdef class TracemallocExtractor( MemoryExtractor ):
+    """Uses tracemalloc's traced memory (Python 3.4+, tracemalloc must be tracing)"""
+    def __cinit__( self ):
+        import tracemalloc
+        self.get_traced_memory = tracemalloc.get_traced_memory
+    cdef PY_LONG_LONG extract( self ):
+        return self.get_traced_memory()[0]
+
+def memory_extractor():
+    """Create the most precise MemoryExtractor available"""
+    try:
+        import tracemalloc
+    except ImportError as err:
+        return MemoryExtractor()
+    if tracemalloc.is_tracing():
+        return TracemallocExtractor()
+    return MemoryExtractor()
+
+cdef class Totals(object):
+    """Call and time (timer unit) totals for a function or line in aggregate mode
+    
+    children -- callee: time spent in callee when called by this function
+    lines -- line: Totals for each line of the function
+    """
+    def __repr__( self ):
+        return '<%s %s calls %s/%s>'%(
+            self.__class__.__name__, self.calls, self.time, self.child_time,
+        )
+
+cdef class ShadowStack(object):
+    """Stack of a thread's calls in progress, for aggregate mode
+
+    Rather than writing events, each return adds the call's time into
+    in-memory tables (times in timer units):
+
+        functions -- function: Totals for the finished calls (with their
+            callees and lines)
+
+        root -- Totals for ROOT_FUNCTION, i.e. the caller of top-level calls
+
+        suspended -- function: [(function,start,suspended,line_start,line,
+            suspend_start),...] for generator calls which have yielded
+
+        first, last -- 64-bit times (timer units since the profiler started) 
+            of the thread's first and latest events, which do not wrap as 
+            the 32-bit event timestamps do
+
+    Times are calculated as the Loader's Stack does, so the totals match
+    those from loading an event trace of the same run.
+    """
+    def __cinit__( self, uint16_t thread, PY_LONG_LONG elapsed ):
+        self.root = Totals()
+        self.root.children = {}
+        self.root.lines = {}
+        self.thread = thread
+        self.capacity = 64
+        self.frames = <shadow_frame *>malloc( self.capacity * sizeof( shadow_frame ))
+        if self.frames == NULL:
+            raise MemoryError( 'Unable to allocate shadow stack' )
+        self.depth = 0
+        self.first = self.last = elapsed
+        self.functions = {}
+        self.suspended = {}
+    def __dealloc__( self ):
+        if self.frames != NULL:
+            free( self.frames )
+            self.frames = NULL
+
+    cdef Totals totals( self, uint32_t function ):
+        """Retrieve (creating if necessary) the Totals for function"""
+        cdef Totals totals
+        cdef PyObject * existing = PyDict_GetItem( self.functions, function )
+        if existing != NULL:
+            return <Totals>existing
+        self.functions[function] = totals = Totals()
+        totals.children = {}
+        totals.lines = {}
+        return totals
+    cdef shadow_frame * push( self, uint32_t function, uint32_t timestamp, uint16_t line ) except NULL:
+        """Push a new call onto the stack"""
+        cdef shadow_frame * frames
+        cdef shadow_frame * frame
+        cdef Totals totals = self.totals( function )
+        if self.depth >= self.capacity:
+            frames = <shadow_frame *>realloc(
+                self.frames, 2 * self.capacity * sizeof( shadow_frame )
+            )
+            if frames == NULL:
+                raise MemoryError( 'Unable to grow shadow stack' )
+            self.frames = frames
+            self.capacity *= 2
+        frame = &self.frames[self.depth]
+        self.depth += 1
+        frame.function = function
+        # borrowed, Totals are never removed from self.functions
+        frame.totals = <void *>totals
+        frame.start = timestamp
+        frame.resumed = timestamp
+        frame.line_start = timestamp
+        frame.suspended = 0
+        frame.line = line
+        return frame
+    cdef pop( self, uint32_t timestamp ):
+        """Finish the call on the top of the stack"""
+        cdef shadow_frame * frame
+        cdef Totals totals
+        cdef uint32_t function
+        cdef uint32_t segment
+        if not self.depth:
+            # return from a call which began before we started
+            return
+        frame = &self.frames[self.depth-1]
+        self.record_line( frame, timestamp )
+        function = frame.function
+        segment = timestamp - frame.resumed
+        totals = <Totals>frame.totals
+        totals.calls += 1
+        if not totals.first:
+            totals.first = frame.start
+        totals.last = frame.start
+        totals.time += <uint32_t>(timestamp - frame.start - frame.suspended)
+        self.depth -= 1
+        self.record_child( function, segment )
+    cdef record_child( self, uint32_t function, uint32_t delta ):
+        """Attribute delta spent in function to the call now on top of the stack"""
+        cdef uint32_t caller = ROOT
+        cdef Totals totals = self.root
+        cdef PyObject * previous
+        if self.depth:
+            caller = self.frames[self.depth-1].function
+            totals = <Totals>self.frames[self.depth-1].totals
+        previous = PyDict_GetItem( totals.children, function )
+        if previous != NULL:
+            totals.children[function] = <object>previous + delta
+        else:
+            totals.children[function] = delta
+        if caller != function:
+            totals.child_time += delta
+    cdef record_line( self, shadow_frame * frame, uint32_t timestamp ):
+        """Finish the frame's current line"""
+        cdef dict lines = (<Totals>frame.totals).lines
+        cdef Totals totals
+        cdef PyObject * existing = PyDict_GetItem( lines, frame.line )
+        if existing != NULL:
+            totals = <Totals>existing
+        else:
+            lines[frame.line] = totals = Totals()
+        totals.calls += 1
+        totals.time += <uint32_t>(timestamp - frame.line_start)
+        frame.line_start = timestamp
+    cdef line( self, uint32_t function, uint32_t timestamp, uint16_t line ):
+        """Record a line event for the call on top of the stack"""
+        cdef shadow_frame * frame
+        if not self.depth:
+            return
+        frame = &self.frames[self.depth-1]
+        if frame.function == function:
+            self.record_line( frame, timestamp )
+            frame.line = line
+    cdef suspend( self, uint32_t timestamp ):
+        """Suspend the (generator) call on top of the stack"""
+        cdef shadow_frame * frame
+        cdef uint32_t function
+        cdef uint32_t segment
+        if not self.depth:
+            return
+        frame = &self.frames[self.depth-1]
+        function = frame.function
+        segment = timestamp - frame.resumed
+        self.suspended.setdefault( function, [] ).append( (
+            function, frame.start, frame.suspended,
+            frame.line_start, frame.line, timestamp,
+        ))
+        self.depth -= 1
+        self.record_child( function, segment )
+    cdef resume( self, uint32_t function, uint32_t timestamp, uint16_t line ):
+        """Resume the most recently suspended call of function"""
+        cdef shadow_frame * frame
+        cdef uint32_t gap
+        cdef uint32_t start
+        cdef uint32_t previous
+        cdef uint32_t line_start
+        cdef uint32_t suspend_start
+        cdef list suspended = self.suspended.get( function )
+        if not suspended:
+            # generator which started before we did
+            self.push( function, timestamp, line )
+            return
+        _,start,previous,line_start,line,suspend_start = suspended.pop()
+        gap = timestamp - suspend_start
+        frame = self.push( function, start, line )
+        frame.suspended = previous + gap
+        frame.line_start = line_start + gap
+        frame.resumed = timestamp
+
+    def finished( self ):
+        """Function totals including still-suspended generator calls
+
+        Suspended calls are counted as finishing when they last yielded, as
+        the Loader does at the end of a trace.
+
+        returns function: [calls,time,child_time,first,last,exceptions]
+        """
+        cdef Totals totals
+        result = {}
+        for function,totals in self.functions.items():
+            if not (totals.calls or totals.child_time or totals.exceptions):
+                # only (still) on the stack
+                continue
+            result[function] = [
+                totals.calls, totals.time, totals.child_time,
+                totals.first, totals.last, totals.exceptions,
+            ]
+        if self.root.child_time:
+            result[ROOT] = [0,0,self.root.child_time,0,0,0]
+        for calls in self.suspended.values():
+            for function,start,previous,line_start,line,suspend_start in calls:
+                record = result.setdefault( function, [0,0,0,0,0,0] )
+                record[0] += 1
+                record[1] += <uint32_t>(suspend_start - start - previous)
+                if not record[3] or start < record[3]:
+                    record[3] = start
+                record[4] = max( record[4], start )
+        return result
+
+cdef class Aggregator(object):
+    """Accumulates function, caller/callee and line totals in memory (aggregate mode)
+
+    stacks -- thread: ShadowStack
+
+    Annotation and counter (memory/CPU) events are not aggregated.
+    """
+    def __cinit__( self ):
+        self.stacks = {}
+        self.current = None
+    cdef event(
+        self,
+        uint16_t thread,
+        uint32_t function,
+        uint32_t timestamp,
+        PY_LONG_LONG elapsed,
+        uint16_t line,
+        uint32_t flags,
+    ):
+        """Process an event (flags as written by the Profiler)
+        
+        elapsed -- the 64-bit time of the event (timestamp is its low 32 bits)
+        """
+        cdef ShadowStack stack = self.current
+        cdef Totals totals
+        if stack is None or stack.thread != thread:
+            stack = self.stacks.get( thread )
+            if stack is None:
+                stack = ShadowStack( thread, elapsed )
+                self.stacks[thread] = stack
+            self.current = stack
+        stack.last = elapsed
+        flags = flags >> 24
+        if flags == 1: # call
+            stack.push( function, timestamp, line )
+        elif flags == 2: # return
+            stack.pop( timestamp )
+        elif flags == 0: # line
+            stack.line( function, timestamp, line )
+        elif flags == 5: # exception
+            totals = stack.totals( function )
+            totals.exceptions += 1
+        elif flags == 6: # yield
+            stack.suspend( timestamp )
+        elif flags == 7: # resume
+            stack.resume( function, timestamp, line )
+
+    def save( self, filename ):
+        """Write our totals as a snapshot (aggregates format) to filename
+
+        Records are those of :py:mod:`coldshot.aggregates` (T, X, C and L,
+        summed over all threads) followed by per-thread records:
+
+            R <thread> <first_timestamp> <last_timestamp>
+            t <thread> <funcno> <calls> <time> <child_time>
+
+        Only finished (or suspended) calls are included.  The root's time and
+        the R records use 64-bit times, so they stay correct once the 32-bit
+        timestamps have wrapped.  The file is replaced with a rename, so 
+        readers never see a partial snapshot.
+        """
+        cdef ShadowStack stack
+        cdef Totals totals
+        functions = {}
+        edges = {}
+        lines = {}
+        threads = []
+        first = last = None
+        for thread,stack in sorted( self.stacks.items() ):
+            finished = stack.finished()
+            threads.append( (stack,finished) )
+            for function,record in finished.items():
+                total = functions.setdefault( function, [0,0,0,0,0,0] )
+                total[0] += record[0]
+                total[1] += record[1]
+                total[2] += record[2]
+                if record[3] and (not total[3] or record[3] < total[3]):
+                    total[3] = record[3]
+                total[4] = max( total[4], record[4] )
+                total[5] += record[5]
+            tables = list( stack.functions.items() )
+            tables.append( (ROOT_FUNCTION,stack.root) )
+            for function,totals in tables:
+                for callee,delta in totals.children.items():
+                    key = (function,callee)
+                    edges[key] = edges.get( key, 0 ) + delta
+                for line,line_totals in totals.lines.items():
+                    total = lines.setdefault( (function,line), [0,0] )
+                    total[0] += (<Totals>line_totals).calls
+                    total[1] += (<Totals>line_totals).time
+            if first is None or stack.first < first:
+                first = stack.first
+            if last is None or stack.last > last:
+                last = stack.last
+        root = functions.setdefault( ROOT_FUNCTION, [0,0,0,0,0,0] )
+        if first is not None:
+            root[0] = 1
+            root[1] = last - first
+            # the other T records hold 32-bit timestamps
+            root[3] = first & 0xffffffff
+            root[4] = last & 0xffffffff
+        children = {}
+        for (caller,callee),delta in edges.items():
+            children.setdefault( caller, [] ).append( (callee,delta) )
+        function_lines = {}
+        for (function,line),total in lines.items():
+            function_lines.setdefault( function, [] ).append( (line,total) )
+
+        temporary = filename + b'.tmp'
+        with open( temporary, 'w' ) as fh:
+            for key,record in sorted( functions.items() ):
+                fh.write( 'T %d %d %d %d %d %d\n'%(
+                    key, record[0], record[1], record[2], record[3], record[4],
+                ))
+                if record[5]:
+                    fh.write( 'X %d %d\n'%( key, record[5] ))
+                for child,delta in sorted( children.get( key, ())):
+                    fh.write( 'C %d %d %d\n'%( key, child, delta ))
+                for line,(calls,time) in sorted( function_lines.get( key, ())):
+                    fh.write( 'L %d %d %d %d\n'%( key, line, calls, time ))
+            for stack,finished in threads:
+                fh.write( 'R %d %d %d\n'%( stack.thread, stack.first, stack.last ))
+                for key,record in sorted( finished.items() ):
+                    fh.write( 't %d %d %d %d %d\n'%(
+                        stack.thread, key, record[0], record[1], record[2],
+                    ))
+        if os.name == 'nt' and os.path.exists( filename ):
+            os.remove( filename )
+        os.rename( temporary, filename )
+        return filename
+
 cdef class Profiler(object):
     """Coldshot Profiler implementation 
     
@@ -221,14 +667,76 @@ cdef class Profiler(object):
     """
     INDEX_FILENAME = b'index.coldshot'
     CALLS_FILENAME = b'coldshot.data'
+    SEGMENT_FORMAT = 'coldshot-%Y%m%d-%H%M%S-{segment:04d}.data'
+    THREAD_FORMAT = 'coldshot-thread-{thread:04d}.data'
+    SNAPSHOT_FILENAME = b'snapshot.coldshot'
     
-    def __init__( self, dirname, lines=True, version=1, thread_extractor=None ):
+    def __init__( 
+        self, dirname, lines=True, version=1, thread_extractor=None,
+        segment_size=None, disk_budget=None, max_events=None,
+        all_threads=False, per_thread=False, memory=None, cpu=False,
+        aggregate=False, snapshot_interval=None, instrument=False,
+    ):
         """Initialize the profiler (and open all files)
         
         dirname -- directory in which to record profiles 
         
         lines -- if True, write line traces (default is True)
         
+        segment_size -- if provided, write events into a series of 
+            time-stamped data-files (segments), starting a new segment when 
+            the current one reaches segment_size bytes
+        
+        disk_budget -- if provided (along with segment_size), delete the 
+            oldest segments when the segments use more than disk_budget bytes,
+            loaders will then only see the most recent events
+        
+        max_events -- if provided, stop profiling after writing this many 
+            events
+        
+        all_threads -- if True, profile every thread in the interpreter, 
+            i.e. threads which were running before :py:meth:`start` as well 
+            as threads started while we are active, rather than just the 
+            thread which calls :py:meth:`start` (on Python 3.10 and 3.11 
+            already-running threads cannot be hooked, a warning is logged)
+        
+        per_thread -- if True, write each thread's events into its own 
+            data-file (declared in the index as separate calls files), so 
+            that threads do not share a write buffer and loaders see each 
+            thread's events without interleaving
+        
+        memory -- if provided, record memory allocation events, either True 
+            (use :py:func:`memory_extractor`) or a MemoryExtractor instance, 
+            before each call, return, yield and resume event we record the 
+            change in allocated bytes since the previous sample (if any), 
+            per-line figures are charged to the line running when the 
+            sample is taken
+            
+            Extractors measure the whole process, so with all_threads the 
+            change is charged to the thread which happens to take the next 
+            sample (including memory allocated by other threads since then)
+        
+        cpu -- if True, record the thread's CPU time (in addition to the 
+            wall-clock time) for each call and return, so that loaders can 
+            separate time spent computing from time spent waiting (e.g. 
+            blocked in system calls or on the GIL)
+        
+        aggregate -- if True, do not write events at all, instead keep 
+            per-thread shadow stacks in memory and accumulate the function, 
+            caller/callee and line totals, writing them to a snapshot file 
+            (in the format of :py:mod:`coldshot.aggregates`) which the 
+            Loader reads, disk use is then constant however long we run, 
+            but individual calls, annotations, memory and CPU events are 
+            not available
+        
+        snapshot_interval -- if provided (with aggregate), seconds between 
+            snapshots while running, otherwise the snapshot is written 
+            when we stop
+        
+        instrument -- if True, measure the time spent in the callbacks for 
+            :py:meth:`stats` (callback_seconds), which costs an extra timer 
+            read for every event
+        
         thread_extractor -- if provided, thread extractor for all events 
         
             This object must be an instance of ThreadExtractor, and should 
@@ -244,15 +752,45 @@ cdef class Profiler(object):
         
         version -- file-format version to write
         """
+        if aggregate and (memory or cpu):
+            raise ValueError( 'Memory and CPU events cannot be aggregated' )
         if not os.path.exists( dirname ):
             os.makedirs( dirname )
+        self.directory = dirname
+        self.segment_size = segment_size or 0
+        self.disk_budget = disk_budget or 0
+        self.max_events = max_events or 0
+        self.events = 0
+        self.segment = 0
+        self.segments = []
+        self.all_threads = all_threads
+        self.per_thread = per_thread
+        self.instrument = instrument
+        self.current_thread = 0
+        self.writers = {}
+        
         index_filename = os.path.join( dirname, self.INDEX_FILENAME )
         self.index = IndexWriter( index_filename )
-        calls_filename = os.path.join( dirname, self.CALLS_FILENAME )
-        self.calls = DataWriter( calls_filename )
-        
         self.index.prefix(version=version)
-        self.index.write_datafile( calls_filename, 'calls' )
+        if aggregate:
+            self.aggregator = Aggregator()
+            self.snapshot_filename = os.path.join( dirname, self.SNAPSHOT_FILENAME )
+            self.snapshot_interval = <PY_LONG_LONG>(
+                (snapshot_interval or 0) / TIMER_UNIT
+            )
+            self.index.write_datafile( self.snapshot_filename, 'aggregate' )
+            self.calls = None
+        elif self.per_thread:
+            # created on the first event of each thread
+            self.calls = None
+        else:
+            if self.segment_size:
+                calls_filename = self.segment_filename()
+            else:
+                calls_filename = os.path.join( dirname, self.CALLS_FILENAME )
+            self.calls = DataWriter( calls_filename )
+            self.index.write_datafile( calls_filename, 'calls' )
+            self.writers[0] = self.calls
         
         self.lines = lines
         
@@ -262,6 +800,11 @@ cdef class Profiler(object):
             self.threads = thread_extractor
         else:
             self.threads = ThreadExtractor()
+        if memory is True:
+            memory = memory_extractor()
+        self.memory = memory or None
+        self.last_memory = 0
+        self.cpu = cpu
         self.active = False
         self.internal = False
         self.internal_start = 0
@@ -270,7 +813,140 @@ cdef class Profiler(object):
         self.CALL_FLAGS = 1 << 24
         self.RETURN_FLAGS = 2 << 24
         self.ANNOTATION_FLAGS = 3 << 24
+        self.COUNTER_FLAGS = 4 << 24
+        self.EXCEPTION_FLAGS = 5 << 24
+        self.YIELD_FLAGS = 6 << 24
+        self.RESUME_FLAGS = 7 << 24
+        
+    def segment_filename( self ):
+        """Produce the (time-stamped) filename for our next data-file segment"""
+        self.segment += 1
+        filename = time.strftime( self.SEGMENT_FORMAT ).format( segment=self.segment )
+        return os.path.join( self.directory, filename )
+    cdef DataWriter thread_writer( self, uint16_t thread ):
+        """Retrieve (or create) the data-file writer for the given thread"""
+        cdef DataWriter writer = self.writers.get( thread )
+        if writer is None:
+            if self.segment_size:
+                calls_filename = self.segment_filename()
+            else:
+                calls_filename = os.path.join( 
+                    self.directory, self.THREAD_FORMAT.format( thread=thread ),
+                )
+            writer = DataWriter( calls_filename )
+            self.index.write_datafile( calls_filename, 'calls' )
+            self.index.flush()
+            self.writers[thread] = writer
+        return writer
+    cdef rotate( self ):
+        """Close the current data-file segment and start writing a new one"""
+        cdef DataWriter previous = self.calls
+        calls_filename = self.segment_filename()
+        self.calls = DataWriter( calls_filename )
+        self.writers[self.current_thread] = self.calls
+        self.index.write_datafile( calls_filename, 'calls' )
+        self.index.flush()
+        previous.close()
+        self.segments.append( (previous.filename,previous.bytes_written) )
+        if self.disk_budget:
+            self.prune()
+    def prune( self ):
+        """Delete our oldest (closed) segments until we are within our disk budget"""
+        total = sum([ size for (filename,size) in self.segments ], 0)
+        total += sum([ writer.bytes_written for writer in self.writers.values() ], 0)
+        while self.segments and total > self.disk_budget:
+            filename,size = self.segments.pop(0)
+            try:
+                os.remove( filename )
+            except OSError as err:
+                log.warn( 'Unable to prune segment %s: %s', filename, err )
+            else:
+                self.pruned += 1
+            total -= size
+    cdef write_event( 
+        self, 
+        uint16_t thread, 
+        uint32_t function, 
+        uint32_t timestamp, 
+        uint16_t line, 
+        uint32_t flags,
+    ):
+        """Write an event record, rotating segments and enforcing max_events"""
+        cdef PY_LONG_LONG memory
+        cdef PY_LONG_LONG cpu
+        cdef PY_LONG_LONG elapsed
+        if self.closed:
+            # late callback from another thread
+            self.dropped += 1
+            return
+        if self.aggregator is not None:
+            # extend the (wrapping) timestamp to 64 bits
+            elapsed = self.elapsed()
+            elapsed -= <uint32_t>(<uint32_t>elapsed - timestamp)
+            self.aggregator.event( thread, function, timestamp, elapsed, line, flags )
+            self.events += 1
+            self.event_counts[(flags >> 24) & 7] += 1
+            if self.snapshot_interval and (
+                elapsed - self.last_snapshot >= self.snapshot_interval
+            ):
+                self.snapshot()
+            if self.max_events and self.events >= self.max_events:
+                self.stop()
+            if self.instrument:
+                self.callback_time += <uint32_t>(self.timestamp() - timestamp)
+            return
+        if self.per_thread and (self.calls is None or thread != self.current_thread):
+            self.calls = self.thread_writer( thread )
+            self.current_thread = thread
+        if (
+            flags == self.CALL_FLAGS or flags == self.RETURN_FLAGS or 
+            flags == self.YIELD_FLAGS or flags == self.RESUME_FLAGS
+        ):
+            # counters are sampled at call boundaries only (not per line)
+            if self.memory is not None:
+                memory = self.memory.extract()
+                if memory != self.last_memory:
+                    self.write_counter( thread, COUNTER_MEMORY, memory - self.last_memory )
+                    self.last_memory = memory
+            if self.cpu:
+                cpu = cpuTimer()
+                if cpu >= 0:
+                    self.write_counter( thread, COUNTER_CPU, cpu )
+        if self.calls.write_callinfo( thread, function, timestamp, line, flags ) != 1:
+            self.write_errors += 1
+            self.dropped += 1
+            return
+        self.events += 1
+        self.event_counts[(flags >> 24) & 7] += 1
+        self.bytes_written += sizeof( event_info )
+        if self.segment_size and self.calls.bytes_written >= self.segment_size:
+            self.rotate()
+        if self.max_events and self.events >= self.max_events:
+            self.stop()
+        if self.instrument:
+            # timestamp was taken on entry to the callback
+            self.callback_time += <uint32_t>(self.timestamp() - timestamp)
+    
+    cdef write_counter( self, uint16_t thread, uint16_t kind, PY_LONG_LONG value ):
+        """Write a counter record, which applies to the thread's next event
         
+        The (signed) value is stored in 56 bits, the high 24 in the function 
+        field and the low 32 in the timestamp field, kind in the line field.
+        """
+        cdef unsigned long long raw = (<unsigned long long>value) & 0x00ffffffffffffffULL
+        if self.calls.write_callinfo( 
+            thread, 
+            <uint32_t>(raw >> 32), 
+            <uint32_t>(raw & 0xffffffffULL), 
+            kind, 
+            self.COUNTER_FLAGS,
+        ) != 1:
+            self.write_errors += 1
+            self.dropped += 1
+            return
+        self.event_counts[4] += 1
+        self.bytes_written += sizeof( event_info )
+    
     cdef uint32_t file_to_number( self, PyCodeObject code ):
         """Convert a code reference to a file number"""
         cdef uint32_t count
@@ -280,6 +956,7 @@ cdef class Profiler(object):
         if count_obj is None:
             count = len( self.files ) + 1
             self.files[filename] = count
+            self.new_files += 1
             self.index.write_file( count, os.path.abspath( filename ) )
         else:
             count = <long>count_obj
@@ -293,6 +970,7 @@ cdef class Profiler(object):
         if count_obj is None:
             count = <uint32_t>(len(self.functions)+1)
             self.functions[key] = count
+            self.new_annotations += 1
             self.index.write_annotation( count, key )
         return count
     
@@ -311,8 +989,10 @@ cdef class Profiler(object):
         cdef int fileno
         # Key is the "id" of the code...
         key = <ssize_t>frame.f_code
+        cdef PY_LONG_LONG start
         count_obj = self.functions.get( key )
         if count_obj is None:
+            start = hpTimer()
             fileno = self.file_to_number( code )
             try:
                 module = (<object>frame.f_globals)['__name__']
@@ -322,7 +1002,9 @@ cdef class Profiler(object):
             name = <bytes>(code.co_name)
             count = <uint32_t>(len(self.functions)+1)
             self.functions[key] = count
+            self.new_functions += 1
             self.index.write_func( count, fileno, code.co_firstlineno, module, name)
+            self.registration_time += hpTimer() - start
         else:
             count = <long>count_obj
         return <uint32_t>count
@@ -337,14 +1019,18 @@ cdef class Profiler(object):
         cdef object count_obj
         cdef bytes name
         cdef bytes module 
+        cdef PY_LONG_LONG start
         id = <ssize_t>(func.m_ml) # ssize_t?
         count_obj = self.functions.get( id )
         if count_obj is None:
+            start = hpTimer()
             name = builtin_name( func[0] )
             module = module_name( func[0] )
             count = len(self.functions) + 1
             self.functions[id] = count
+            self.new_functions += 1
             self.index.write_func( count, 0, 0, module, name )
+            self.registration_time += hpTimer() - start
         else:
             count = <long>count_obj
         return count
@@ -359,7 +1045,7 @@ cdef class Profiler(object):
             return
         ts = self.timestamp()
         func_number = self.func_to_number( frame )
-        self.calls.write_callinfo( 
+        self.write_event( 
             self.thread_id( frame ), 
             func_number, 
             ts, 
@@ -375,11 +1061,12 @@ cdef class Profiler(object):
             return
         ts = self.timestamp()
         func_number = self.builtin_to_number( func )
-        self.calls.write_callinfo( 
+        self.write_event( 
             self.thread_id( frame ), 
             func_number, 
             ts, 
-            frame.f_lineno,
+            # the aggregator records the line of the called function
+            0 if self.aggregator is not None else frame.f_lineno,
             self.CALL_FLAGS,
         )
         
@@ -388,7 +1075,7 @@ cdef class Profiler(object):
         cdef uint32_t ts = self.timestamp()
         if self.internal:
             return
-        self.calls.write_callinfo( 
+        self.write_event( 
             self.thread_id( frame ), 
             self.func_to_number( frame ), 
             ts,
@@ -396,12 +1083,37 @@ cdef class Profiler(object):
             self.RETURN_FLAGS,
         )
         
+    cdef write_frame_event( self, PyFrameObject frame, uint32_t flags ):
+        """Write a (generator yield/resume) event for the frame into the calls-file"""
+        cdef uint32_t ts = self.timestamp()
+        if self.internal:
+            return
+        self.write_event( 
+            self.thread_id( frame ), 
+            self.func_to_number( frame ), 
+            ts,
+            frame.f_lineno,
+            flags,
+        )
+    cdef write_exception( self, PyFrameObject frame, uint32_t function ):
+        """Write an exception event (function exited by raising) into the calls-file"""
+        cdef uint32_t ts = self.timestamp()
+        if self.internal:
+            return
+        self.write_event( 
+            self.thread_id( frame ), 
+            function,
+            ts,
+            frame.f_lineno,
+            self.EXCEPTION_FLAGS,
+        )
+        
     cdef write_line( self, PyFrameObject frame ):
         """Write a line-event into the calls-file"""
         cdef uint32_t ts = self.timestamp()
         cdef uint16_t thread = self.thread_id( frame )
         cdef uint32_t function =  self.func_to_number( frame )
-        self.calls.write_callinfo( 
+        self.write_event( 
             thread, 
             function, 
             ts,
@@ -418,12 +1130,10 @@ cdef class Profiler(object):
         versus GIL-locked (if it's locked, we should discount, otherwise we should 
         not).
         """
-        cdef PY_LONG_LONG delta
-        cdef uint32_t mask
-        cdef PY_LONG_LONG current = hpTimer()
-        delta = current - self.internal_start - self.internal_discount
-        #delta = delta & mask
-        return <uint32_t>delta
+        return <uint32_t>self.elapsed()
+    cdef PY_LONG_LONG elapsed( self ):
+        """Calculate the (64-bit) time since we started, timestamp() is its low 32 bits"""
+        return hpTimer() - self.internal_start - self.internal_discount
     
     def __enter__( self ):
         """Start the Profiler on entry (with statement starts)"""
@@ -446,18 +1156,59 @@ cdef class Profiler(object):
         # TODO: wrong, this will cause time to go backward!
         if self.internal_start == 0:
             self.internal_start = hpTimer()
+        if self.memory is not None:
+            self.last_memory = self.memory.extract()
+        if self.aggregator is not None:
+            self.last_snapshot = self.elapsed()
+        if self.all_threads:
+            # threads started from now on hook themselves on startup...
+            threading.setprofile( self.bootstrap_thread )
+            if coldshot_set_profile_all(profile_callback, self) < 0:
+                log.warn( 
+                    'Unable to hook already-running threads on Python %s, only the calling thread and threads started from now on are profiled', 
+                    sys.version.split()[0],
+                )
+            if self.lines:
+                coldshot_set_trace_all(trace_callback, self)
+        else:
+            self.install()
+    cdef install( self ):
+        """Install our callbacks for the current thread"""
         PyEval_SetProfile(profile_callback, self)
         if self.lines:
             PyEval_SetTrace(trace_callback, self)
+    def bootstrap_thread( self, frame, event, arg ):
+        """Python-level profile function for threads started while active
+        
+        threading.setprofile installs this as the profile function for new 
+        threads, we replace it with our C-level callbacks on the thread's 
+        first event (recording that event).
+        """
+        if not self.active:
+            sys.setprofile( None )
+            return
+        self.install()
+        if event == 'call':
+            self.write_call( (<PyFrameObject *>frame)[0] )
     def stop( self ):
         """Remove the currently installed profiler (even if it is not us)"""
         if not self.active:
             return 
         self.active = False
-        coldshot_unset_profile()
-        if self.lines:
-            coldshot_unset_trace()
+        if self.all_threads:
+            threading.setprofile( None )
+            coldshot_unset_profile_all()
+            if self.lines:
+                coldshot_unset_trace_all()
+        else:
+            coldshot_unset_profile()
+            if self.lines:
+                coldshot_unset_trace()
+        if self.aggregator is not None:
+            self.snapshot()
         self.flush()
+        self.index.write_stats( self.stats() )
+        self.index.flush()
     
     def flush( self ):
         """Flush our results to disk
@@ -467,8 +1218,71 @@ cdef class Profiler(object):
         to the data-files.  :py:meth:`stop` will automatically flush the 
         profiler results.
         """
+        cdef PY_LONG_LONG start = hpTimer()
         self.index.flush()
-        self.calls.flush()
+        for writer in self.writers.values():
+            writer.flush()
+        self.flushes += 1
+        self.flush_time += hpTimer() - start
+    
+    def snapshot( self ):
+        """Write the aggregate-mode totals so far to our snapshot file
+        
+        Called every snapshot_interval while running and when we stop, the 
+        snapshot replaces the previous one, errors are logged (and counted 
+        as write errors) rather than raised into the profiled code.
+        """
+        if self.aggregator is None:
+            raise RuntimeError( 'Snapshots are only available in aggregate mode' )
+        self.last_snapshot = self.elapsed()
+        try:
+            self.aggregator.save( self.snapshot_filename )
+        except (IOError,OSError) as err:
+            log.warn( 'Unable to write snapshot %s: %s', self.snapshot_filename, err )
+            self.write_errors += 1
+        else:
+            self.snapshots += 1
+    
+    def stats( self ):
+        """Report the profiler's internal (self-instrumentation) counters
+        
+        events -- total events written (excluding counter records)
+        <type>_events -- events written of each of :py:data:`EVENT_TYPES`
+        functions, files, annotations -- number of each registered
+        bytes_written -- bytes of event records written to data-files
+        segments, pruned_segments -- data-file segments created/deleted
+        flushes -- number of explicit flushes
+        snapshots -- aggregate-mode snapshots written
+        write_errors -- records which could not be written to the data-file
+        dropped_events -- records discarded (write errors or written after close)
+        callback_seconds -- time spent inside the profiling callbacks 
+            (from the event's timestamp to the end of writing it), only 
+            measured when the profiler was created with instrument=True
+        registration_seconds -- part of callback_seconds spent registering 
+            new functions (and files) in the index
+        flush_seconds -- time spent in explicit flushes
+        
+        returns dictionary of name: value
+        """
+        result = {
+            'events': self.events,
+            'functions': self.new_functions,
+            'files': self.new_files,
+            'annotations': self.new_annotations,
+            'bytes_written': self.bytes_written,
+            'segments': self.segment or len( self.writers ),
+            'pruned_segments': self.pruned,
+            'flushes': self.flushes,
+            'snapshots': self.snapshots,
+            'write_errors': self.write_errors,
+            'dropped_events': self.dropped,
+            'callback_seconds': self.callback_time * TIMER_UNIT,
+            'registration_seconds': self.registration_time * TIMER_UNIT,
+            'flush_seconds': self.flush_time * TIMER_UNIT,
+        }
+        for i,name in enumerate( EVENT_TYPES ):
+            result['%s_events'%( name, )] = self.event_counts[i]
+        return result
     
     def close( self ):
         """Close our files
@@ -478,8 +1292,10 @@ cdef class Profiler(object):
         """
         if self.active:
             self.stop()
+        self.closed = True
         self.index.close()
-        self.calls.close()
+        for writer in self.writers.values():
+            writer.close()
     
     # possible API
     def annotation( self, annotation, uint16_t lineno=0 ):
@@ -506,7 +1322,7 @@ cdef class Profiler(object):
         self.internal = True
         thread = self.threads.new_id(PyThreadState_Get().thread_id)
         ts = self.timestamp()
-        self.calls.write_callinfo(
+        self.write_event(
             thread,
             self.annotation_to_number( annotation ),
             ts,
@@ -551,6 +1367,10 @@ cdef int trace_callback(
     events, which seems wrong/silly
     """
     cdef Profiler profiler = <Profiler>self
+    if not profiler.active:
+        # stopped from another thread (or by max_events), detach ourselves
+        coldshot_unset_trace()
+        return 0
     if what == PyTrace_LINE:
         profiler.write_line( frame[0] )
     return 0
@@ -563,13 +1383,36 @@ cdef int profile_callback(
 ):
     """Callback for profile (call/return, include C call/return) operations"""
     cdef Profiler profiler = <Profiler>self
+    if not profiler.active:
+        # stopped from another thread (or by max_events), detach ourselves
+        coldshot_unset_profile()
+        return 0
     if what == PyTrace_CALL:
-        profiler.write_call( frame[0] )
+        if frame.f_lasti >= 0:
+            # generator frame which has already started, i.e. being resumed
+            profiler.write_frame_event( frame[0], profiler.RESUME_FLAGS )
+        else:
+            profiler.write_call( frame[0] )
     elif what == PyTrace_C_CALL:
         if PyCFunction_Check( arg ):
             profiler.write_c_call( frame[0], <PyCFunctionObject *>arg )
-#    elif what == PyTrace_EXCEPTION or what == PyTrace_C_EXCEPTION:
-#        pass #profiler.write_exception( 
-    elif what == PyTrace_RETURN or what == PyTrace_C_RETURN:
+    elif what == PyTrace_RETURN:
+        if <void *>arg == NULL:
+            # frame is being exited by an exception
+            profiler.write_exception( frame[0], profiler.func_to_number( frame[0] ) )
+            profiler.write_return( frame[0] )
+        elif frame.f_stacktop != NULL:
+            # frame is suspended (yield) rather than finished
+            profiler.write_frame_event( frame[0], profiler.YIELD_FLAGS )
+        else:
+            profiler.write_return( frame[0] )
+    elif what == PyTrace_C_RETURN:
         profiler.write_return( frame[0] )
+    elif what == PyTrace_C_EXCEPTION:
+        # no C_RETURN follows a C_EXCEPTION
+        if PyCFunction_Check( arg ):
+            profiler.write_exception( 
+                frame[0], profiler.builtin_to_number( <PyCFunctionObject *>arg ),
+            )
+            profiler.write_return( frame[0] )
     return 0
@@ -0,0 +1,236 @@
+"""On-demand (query-oriented) access to Coldshot profiles for interactive browsers
+
+A full :py:meth:`coldshot.loader.Loader.load` replays every event before
+anything can be shown.  A :py:class:`Query` only processes the index when
+created, so the functions and files are available immediately, and then:
+
+    * computes the function aggregates in a background thread
+      (:py:meth:`Query.start`), reporting progress to a callback, the
+      FunctionInfo records are filled in as loading progresses
+
+    * materializes individual calls only when asked for, by scanning the
+      range of the event stream between a call's start and stop indices
+      (:py:meth:`Query.children`), keeping the most recently used results
+
+.. code:: python
+
+    from coldshot import query
+    profile = query.Query( 'test.profile' )
+    profile.start( progress=lambda done,total: None )
+    for call in profile.calls( profile.function( 'mymodule', 'main' )):
+        for child in profile.children( call ):
+            print child
+"""
+import os, time, threading, collections, logging
+from . import loader, aggregates
+log = logging.getLogger( __name__ )
+
+__all__ = ('Query','CallNode','LRUCache')
+
+class LRUCache( object ):
+    """Mapping of at most size entries, discarding the least-recently used"""
+    def __init__( self, size=256 ):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+    def __len__( self ):
+        return len( self.entries )
+    def __contains__( self, key ):
+        return key in self.entries
+    def get( self, key, default=None ):
+        """Retrieve key (marking it as most recently used)"""
+        with self.lock:
+            try:
+                value = self.entries.pop( key )
+            except KeyError:
+                return default
+            self.entries[key] = value
+            return value
+    def set( self, key, value ):
+        """Store value for key, evicting the least-recently used entries"""
+        with self.lock:
+            self.entries.pop( key, None )
+            self.entries[key] = value
+            while len( self.entries ) > self.size:
+                self.entries.popitem( last=False )
+    def clear( self ):
+        with self.lock:
+            self.entries.clear()
+
+class CallNode( object ):
+    """A single call found by scanning the event stream
+
+    Attributes:
+
+        function -- FunctionInfo which was called
+
+        thread -- 16-bit thread id
+
+        call_file -- index of the call file in the Query's call files
+
+        start_index, stop_index -- indices of the call and return events,
+            stop_index is -1 if the call had not returned by the end of
+            the call file
+
+        start, stop -- raw timestamps of the call and return
+    """
+    __slots__ = (
+        'function','thread','call_file','start_index','stop_index','start','stop',
+    )
+    def __init__( self, function, thread, call_file, start_index, stop_index, start, stop ):
+        self.function = function
+        self.thread = thread
+        self.call_file = call_file
+        self.start_index = start_index
+        self.stop_index = stop_index
+        self.start = start
+        self.stop = stop
+    def __repr__( self ):
+        return '<%s for %s at index %s %ss>'%(
+            self.__class__.__name__, self.function, self.start_index, self.cumulative,
+        )
+    @property
+    def complete( self ):
+        """Did the call return within its call file?"""
+        return self.stop_index >= 0
+    @property
+    def time( self ):
+        return self.stop - self.start
+    @property
+    def cumulative( self ):
+        return self.time * self.function.loader.timer_unit
+    @property
+    def may_have_children( self ):
+        """Are there any events between the call and its return?"""
+        return self.stop_index < 0 or self.stop_index > self.start_index + 1
+
+class Query( object ):
+    """Query-oriented (lazy) access to a profile directory
+
+    directory -- profile directory (as written by the Profiler)
+    cache_size -- number of scan results (lists of calls) to retain
+    use_cache -- if True, read (and write) the aggregates cache, see
+        :py:mod:`coldshot.aggregates`
+
+    Attributes:
+
+        loader -- Loader which has processed the index
+
+        info -- the loader's LoaderInfo, function totals are filled in by
+            :py:meth:`start`
+
+        ready -- threading.Event set once the aggregates are complete
+
+        error -- exception raised while computing the aggregates (if any)
+    """
+    def __init__( self, directory, cache_size=256, use_cache=True ):
+        self.directory = directory
+        self.loader = loader.Loader( directory )
+        self.loader.process_index( self.loader.index_filename )
+        self.info = self.loader.info
+        self.use_cache = use_cache
+        self.cache = LRUCache( cache_size )
+        self.ready = threading.Event()
+        self.thread = None
+        self.error = None
+
+    def functions( self ):
+        """All functions declared in the index (totals are filled in once loaded)"""
+        root = self.info.roots['functions']
+        return [
+            function for (key,function) in sorted( self.info.functions.items() )
+            if function is not root
+        ]
+    def function( self, module, name ):
+        """Find a function by module and name (None if not present)"""
+        return self.info.function_names.get( (module,name) )
+
+    def start( self, progress=None, done=None ):
+        """Compute the function aggregates in a background thread
+
+        progress -- callable( records_done, records_total ), called
+            periodically from the loading thread
+        done -- callable( query ), called from the loading thread once
+            the aggregates are complete (or failed, see :py:attr:`error`)
+
+        returns the loading thread
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target = self.run, args = (progress,done), name = 'coldshot-query',
+            )
+            self.thread.daemon = True
+            self.thread.start()
+        return self.thread
+    def run( self, progress=None, done=None ):
+        """Compute the function aggregates in the calling thread"""
+        def report( records_done, records_total ):
+            if progress is not None:
+                progress( records_done, records_total )
+            # the loader does not release the GIL, let other threads run
+            time.sleep( 0 )
+        self.loader.progress = report
+        try:
+            aggregates.populate(
+                self.loader, use_cache=self.use_cache, write_cache=self.use_cache,
+            )
+        except Exception as err:
+            log.exception( 'Unable to load aggregates for %s', self.directory )
+            self.error = err
+        finally:
+            self.loader.progress = None
+            self.ready.set()
+        if done is not None:
+            done( self )
+    def wait( self, timeout=None ):
+        """Wait for the aggregates to be complete, returns whether they are"""
+        self.ready.wait( timeout )
+        return self.ready.is_set()
+
+    def scan( self, call_file, start=0, stop=-1, thread=-1, depth=-1, function=-1 ):
+        """Scan (a range of) a call file for calls, see Loader.scan_calls
+
+        Results are cached, the least-recently used being discarded.
+
+        returns [CallNode,...]
+        """
+        key = (call_file,start,stop,thread,depth,function)
+        nodes = self.cache.get( key )
+        if nodes is None:
+            filename = self.loader.call_files[call_file]
+            nodes = []
+            if os.path.exists( filename ):
+                functions = self.info.functions
+                for (key_,thread_,start_index,stop_index,start_ts,stop_ts) in self.loader.scan_calls(
+                    filename, start, stop, thread, depth, function,
+                ):
+                    called = functions.get( key_ )
+                    if called is not None:
+                        nodes.append( CallNode(
+                            called, thread_, call_file, start_index, stop_index, start_ts, stop_ts,
+                        ))
+            self.cache.set( key, nodes )
+        return nodes
+    def roots( self, thread=None ):
+        """Top-level calls in each call file (optionally for a single thread)"""
+        result = []
+        for call_file in range( len( self.loader.call_files )):
+            result.extend( self.scan(
+                call_file, depth=0, thread=-1 if thread is None else thread,
+            ))
+        return result
+    def calls( self, function ):
+        """Individual calls of function (FunctionInfo or id) in all call files"""
+        key = getattr( function, 'key', function )
+        result = []
+        for call_file in range( len( self.loader.call_files )):
+            result.extend( self.scan( call_file, function=key ))
+        return result
+    def children( self, call ):
+        """Calls made directly by call (a CallNode)"""
+        if not call.may_have_children:
+            return []
+        return self.scan(
+            call.call_file, start=call.start_index + 1, stop=call.stop_index,
+            thread=call.thread, depth=0,
+        )
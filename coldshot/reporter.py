@@ -1,42 +1,500 @@
+"""Tabular textual/csv/json reports on loaded Coldshot profiles"""
+import os, heapq, json, csv, numbers
+from operator import itemgetter
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+__all__ = (
+    'Reporter','LineReporter','SourceCache','COLUMNS','MEMORY_COLUMNS',
+    'CPU_COLUMNS','LATENCY_COLUMNS','FORMATS',
+)
+
+FORMATS = ('text','csv','json')
+
+# name: (header, text-format-string, width)
+COLUMNS = {
+    'thread': ('Thread', '%6d', 6),
+    'annotation': ('Annotation', '%-20s', 20),
+    'module': ('Namespace', '%30s', 30),
+    'line': ('Line', '%-5s', 5),
+    'name': ('Name', '%-20s', 20),
+    'filename': ('File', '%-20s', 20),
+    'calls': ('Calls', '% 8d', 8),
+    'cumulative': ('Cumtime', '% 10.4f', 10),
+    'cumulativePer': ('Cum/Call', '% 10.6f', 10),
+    'local': ('Local', '% 10.4f', 10),
+    'localPer': ('Local/Call', '% 10.6f', 10),
+    'empty': ('Empty', '% 6.3f', 6),
+    'time': ('Raw', '% 12d', 12),
+    'allocated': ('Allocated', '% 12d', 12),
+    'freed': ('Freed', '% 12d', 12),
+    'local_allocated': ('Local Alloc', '% 12d', 12),
+    'local_freed': ('Local Freed', '% 12d', 12),
+    'allocatedPer': ('Alloc/Call', '% 10d', 10),
+    'net_allocated': ('Net Alloc', '% 12d', 12),
+    'cpu': ('CPU', '% 10.4f', 10),
+    'cpu_local': ('Local CPU', '% 10.4f', 10),
+    'cpuPer': ('CPU/Call', '% 10.6f', 10),
+    'waiting': ('Waiting', '% 10.4f', 10),
+    'exceptions': ('Exceptions', '% 10d', 10),
+    'p50': ('P50', '% 10.6f', 10),
+    'p90': ('P90', '% 10.6f', 10),
+    'p99': ('P99', '% 10.6f', 10),
+    'slowest': ('Slowest', '% 10.6f', 10),
+    'slowest_index': ('Slowest At', '% 12d', 12),
+    'slowest_file': ('Slowest In', '%-32s', 32),
+}
+DEFAULT_COLUMNS = ('module','line','name','cumulative','calls','local')
+MEMORY_COLUMNS = ('allocated','local_allocated','freed')
+CPU_COLUMNS = ('cpu','cpu_local','waiting')
+LATENCY_COLUMNS = ('p50','p90','p99','slowest','slowest_index','slowest_file')
+MODULE_COLUMNS = ('module','calls','cumulative','cumulativePer')
+THREAD_COLUMNS = ('thread','start','stop','duration','context_switches','calls')
+ANNOTATION_COLUMNS = ('annotation','calls','cumulative','cumulativePer')
+SPAN_COLUMNS = ('annotation','thread','start','duration','start_index','stop_index')
+STATS_COLUMNS = ('statistic','value')
+# metrics which are not function attributes...
+EXTRA_COLUMNS = {
+    'start': ('Start', '% 10.4f', 10),
+    'stop': ('Stop', '% 10.4f', 10),
+    'duration': ('Duration', '% 10.4f', 10),
+    'context_switches': ('Switches', '% 8d', 8),
+    'start_index': ('Start Index', '% 12d', 12),
+    'stop_index': ('Stop Index', '% 12d', 12),
+    'statistic': ('Statistic', '%-24s', 24),
+    'value': ('Value', '%16s', 16),
+}
 
 class Reporter( object ):
-    """Trivial reporter class (present tabular textual statistics)"""
-    def __init__( self, loader, sort=('-time','module','name' )):
-        self.loader = loader 
+    """Reporter producing tabular reports from a loader
+
+    loader -- :py:class:`coldshot.loader.Loader` which has been loaded
+    sort -- sequence of column names, prefix with '-' for descending
+    limit -- if non-None, only report the top ``limit`` rows
+    columns -- sequence of column names to display (see :py:data:`COLUMNS`)
+    modules -- if non-None, sequence of module names (or package prefixes)
+        to which to restrict the report
+    threads -- if non-None, sequence of thread ids to which to restrict the
+        report, rows are then reported per-thread (the loader must have been 
+        created with thread_functions=True)
+    annotations -- if non-None, sequence of annotation values, the report 
+        then uses the per-annotation totals (calls/lines run while the 
+        annotation was current), combined with threads, only functions 
+        run in one of the annotations are reported
+    lines -- if True, report per-line timings for each function (text only)
+    format -- one of :py:data:`FORMATS`
+    """
+    def __init__(
+        self, loader, sort=('-time','module','name' ),
+        limit=None, columns=DEFAULT_COLUMNS,
+        modules=None, threads=None, annotations=None,
+        lines=True, format='text',
+    ):
+        self.loader = loader
+        self.limit = limit
+        self.columns = tuple(columns)
+        for column in self.columns:
+            if column not in COLUMNS:
+                raise ValueError( 'Unknown report column %r, expected one of %s'%( column, sorted(COLUMNS) ))
+        self.modules = modules
+        self.threads = threads
+        self.annotations = annotations
+        self.lines = lines
+        if format not in FORMATS:
+            raise ValueError( 'Unknown report format %r, expected one of %s'%( format, FORMATS ))
+        self.format = format
         self.set_sort( sort )
     def set_sort( self, sort ):
         """Set our sorting key"""
-        def key(x):
-            result = []
-            for key in sort:
-                if key.startswith( '-' ):
-                    result.append( - (getattr(x,key[1:],0)))
+        self.sort = [
+            (key.lstrip('-'),key.startswith('-'))
+            for key in sort
+        ]
+
+    def functions( self ):
+        """Produce the (filtered) rows for the function report
+
+        returns [(scope,function),...] where scope is the thread id, the 
+        annotation value or None for whole-profile totals
+        """
+        info = self.loader.info
+        if self.annotations is not None and self.threads is None:
+            rows = []
+            for annotation in self.annotations:
+                note = info.annotation_notes.get( annotation )
+                if note is not None:
+                    rows.extend( [(annotation,function) for function in note.functions.values()] )
+        elif self.threads is not None:
+            rows = []
+            for thread in self.threads:
+                stack = info.threads.get( thread )
+                if stack is not None:
+                    rows.extend( [(thread,function) for function in stack.functions.values()] )
+        else:
+            rows = [(None,function) for function in info.functions.values()]
+        rows = [row for row in rows if row[1].time]
+        if self.modules is not None:
+            modules = tuple( self.modules )
+            prefixes = tuple([ module + '.' for module in modules ])
+            rows = [
+                row for row in rows
+                if row[1].module in modules or row[1].module.startswith( prefixes )
+            ]
+        if self.annotations is not None and self.threads is not None:
+            keys = set()
+            for annotation in self.annotations:
+                note = info.annotation_notes.get( annotation )
+                if note is not None:
+                    keys.update( note.functions )
+            rows = [row for row in rows if row[1].key in keys]
+        return rows
+
+    def table( self, rows, columns, extract ):
+        """Extract the columns+sort-keys from the rows and select/sort them
+
+        rows -- sequence of row objects
+        columns -- column names to report
+        extract -- callable( row, name ) -> value
+
+        Values are extracted once for every row into a tuple, so that the
+        selection itself runs with C-level key functions.
+
+        returns [(row,values),...] in report order
+        """
+        sort_names = [name for (name,descending) in self.sort]
+        names = list(columns) + [name for name in sort_names if name not in columns]
+        indices = dict([(name,i) for (i,name) in enumerate(names)])
+        records = [
+            tuple([extract( row, name ) for name in names]) + (row,)
+            for row in rows
+        ]
+        directions = set([descending for (name,descending) in self.sort])
+        if len(directions) == 1:
+            reverse = directions.pop()
+            key = itemgetter( *[indices[name] for name in sort_names] )
+        elif records and all([
+            isinstance( records[0][indices[name]], numbers.Number )
+            for (name,descending) in self.sort if descending
+        ]):
+            # mixed directions, but descending keys can be negated
+            reverse = False
+            getters = [(indices[name],descending) for (name,descending) in self.sort]
+            def key( record ):
+                return tuple([
+                    -record[index] if descending else record[index]
+                    for (index,descending) in getters
+                ])
+        else:
+            # successive stable sorts from least significant key
+            for name,descending in self.sort[::-1]:
+                records.sort( key=itemgetter( indices[name] ), reverse=descending )
+            key = None
+        if key is not None:
+            if self.limit is not None:
+                if reverse:
+                    records = heapq.nlargest( self.limit, records, key=key )
                 else:
-                    result.append( getattr( x, key, None))
-            return result 
-        self.sort = key 
+                    records = heapq.nsmallest( self.limit, records, key=key )
+            else:
+                records.sort( key=key, reverse=reverse )
+        elif self.limit is not None:
+            records = records[:self.limit]
+        width = len(columns)
+        return [ (record[-1],record[:width]) for record in records ]
+
+    def function_value( self, row, name ):
+        """Extract a named value from a (scope,function) row"""
+        scope,function = row
+        if name == 'thread':
+            return scope if self.threads is not None else -1
+        elif name == 'annotation':
+            return scope if self.threads is None and scope is not None else ''
+        elif name == 'slowest_file':
+            # the data-file (within the profile directory) of slowest_index
+            index = function.slowest_file
+            if index < 0 or index >= len( self.loader.call_files ):
+                return ''
+            return os.path.basename( self.loader.call_files[index] )
+        return getattr( function, name, 0 )
+
     def report( self ):
-        """Generate textual report with our current setup"""
-        functions = self.loader.info.functions.values()
-        functions.sort( key=self.sort )
-        COLSET = ['module','name','time','calls','local']
-        header = '%s %s %s %s %s'%('Namespace'.rjust(30),'Name'.ljust(20),'Cumtime'.ljust(12),'Calls'.ljust(9),'Local'.ljust(9))
+        """Generate report with our current setup"""
+        columns = self.columns
+        if self.threads is not None and 'thread' not in columns:
+            columns = ('thread',) + columns
+        elif self.annotations is not None and 'annotation' not in columns:
+            columns = ('annotation',) + columns
+        table = self.table( self.functions(), columns, self.function_value )
+        if self.format != 'text' or not self.lines:
+            return self.format_table( columns, table )
+        timer_unit = self.loader.info.timer_unit
+        def line_rows( row ):
+            function = row[1]
+            for (line,lineinfo) in sorted(function.line_map.items()):
+                text = '    % 5d % 8.4f % 8d'%(
+                    lineinfo.line,
+                    lineinfo.time * timer_unit,
+                    lineinfo.calls,
+                )
+                if lineinfo.allocated or lineinfo.freed:
+                    text += ' +%d/-%d bytes'%( lineinfo.allocated, lineinfo.freed )
+                yield text
+        return self.format_table( columns, table, line_rows )
+
+    def module_report( self ):
+        """Generate a per-module report from :py:attr:`LoaderInfo.modules`"""
+        info = self.loader.info
+        info.finalize_modules()
+        rows = [
+            module for module in info.modules.values()
+            if module.key and module.cumulative
+        ]
+        if self.modules is not None:
+            prefixes = tuple([ module + '.' for module in self.modules ])
+            rows = [
+                row for row in rows
+                if row.key in self.modules or row.key.startswith( prefixes )
+            ]
+        table = self.table( rows, MODULE_COLUMNS, self.module_value )
+        return self.format_table( MODULE_COLUMNS, table )
+    def module_value( self, module, name ):
+        """Extract a named value from a module row"""
+        if name == 'time':
+            name = 'cumulative'
+        elif name == 'module':
+            name = 'key'
+        return getattr( module, name, 0 )
+
+    def thread_report( self ):
+        """Generate a per-thread report from :py:attr:`LoaderInfo.threads`"""
+        rows = self.loader.info.threads.values()
+        if self.threads is not None:
+            rows = [row for row in rows if row.thread in self.threads]
+        table = self.table( rows, THREAD_COLUMNS, self.thread_value )
+        return self.format_table( THREAD_COLUMNS, table )
+    def thread_value( self, stack, name ):
+        """Extract a named value from a thread (Stack) row"""
+        timer_unit = self.loader.info.timer_unit
+        if name == 'start':
+            return stack.start * timer_unit
+        elif name == 'stop':
+            return stack.stop * timer_unit
+        elif name in ('duration','time','cumulative'):
+            return (stack.stop - stack.start) * timer_unit
+        elif name == 'calls':
+            return sum([ function.calls for function in stack.functions.values() ])
+        return getattr( stack, name, 0 )
+
+    def annotation_report( self ):
+        """Generate a per-annotation report (number of spans and total span time)"""
+        info = self.loader.info
+        rows = info.annotation_notes.values()
+        if self.annotations is not None:
+            rows = [row for row in rows if row.key in self.annotations]
+        for row in rows:
+            row.calculate_totals()
+        table = self.table( rows, ANNOTATION_COLUMNS, self.annotation_value )
+        return self.format_table( ANNOTATION_COLUMNS, table )
+    def annotation_value( self, note, name ):
+        """Extract a named value from an Annotation row"""
+        if name == 'annotation':
+            return note.key
+        elif name == 'time':
+            name = 'cumulative'
+        return getattr( note, name, 0 )
+
+    def span_report( self ):
+        """Generate a report of the slowest annotated spans (limit defaults to 10)"""
+        spans = self.loader.info.slowest_spans( self.limit or 10, self.annotations )
+        table = [
+            (span,(note.key,span[0],span[1]*self.loader.info.timer_unit,duration,span[3],span[4]))
+            for (duration,note,span) in spans
+        ]
+        return self.format_table( SPAN_COLUMNS, table )
+
+    def stats_report( self ):
+        """Report the profiler's self-instrumentation counters (in name order)"""
+        stats = sorted( self.loader.info.profiler_stats.items() )
+        table = [ (row,row) for row in stats ]
+        return self.format_table( STATS_COLUMNS, table )
+
+    def format_table( self, columns, table, extra=None ):
+        """Format the table in our configured format
+
+        columns -- column names
+        table -- [(row,values),...] as produced by :py:meth:`table`
+        extra -- for text format, callable( row ) -> iterable of extra lines
+        """
+        if self.format == 'json':
+            return json.dumps( [
+                dict( zip( columns, values ))
+                for (row,values) in table
+            ], indent=1, sort_keys=True )
+        elif self.format == 'csv':
+            fh = StringIO()
+            writer = csv.writer( fh )
+            writer.writerow( columns )
+            for row,values in table:
+                writer.writerow( values )
+            return fh.getvalue()
+        definitions = [ COLUMNS.get( name ) or EXTRA_COLUMNS[name] for name in columns ]
+        header = ' '.join([
+            format_cell( format, width, header )
+            for (header,format,width) in definitions
+        ])
         report = [ header, '' ]
-        for function in functions:
-            if function.time:
-                report.append('''%s:%s %s % 8.4f % 8d % 8.4f'''%(
-                    function.module[-30:].rjust(30),
-                    str(function.line).ljust(4),
-                    function.name.ljust(20),
-                    function.cumulative,
-                    function.calls,
-                    function.local,
-                ))
-                for (line,lineinfo) in sorted(function.line_map.items()):
-                    report.append( '    % 5d % 8.4f % 8d'%(
-                        lineinfo.line,
-                        lineinfo.time * self.loader.info.timer_unit,
-                        lineinfo.calls,
-                    ))
+        for row,values in table:
+            report.append( ' '.join([
+                format_cell( format, width, value )
+                for ((header,format,width),value) in zip( definitions, values )
+            ]))
+            if extra is not None:
+                report.extend( extra( row ) )
         return '\n'.join( report )
+
+def format_cell( format, width, value ):
+    """Format a single cell of a text report
     
+    Textual values are truncated to width, right-aligned columns keep the 
+    end of the value (the most specific part of a dotted name).
+    """
+    if isinstance( value, (bytes,str) ):
+        if format.startswith( '%-' ):
+            return value[:width].ljust( width )
+        return value[-width:].rjust( width )
+    return format%( value, )
+
+def top( limit, records ):
+    """Select the top limit records by their first element (all if limit is None)"""
+    if limit is None:
+        return sorted( records, key=itemgetter(0), reverse=True )
+    return heapq.nlargest( limit, records, key=itemgetter(0) )
+
+class SourceCache( object ):
+    """Reads source files on demand, reading each path at most once"""
+    def __init__( self ):
+        self.sources = {}
+    def lines( self, path ):
+        """Retrieve the lines of the source file at path (empty list if unreadable)"""
+        lines = self.sources.get( path )
+        if lines is None:
+            try:
+                with open( path ) as fh:
+                    lines = [line.rstrip('\r\n').expandtabs() for line in fh]
+            except (IOError,OSError):
+                lines = []
+            self.sources[path] = lines
+        return lines
+    def line( self, path, lineno ):
+        """Retrieve a single (1-indexed) line from the file at path"""
+        lines = self.lines( path )
+        if 0 < lineno <= len(lines):
+            return lines[lineno-1]
+        return ''
+
+class LineReporter( object ):
+    """Line-level hot-spot report with annotated source (like line_profiler)
+
+    info -- :py:class:`coldshot.stack.LoaderInfo` loaded from a profile with
+        line tracing enabled (aggregates from :py:mod:`coldshot.aggregates`
+        are sufficient, so large traces need only be replayed once)
+    limit -- number of functions/files to report
+    source -- :py:class:`SourceCache` from which to read source files
+    """
+    HEADER = '%6s %9s %12s %12s %8s  %s'%( 
+        'Line #', 'Hits', 'Time', 'Per Hit', '% Time', 'Line Contents',
+    )
+    def __init__( self, info, limit=10, source=None ):
+        self.info = info
+        self.limit = limit
+        self.source = source or SourceCache()
+
+    def hot_functions( self ):
+        """Select the top functions by total line time"""
+        functions = [
+            (sum([line.time for line in function.line_map.values()]), function)
+            for function in self.info.functions.values()
+            if function.line_map and function.file.fileno
+        ]
+        return [
+            function for (total,function) in 
+            top( self.limit, functions )
+            if total
+        ]
+    def hot_files( self ):
+        """Select the top files by total line time
+
+        returns [(FileInfo,{line:(hits,time)}),...]
+        """
+        files = {}
+        for function in self.info.functions.values():
+            if not function.line_map or not function.file.fileno:
+                continue
+            lines = files.setdefault( function.file.path, (function.file,{}) )[1]
+            for line,line_info in function.line_map.items():
+                hits,time = lines.get( line, (0,0) )
+                lines[line] = (hits+line_info.calls,time+line_info.time)
+        totals = [
+            (sum([time for (hits,time) in lines.values()]),file,lines)
+            for (file,lines) in files.values()
+        ]
+        return [
+            (file,lines) for (total,file,lines) in 
+            top( self.limit, totals )
+            if total
+        ]
+
+    def format_lines( self, path, lines, linenos ):
+        """Format the given line numbers of path with the statistics in lines"""
+        timer_unit = self.info.timer_unit
+        total = sum([time for (hits,time) in lines.values()]) or 1
+        report = [ self.HEADER, '='*len(self.HEADER) ]
+        for lineno in linenos:
+            text = self.source.line( path, lineno )
+            if lineno in lines:
+                hits,time = lines[lineno]
+                report.append( '%6d %9d %12.6f %12.6f %8.1f  %s'%(
+                    lineno, hits, time*timer_unit, 
+                    time*timer_unit/(hits or 1),
+                    100.0*time/total,
+                    text,
+                ))
+            else:
+                report.append( '%6d %9s %12s %12s %8s  %s'%( lineno, '', '', '', '', text ))
+        return report
+
+    def function_report( self ):
+        """Report the hottest functions with annotated source"""
+        report = []
+        for function in self.hot_functions():
+            lines = dict([
+                (line,(line_info.calls,line_info.time))
+                for (line,line_info) in function.line_map.items()
+            ])
+            report.extend([
+                'File: %s'%( function.path, ),
+                'Function: %s.%s at line %s'%( function.module, function.name, function.line ),
+                'Total time: %0.6f s'%( function.cumulative, ),
+                '',
+            ])
+            report.extend( self.format_lines( 
+                function.path, lines, range( function.line, max(lines)+1 ) 
+            ))
+            report.append( '' )
+        return '\n'.join( report )
+    def file_report( self ):
+        """Report the hottest files, showing only executed lines"""
+        report = []
+        for file,lines in self.hot_files():
+            report.extend([
+                'File: %s'%( file.path, ),
+                'Total time: %0.6f s'%( 
+                    sum([time for (hits,time) in lines.values()]) * self.info.timer_unit, 
+                ),
+                '',
+            ])
+            report.extend( self.format_lines( file.path, lines, sorted( lines )))
+            report.append( '' )
+        return '\n'.join( report )
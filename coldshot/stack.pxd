@@ -10,10 +10,15 @@ cdef class LoaderInfo:
     cdef public bint bigendian
     cdef public bint swapendian
     cdef public double timer_unit
+    cdef public double cpu_timer_unit
     cdef public dict threads
     cdef public dict roots
     cdef public set individual_calls
     cdef public dict modules
+    cdef public dict profiler_stats
+    cdef public bint latency_edges
+    cdef public bint thread_functions
+    cdef public long call_file
     
     cdef FileInfo add_file( self, filename, uint16_t fileno )
     cdef FunctionInfo add_function( self, FunctionInfo function )
@@ -25,20 +30,46 @@ cdef class LoaderInfo:
 cdef class Stack:
     cdef public uint16_t thread 
     cdef public LoaderInfo loader
-    cdef public uint32_t start 
-    cdef public uint32_t stop 
+    cdef public long long start 
+    cdef public long long stop 
     cdef public long context_switches
+    cdef public object runs
+    cdef uint32_t run_start
+    cdef public dict functions
     cdef list function_stack
     cdef uint16_t individual_calls
     cdef Annotation current_annotation
+    cdef public long long cpu
+    cdef public dict suspended
+    cdef list annotation_stack
     
     cdef push( self, FunctionInfo function_info, uint32_t timestamp, long index )
     cdef pop( self, uint32_t timestamp, long index )
     cdef line( self, FunctionInfo function_info, uint32_t timestamp, uint16_t line )
+    cdef memory( self, long long delta )
+    cdef suspend( self, uint32_t timestamp, long index )
+    cdef resume( self, FunctionInfo function_info, uint32_t timestamp, long index )
+    cdef exception( self, FunctionInfo function_info )
+    cdef long long cpu_segment( self, CallInfo call_info )
+    cdef finish_call( self, CallInfo call_info, uint32_t timestamp, long index, long long cpu )
+    cdef record_child( self, CallInfo child, uint32_t delta, long long cpu_delta )
     cdef record_context_switch( self, uint32_t timestamp )
-    cdef annotation( self, uint32_t id, uint32_t timestamp, uint16_t lineno )
+    cdef record_switch_out( self, uint32_t timestamp )
+    cdef annotation( self, uint32_t id, uint32_t timestamp, uint16_t lineno, long index )
+    cdef uint32_t record_line( self, CallInfo call_info, uint16_t line, uint32_t timestamp )
+    cdef FunctionInfo thread_function( self, FunctionInfo function_info )
     cdef debug_stack( self )
 
+cdef class LatencyHistogram:
+    # 8 sub-buckets for each power of two of a 32-bit duration
+    cdef uint32_t counts[240]
+    cdef public long count
+    cdef public uint32_t min
+    cdef public uint32_t max
+    cdef public list slowest
+    cdef uint32_t slowest_floor
+    cdef record( self, uint32_t delta, uint16_t thread, long call_file, long index )
+
 cdef class FunctionInfo:
     cdef public long calls 
     cdef public long time
@@ -53,18 +84,40 @@ cdef class FunctionInfo:
     cdef public long first_timestamp
     cdef public long last_timestamp
     
+    cdef public long long allocated
+    cdef public long long freed
+    cdef public long long local_allocated
+    cdef public long long local_freed
+    
+    cdef public long long cpu_time
+    cdef public long long cpu_child_time
+    cdef public long exceptions
+    
     cdef public dict line_map 
     cdef public dict child_map
     cdef public list individual_calls
+    cdef public LatencyHistogram latency
+    cdef public dict edge_latency
+    cdef FunctionInfo scoped_copy( self )
+    cdef record_line_time( self, uint16_t line, uint32_t delta )
     cdef record_call( self, uint32_t timestamp )
     cdef record_time_spent( self, uint32_t delta )
     cdef record_time_spent_child( self, uint32_t child, uint32_t delta )
+    cdef record_memory( self, CallInfo call_info )
+    cdef record_cpu( self, long long delta )
+    cdef record_cpu_child( self, uint32_t child, long long delta )
+    cdef record_line_memory( self, uint16_t line, long long delta )
+    cdef record_latency( self, CallInfo call_info, uint32_t delta )
+    cdef record_edge_latency( self, CallInfo child, uint32_t delta )
 
 cdef class FunctionLineInfo:
     cdef public uint16_t line 
     cdef public uint32_t time 
     cdef public uint32_t calls
+    cdef public long long allocated
+    cdef public long long freed
     cdef add_time( self, uint32_t delta, int exit )
+    cdef add_memory( self, long long delta )
 
 cdef class FileInfo:
     """Referenced by functions which declare the same file
@@ -72,7 +125,7 @@ cdef class FileInfo:
     All built-in functions currently declare the same file number (0), so all 
     built-ins will appear to come from a single file.
     """
-    cdef uint16_t fileno 
+    cdef public uint16_t fileno
     cdef public object filename 
     cdef public object directory
     cdef public object path 
@@ -84,13 +137,30 @@ cdef class CallInfo:
     cdef public uint16_t thread
     cdef public uint32_t start 
     cdef public uint32_t stop
+    cdef public long call_file
     cdef public long start_index
     cdef public long stop_index
+    cdef public Annotation annotation
     cdef list _children
     cdef uint32_t _child_time
     
+    cdef public long long allocated
+    cdef public long long freed
+    cdef public long long local_allocated
+    cdef public long long local_freed
+    cdef public long long cpu_start
+    cdef public long long cpu_stop
+    cdef public uint32_t resumed
+    cdef public uint32_t suspend_start
+    cdef public uint32_t suspended_time
+    cdef public long long cpu_resumed
+    cdef public long long cpu_suspend_start
+    cdef public long long cpu_suspended
+    
     cdef uint16_t last_line 
     cdef uint32_t last_line_time
+    cdef record_memory( self, long long delta )
+    cdef record_child_memory( self, CallInfo child )
     cdef uint32_t record_stop( self, uint32_t stop, long stop_index )
     cdef uint32_t record_stop_child( self, uint32_t delta, uint32_t child )
     cdef uint32_t record_line( self, uint16_t new_line, uint32_t stop )
@@ -116,4 +186,7 @@ cdef class ModuleInfo( PackageInfo ):
     cdef public object directory 
     cdef public object filename 
 cdef class Annotation( Grouping ):
-    pass
+    cdef public dict functions
+    cdef public list spans
+    cdef FunctionInfo scoped_function( self, FunctionInfo function_info )
+    cdef record_span( self, uint16_t thread, uint32_t start, uint32_t stop, long start_index, long stop_index )
@@ -1,5 +1,6 @@
 from coldshot cimport uint16_t, uint32_t
-import os, logging 
+import os, logging, array, heapq
+from operator import itemgetter
 log = logging.getLogger( __name__ )
 
 cdef class LoaderInfo:
@@ -23,9 +24,22 @@ cdef class LoaderInfo:
         
         timer_unit -- fractional multiplier for raw time
         
+        cpu_timer_unit -- fractional multiplier for raw CPU time
+        
         bigendian -- whether the source file was written big-endian
         
         swapendian -- whether we need to swap the endianness of records
+        
+        profiler_stats -- name:value self-instrumentation counters recorded 
+            by the profiler when it stopped (see Profiler.stats)
+        
+        latency_edges -- if True, functions record a LatencyHistogram for 
+            each child (the durations of the calls they made to it)
+        
+        thread_functions -- if True, each Stack keeps per-thread FunctionInfo 
+            totals (including line timings) in :py:attr:`Stack.functions`
+        
+        call_file -- index of the call file currently being loaded
     """
     def __cinit__( self ):
         self.functions = {}
@@ -37,10 +51,15 @@ cdef class LoaderInfo:
         self.threads = {}
         self.roots = {}
         self.modules = {}
+        self.profiler_stats = {}
+        self.latency_edges = False
+        self.thread_functions = False
+        self.call_file = 0
         
         self.individual_calls = set()
         
         self.timer_unit = .000001 # Linux default
+        self.cpu_timer_unit = .000000001
         
         self.add_file('__builtin__', 0 )
         
@@ -119,6 +138,25 @@ cdef class LoaderInfo:
                     last.children.append( current )
             last = current 
         return current
+    def slowest_spans( self, count=10, annotations=None ):
+        """Find the slowest annotated spans
+        
+        count -- number of spans to return 
+        annotations -- if non-None, sequence of annotation values to consider
+        
+        returns [(duration_in_seconds,Annotation,span),...] longest first, 
+        see :py:attr:`Annotation.spans` for the span format
+        """
+        if annotations is None:
+            notes = self.annotation_notes.values()
+        else:
+            notes = [self.annotation_notes[key] for key in annotations if key in self.annotation_notes]
+        spans = [
+            ((span[2]-span[1]) * self.timer_unit, note, span)
+            for note in notes 
+            for span in note.spans
+        ]
+        return heapq.nlargest( count, spans, key=itemgetter(0) )
     def finalize_modules( self ):
         result = self.modules.items()
         result.sort(reverse=True)
@@ -134,19 +172,36 @@ cdef class Stack:
         
         loader -- LoaderInfo object
         
-        start -- 32-bit timestamp for first event in the thread
+        start -- 32-bit timestamp for first event in the thread (64-bit 
+            time when read from an aggregate-mode snapshot)
         
-        stop -- 32-bit timestamp for the last event in the thread
+        stop -- 32-bit timestamp for the last event in the thread (as start)
         
         context_switches -- counter of the number of context switches observed
         
+        runs -- array of [start,stop,start,stop,...] 32-bit timestamps for the 
+            intervals during which this thread was emitting events (i.e. 
+            was running), see :py:mod:`coldshot.timeline`
+        
         function_stack -- list of CallInfo records currently on the stack
         
             the stack *should* be empty when the stack has been loaded
+        
+        functions -- id:FunctionInfo records with the totals for this thread only
+            (only populated from events when the loader's thread_functions is set)
             
-        current_annotation -- Annotation record (or None)
+        current_annotation -- Annotation record (or None), the top of the 
+            annotation stack
+        
+        annotation_stack -- [(Annotation,start,start_index),...] for the 
+            currently-open annotations, an annotation with id 0 (None) pops
+            the stack
         
+        cpu -- the thread's CPU clock at the current event (-1 if the 
+            profile does not record CPU time)
         
+        suspended -- function_id:[CallInfo,...] for generator calls which 
+            have yielded and not yet been resumed
     
     TODO: need to have "children" for the stack (thread) to show us what was run 
     during the thread
@@ -157,14 +212,25 @@ cdef class Stack:
         self.start = timestamp 
         self.stop = timestamp
         self.context_switches = 0
+        self.runs = array.array( 'I' )
+        self.run_start = timestamp
         self.individual_calls = ('*','*') in loader.individual_calls
         
+        self.functions = {}
         self.function_stack = []
+        self.annotation_stack = []
+        self.cpu = -1
+        self.suspended = {}
         self.push( root, timestamp, -1 )
     
     cdef record_context_switch( self, uint32_t timestamp ):
-        """Record the fact that a context switch has occurred"""
+        """Record the fact that a context switch to this thread has occurred"""
         self.context_switches += 1
+        self.run_start = timestamp
+    cdef record_switch_out( self, uint32_t timestamp ):
+        """Record that this thread's run (which began at run_start) ended at timestamp"""
+        self.runs.append( self.run_start )
+        self.runs.append( timestamp )
     cdef debug_stack( self ):
         """Print out a debug stack trace during loading"""
         cdef CallInfo call_info
@@ -178,23 +244,71 @@ cdef class Stack:
                     call_info.function.module, 
                     call_info.function.name 
                 )
-    cdef annotation( self, uint32_t id, uint32_t timestamp, uint16_t lineno ):
+    cdef annotation( self, uint32_t id, uint32_t timestamp, uint16_t lineno, long index ):
         """Record a new annotation
         
         Attributes:
         
-            id -- annotation id
+            id -- annotation id, 0 pops the annotation stack
             
-            timestamp -- 32-bit timestamp,currently ignored
+            timestamp -- 32-bit timestamp
             
             lineno -- line number (arbitrary data)
+            
+            index -- index of the annotation event in the event stream
         """
-        self.current_annotation = <Annotation>self.loader.annotations.get( id )
-        # TODO: needs to be configurable...
+        cdef Annotation note
+        if id == 0:
+            if self.annotation_stack:
+                note,start,start_index = self.annotation_stack.pop()
+                note.record_span( self.thread, start, timestamp, start_index, index )
+        else:
+            note = <Annotation>self.loader.annotations.get( id )
+            if note is not None:
+                self.annotation_stack.append( (note,timestamp,index) )
+        if self.annotation_stack:
+            self.current_annotation = self.annotation_stack[-1][0]
+        else:
+            self.current_annotation = None
+    def finish( self ):
+        """Close any annotation spans still open at the end of the thread
+        
+        Generator calls which were still suspended are recorded as ending 
+        when they last yielded.
+        """
+        cdef CallInfo call_info
+        cdef Annotation note
+        cdef uint32_t stop = self.stop
+        if self.runs and self.runs[-1] > stop:
+            stop = self.runs[-1]
+        while self.annotation_stack:
+            note,start,start_index = self.annotation_stack.pop()
+            note.record_span( self.thread, start, stop, start_index, -1 )
+        self.current_annotation = None
+        for calls in self.suspended.values():
+            for call_info in calls:
+                self.finish_call( 
+                    call_info, call_info.suspend_start, -1, call_info.cpu_suspend_start,
+                )
+        self.suspended = {}
+        
+    cdef FunctionInfo thread_function( self, FunctionInfo function_info ):
+        """Retrieve (creating if necessary) our per-thread copy of function_info
+        
+        returns None unless the loader's thread_functions is set
+        """
+        cdef FunctionInfo local
+        if not self.loader.thread_functions:
+            return None
+        local = self.functions.get( function_info.key )
+        if local is None:
+            self.functions[function_info.key] = local = function_info.scoped_copy()
+        return local
         
     cdef push( self, FunctionInfo function_info, uint32_t timestamp, long index ):
         """Push a new record onto the function stack"""
         call_info = CallInfo( function_info, timestamp, index, self.thread )
+        call_info.cpu_start = call_info.cpu_resumed = self.cpu
         self.function_stack.append( call_info )
         if function_info.key in function_info.loader.individual_calls:
             self.individual_calls += 1
@@ -203,31 +317,200 @@ cdef class Stack:
         # TODO: allow annotation to decide what to do with events...
         if self.current_annotation is not None:
             self.current_annotation.children.append( call_info )
+            call_info.annotation = self.current_annotation
     cdef pop( self, uint32_t timestamp, long index ):
         """Pop a single record from the stack at given timestamp"""
         cdef CallInfo call_info 
-        cdef uint32_t current_function 
+        cdef CallInfo parent
+        cdef uint32_t segment
+        cdef long long cpu_segment
         
+        if not self.function_stack:
+            # return from a call which began before the (recorded) trace
+            return
         call_info = <CallInfo>(self.function_stack[-1])
-        call_info.record_line( call_info.function.line, timestamp )
-        current_function = call_info.function.key 
-        child_delta = call_info.record_stop( timestamp, index )
+        self.record_line( call_info, call_info.function.line, timestamp )
+        segment = timestamp - call_info.resumed
+        cpu_segment = self.cpu_segment( call_info )
+        self.finish_call( call_info, timestamp, index, self.cpu )
         self.stop = timestamp
 
-        if current_function in call_info.function.loader.individual_calls:
+        if call_info.function.key in call_info.function.loader.individual_calls:
             self.individual_calls -= 1
         
         del self.function_stack[-1]
         if self.function_stack:
-            call_info = self.function_stack[-1]
-            # child is current_function...
-            call_info.record_stop_child( child_delta, current_function )
+            parent = <CallInfo>self.function_stack[-1]
+            parent.record_child_memory( call_info )
+            if self.loader.latency_edges:
+                parent.function.record_edge_latency( 
+                    call_info, timestamp - call_info.start - call_info.suspended_time,
+                )
+        self.record_child( call_info, segment, cpu_segment )
+    
+    cdef suspend( self, uint32_t timestamp, long index ):
+        """Suspend the current (generator) call, which yielded at timestamp
+        
+        The call is moved from the stack to :py:attr:`suspended` until it is 
+        resumed, the time it ran since being (re)started is attributed to the 
+        caller as child time.
+        """
+        cdef CallInfo call_info 
+        cdef uint32_t segment
+        cdef long long cpu_segment
+        if not self.function_stack:
+            return
+        call_info = <CallInfo>(self.function_stack[-1])
+        segment = timestamp - call_info.resumed
+        cpu_segment = self.cpu_segment( call_info )
+        call_info.suspend_start = timestamp
+        call_info.cpu_suspend_start = self.cpu
+        self.stop = timestamp
+        if call_info.function.key in call_info.function.loader.individual_calls:
+            self.individual_calls -= 1
+        del self.function_stack[-1]
+        self.suspended.setdefault( call_info.function.key, [] ).append( call_info )
+        self.record_child( call_info, segment, cpu_segment )
+    
+    cdef resume( self, FunctionInfo function_info, uint32_t timestamp, long index ):
+        """Resume a suspended (generator) call of function_info
+        
+        Suspended calls are matched by function (most recently suspended 
+        first), so the resumed frames form a single logical call whose time 
+        excludes the time it spent suspended.  Generators started before the 
+        trace (or in another thread) are treated as a new call.
+        """
+        cdef list suspended = self.suspended.get( function_info.key )
+        cdef CallInfo call_info 
+        cdef uint32_t gap
+        if not suspended:
+            self.push( function_info, timestamp, index )
+            return
+        call_info = <CallInfo>suspended.pop()
+        gap = timestamp - call_info.suspend_start
+        call_info.suspended_time += gap
+        # the yield line continues after the resume...
+        call_info.last_line_time += gap
+        call_info.resumed = timestamp
+        if call_info.cpu_suspend_start >= 0 and self.cpu >= call_info.cpu_suspend_start:
+            call_info.cpu_suspended += self.cpu - call_info.cpu_suspend_start
+        call_info.cpu_resumed = self.cpu
+        if function_info.key in function_info.loader.individual_calls:
+            self.individual_calls += 1
+        self.function_stack.append( call_info )
+    
+    cdef exception( self, FunctionInfo function_info ):
+        """Record that a call to function_info exited by raising an exception
+        
+        The exception is scoped to the annotation of the call (on top of the 
+        stack) as the call's time is, not to the annotation current when it 
+        raised.
+        """
+        cdef FunctionInfo local
+        cdef CallInfo call_info
+        function_info.exceptions += 1
+        local = self.thread_function( function_info )
+        if local is not None:
+            local.exceptions += 1
+        if not self.function_stack:
+            return
+        call_info = self.function_stack[-1]
+        if call_info.function.key == function_info.key and call_info.annotation is not None:
+            local = call_info.annotation.scoped_function( function_info )
+            local.exceptions += 1
+    
+    cdef long long cpu_segment( self, CallInfo call_info ):
+        """CPU time since call_info was (re)started, -1 if not recorded"""
+        if call_info.cpu_resumed >= 0 and self.cpu >= call_info.cpu_resumed:
+            return self.cpu - call_info.cpu_resumed
+        return -1
+    
+    cdef finish_call( self, CallInfo call_info, uint32_t timestamp, long index, long long cpu ):
+        """Record the totals for a finished call"""
+        cdef FunctionInfo local
+        cdef Annotation note
+        cdef long long cpu_delta = -1
+        cdef uint32_t delta = call_info.record_stop( timestamp, index )
+        if call_info.cpu_start >= 0 and cpu >= call_info.cpu_start + call_info.cpu_suspended:
+            call_info.cpu_stop = cpu
+            cpu_delta = cpu - call_info.cpu_start - call_info.cpu_suspended
+            call_info.function.record_cpu( cpu_delta )
+        local = self.thread_function( call_info.function )
+        if local is not None:
+            local.record_call( call_info.start )
+            local.record_time_spent( delta )
+            local.record_memory( call_info )
+            if cpu_delta >= 0:
+                local.record_cpu( cpu_delta )
+        note = call_info.annotation
+        if note is not None:
+            local = note.scoped_function( call_info.function )
+            local.record_call( call_info.start )
+            local.record_time_spent( delta )
+            local.record_memory( call_info )
+            if cpu_delta >= 0:
+                local.record_cpu( cpu_delta )
+    
+    cdef record_child( self, CallInfo child, uint32_t delta, long long cpu_delta ):
+        """Attribute time child ran (delta) to the call now on top of the stack"""
+        cdef CallInfo call_info
+        cdef FunctionInfo local
+        cdef Annotation note = child.annotation
+        cdef uint32_t current_function = child.function.key
+        if not self.function_stack:
+            return
+        call_info = self.function_stack[-1]
+        # child is current_function...
+        call_info.record_stop_child( delta, current_function )
+        local = self.thread_function( call_info.function )
+        if local is not None:
+            local.record_time_spent_child( current_function, delta )
+        if note is not None and call_info.annotation is note:
+            note.scoped_function( call_info.function ).record_time_spent_child(
+                current_function, delta
+            )
+        if cpu_delta >= 0:
+            call_info.function.record_cpu_child( current_function, cpu_delta )
+            if local is not None:
+                local.record_cpu_child( current_function, cpu_delta )
+            if note is not None and call_info.annotation is note:
+                note.scoped_function( call_info.function ).record_cpu_child(
+                    current_function, cpu_delta
+                )
     
     cdef line( self, FunctionInfo function_info, uint32_t timestamp, uint16_t line ):
         """Record a line event into the stack trace"""
-        cdef CallInfo call_info = self.function_stack[-1]
+        cdef CallInfo call_info
+        if not self.function_stack:
+            return 0
+        call_info = self.function_stack[-1]
         if call_info.function.key == function_info.key:
-            return call_info.record_line( line, timestamp )
+            return self.record_line( call_info, line, timestamp )
+    cdef memory( self, long long delta ):
+        """Record memory allocated (positive) or freed (negative) by the current call"""
+        cdef CallInfo call_info
+        cdef FunctionInfo local
+        if not self.function_stack:
+            return 
+        call_info = self.function_stack[-1]
+        call_info.record_memory( delta )
+        if call_info.last_line_time != call_info.start:
+            local = self.thread_function( call_info.function )
+            if local is not None:
+                local.record_line_memory( call_info.last_line, delta )
+    cdef uint32_t record_line( self, CallInfo call_info, uint16_t line, uint32_t timestamp ):
+        """Record the end of call_info's current line, attributing it to the thread/current annotation"""
+        cdef FunctionInfo local
+        cdef uint16_t previous = call_info.last_line
+        cdef uint32_t delta = call_info.record_line( line, timestamp )
+        local = self.thread_function( call_info.function )
+        if local is not None:
+            local.record_line_time( previous, delta )
+        if self.current_annotation is not None:
+            self.current_annotation.scoped_function( call_info.function ).record_line_time( 
+                previous, delta 
+            )
+        return delta
 
 cdef class FileInfo:
     """Referenced by functions which declare the same file
@@ -253,6 +536,123 @@ cdef class FileInfo:
         return '<%s for %s>'%( self.__class__.__name__, self.filename )
     __repr__ = __unicode__
 
+# latency histograms: durations below 8 timer units are counted exactly, 
+# above that each power of two is split into 8 sub-buckets (~12% precision)
+LATENCY_BUCKETS = 240
+# number of slowest calls retained (for drill-down) in each histogram
+SLOWEST_CALLS = 5
+
+cdef inline int latency_bucket( uint32_t value ):
+    """Bucket into which the given duration falls"""
+    cdef int shift = 0
+    if value < 8:
+        return value
+    while value >= 16:
+        value >>= 1
+        shift += 1
+    return (shift + 1) * 8 + (value - 8)
+
+def bucket_of( uint32_t value ):
+    """Bucket into which the given duration (timer units) falls"""
+    return latency_bucket( value )
+
+def bucket_bounds( int bucket ):
+    """(lowest,highest) duration (timer units) counted in the given bucket"""
+    cdef int shift
+    if bucket < 8:
+        return bucket, bucket
+    shift = bucket // 8 - 1
+    lowest = (8 + bucket % 8) << shift
+    return lowest, lowest + (1 << shift) - 1
+
+cdef class LatencyHistogram:
+    """Log-bucketed (HDR-style) histogram of call durations
+    
+    Uses a fixed number of counters, whatever the number of calls.
+    
+    Attributes:
+    
+        count -- number of calls recorded
+        
+        min, max -- shortest/longest duration recorded (timer units)
+        
+        slowest -- [(duration,call_file,start_index,thread),...] for the 
+            SLOWEST_CALLS longest calls, longest first, call_file is the 
+            index of the loader's call file in which the call started
+    """
+    def __cinit__( self ):
+        self.count = 0
+        self.min = 0
+        self.max = 0
+        self.slowest = []
+        self.slowest_floor = 0
+    cdef record( self, uint32_t delta, uint16_t thread, long call_file, long index ):
+        """Record a call of duration delta"""
+        self.counts[latency_bucket( delta )] += 1
+        self.count += 1
+        if delta > self.max:
+            self.max = delta
+        if delta < self.min or self.count == 1:
+            self.min = delta
+        if delta > self.slowest_floor or len( self.slowest ) < SLOWEST_CALLS:
+            self.add_slowest( delta, call_file, index, thread )
+    def add_slowest( self, uint32_t delta, long call_file, long index, uint16_t thread ):
+        """Consider a call for the slowest calls"""
+        self.slowest.append( (delta,call_file,index,thread) )
+        self.slowest.sort( reverse=True )
+        del self.slowest[SLOWEST_CALLS:]
+        if len( self.slowest ) >= SLOWEST_CALLS:
+            self.slowest_floor = self.slowest[-1][0]
+    def add( self, int bucket, long count ):
+        """Add count calls to bucket (e.g. when restoring from a cache)"""
+        if bucket < 0 or bucket >= LATENCY_BUCKETS:
+            raise ValueError( 'Latency bucket %s out of range'%( bucket, ))
+        self.counts[bucket] += count
+        self.count += count
+    def merge( self, LatencyHistogram other ):
+        """Add the calls recorded in other to our own"""
+        cdef int i
+        for i in range( LATENCY_BUCKETS ):
+            self.counts[i] += other.counts[i]
+        if other.count:
+            if other.max > self.max:
+                self.max = other.max
+            if other.min < self.min or not self.count:
+                self.min = other.min
+        self.count += other.count
+        for record in other.slowest:
+            self.add_slowest( *record )
+    def buckets( self ):
+        """Non-empty buckets as [(bucket,count),...]"""
+        cdef int i
+        return [
+            (i,self.counts[i]) for i in range( LATENCY_BUCKETS )
+            if self.counts[i]
+        ]
+    def percentile( self, double percent ):
+        """Duration (timer units) below which percent of the calls fall
+        
+        Reports the highest duration of the bucket holding the percentile 
+        (within ~12% of the true value), never more than max.
+        """
+        cdef int i
+        cdef long seen = 0
+        cdef long target
+        if not self.count:
+            return 0
+        target = <long>(percent / 100.0 * self.count + .999999)
+        if target < 1:
+            target = 1
+        for i in range( LATENCY_BUCKETS ):
+            seen += self.counts[i]
+            if seen >= target:
+                return min( bucket_bounds( i )[1], self.max )
+        return self.max
+    def __repr__( self ):
+        return '<%s %s calls p50=%s max=%s>'%(
+            self.__class__.__name__, self.count, self.percentile( 50 ), self.max,
+        )
+
 cdef class FunctionInfo:
     """Represents call/trace information for a single function
     
@@ -283,6 +683,27 @@ cdef class FunctionInfo:
         first_timestamp -- timestamp of the first call to the function
         
         last_timestamp -- timestamp of the last call to the function
+        
+        allocated/freed -- bytes allocated/freed during calls to the function 
+            (including children), only recorded for profiles with memory 
+            events
+        
+        local_allocated/local_freed -- bytes allocated/freed while the 
+            function itself was running
+        
+        cpu_time -- cumulative thread CPU time spent in the function (in 
+            the loader's cpu_timer_unit), only recorded for profiles with 
+            CPU time
+        
+        cpu_child_time -- cumulative thread CPU time spent in children
+        
+        exceptions -- number of calls which exited by raising an exception
+        
+        latency -- LatencyHistogram of the durations of the calls (None 
+            until the first call finishes, only for whole-profile totals)
+        
+        edge_latency -- child_id: LatencyHistogram of calls to the child 
+            (when the loader's latency_edges is set)
     
     All times/timestamps are stored in the original profiler units.
     """
@@ -305,6 +726,12 @@ cdef class FunctionInfo:
         self.child_time = 0
         self.first_timestamp = 0
         self.last_timestamp = 0
+        self.allocated = self.freed = 0
+        self.local_allocated = self.local_freed = 0
+        self.cpu_time = self.cpu_child_time = 0
+        self.exceptions = 0
+        self.latency = None
+        self.edge_latency = {}
     
     # external data-API showing seconds 
     @property 
@@ -332,6 +759,79 @@ cdef class FunctionInfo:
         """Average cumulative time in seconds per call"""
         return self.cumulative / (self.calls or 1 )
     
+    @property 
+    def cpu( self ):
+        """Cumulative CPU time in seconds"""
+        return self.cpu_time * self.loader.cpu_timer_unit
+    @property 
+    def cpu_local( self ):
+        """CPU time in seconds spent in the function itself"""
+        if self.cpu_time > self.cpu_child_time:
+            return (self.cpu_time - self.cpu_child_time) * self.loader.cpu_timer_unit
+        return 0.0
+    @property 
+    def cpuPer( self ):
+        """Average cumulative CPU time in seconds per call"""
+        return self.cpu / (self.calls or 1)
+    @property 
+    def waiting( self ):
+        """Cumulative time in seconds not spent on the CPU (blocked, waiting for the GIL, etc)"""
+        if not self.cpu_time:
+            return 0.0
+        return max( (0.0, self.cumulative - self.cpu) )
+    @property 
+    def allocatedPer( self ):
+        """Average bytes allocated per call (including children)"""
+        return self.allocated // (self.calls or 1)
+    @property 
+    def net_allocated( self ):
+        """Bytes allocated and not freed during calls (including children)"""
+        return self.allocated - self.freed
+    
+    def percentile( self, double percent ):
+        """Duration in seconds below which percent of the calls fell"""
+        if self.latency is None:
+            return 0.0
+        return self.latency.percentile( percent ) * self.loader.timer_unit
+    @property 
+    def p50( self ):
+        """Median call duration in seconds"""
+        return self.percentile( 50 )
+    @property 
+    def p90( self ):
+        return self.percentile( 90 )
+    @property 
+    def p99( self ):
+        return self.percentile( 99 )
+    @property 
+    def slowest( self ):
+        """Duration of the slowest call in seconds"""
+        if self.latency is None:
+            return 0.0
+        return self.latency.max * self.loader.timer_unit
+    @property 
+    def slowest_index( self ):
+        """Index (in its call file) of the slowest call's start event, -1 if unknown"""
+        if self.latency is None or not self.latency.slowest:
+            return -1
+        return self.latency.slowest[0][2]
+    @property 
+    def slowest_file( self ):
+        """Index (in Loader.call_files) of the slowest call's call file, -1 if unknown"""
+        if self.latency is None or not self.latency.slowest:
+            return -1
+        return self.latency.slowest[0][1]
+    @property 
+    def slowest_calls( self ):
+        """[(seconds,call_file,start_index,thread),...] for the slowest calls"""
+        if self.latency is None:
+            return []
+        timer_unit = self.loader.timer_unit
+        return [
+            (delta * timer_unit, call_file, index, thread)
+            for (delta,call_file,index,thread) in self.latency.slowest
+        ]
+    
     @property 
     def lineno( self ):
         return self.line 
@@ -368,6 +868,15 @@ cdef class FunctionInfo:
             return other.cumulative/float(self.cumulative)
         return other.cumulative
     # Internal APIs for Loader
+    cdef FunctionInfo scoped_copy( self ):
+        """Create an empty FunctionInfo for the same function (for per-thread/annotation totals)"""
+        return FunctionInfo( self.key, self.module, self.name, self.file, self.line, self.loader )
+    cdef record_line_time( self, uint16_t line, uint32_t delta ):
+        """Record time spent on a given line of the function"""
+        cdef FunctionLineInfo current = self.line_map.get( line, None )
+        if current is None:
+            self.line_map[line] = current = FunctionLineInfo( line )
+        current.add_time( delta, 0 )
     cdef record_call( self, uint32_t timestamp ):
         """Increment our internal call counter and first/last timestamp"""
         self.calls += 1
@@ -385,6 +894,40 @@ cdef class FunctionInfo:
             self.child_time += delta 
         current = self.child_map.get( child, 0 )
         self.child_map[child] = current + delta
+    cdef record_memory( self, CallInfo call_info ):
+        """Record the memory allocated/freed by a (finished) call"""
+        self.allocated += call_info.allocated
+        self.freed += call_info.freed
+        self.local_allocated += call_info.local_allocated
+        self.local_freed += call_info.local_freed
+    cdef record_cpu( self, long long delta ):
+        """Record total CPU time spent in the function"""
+        self.cpu_time += delta
+    cdef record_cpu_child( self, uint32_t child, long long delta ):
+        """Record CPU time spent in a child function"""
+        if child != self.key:
+            self.cpu_child_time += delta
+    cdef record_line_memory( self, uint16_t line, long long delta ):
+        """Record memory allocated/freed on a given line of the function"""
+        cdef FunctionLineInfo current = self.line_map.get( line, None )
+        if current is None:
+            self.line_map[line] = current = FunctionLineInfo( line )
+        current.add_memory( delta )
+    cdef record_latency( self, CallInfo call_info, uint32_t delta ):
+        """Record the duration of a finished call in our histogram"""
+        if self.latency is None:
+            self.latency = LatencyHistogram()
+        self.latency.record( 
+            delta, call_info.thread, call_info.call_file, call_info.start_index,
+        )
+    cdef record_edge_latency( self, CallInfo child, uint32_t delta ):
+        """Record the duration of a finished call we made to child"""
+        cdef LatencyHistogram histogram = self.edge_latency.get( child.function.key )
+        if histogram is None:
+            self.edge_latency[child.function.key] = histogram = LatencyHistogram()
+        histogram.record( 
+            delta, child.thread, child.call_file, child.start_index,
+        )
     
     def __repr__( self ):
         return '<%s %s:%s %s:%ss>'%(
@@ -401,11 +944,19 @@ cdef class FunctionLineInfo:
         self.line = line 
         self.time = 0
         self.calls = 0
+        self.allocated = 0
+        self.freed = 0
     cdef add_time( self, uint32_t delta, int exit ):
         """Add time spent on the line"""
         self.time += delta 
         if not exit:
             self.calls += 1
+    cdef add_memory( self, long long delta ):
+        """Add memory allocated (positive) or freed (negative) on the line"""
+        if delta > 0:
+            self.allocated += delta
+        else:
+            self.freed -= delta
     def __repr__( self ):
         return b'Line %s: %s %.4fs'%( self.line, self.calls, self.time, )
 
@@ -416,15 +967,26 @@ cdef class CallInfo:
     so that the CallInfo records are available
     
     Otherwise is just used by the stack to track calls during initial loading.
+    
+    call_file and start_index locate the call's event (the call may return 
+    in a later call file when the profile is segmented)
     """
     def __init__( self, FunctionInfo function, uint32_t start, long start_index, uint16_t thread ):
         self.function = function 
         self.thread = thread
         self.last_line_time = self.stop = self.start = start 
         self.last_line = function.line
+        self.call_file = function.loader.call_file
         self.start_index = start_index
         self.stop_index = start_index
         self._children = None
+        self.allocated = self.freed = 0
+        self.local_allocated = self.local_freed = 0
+        self.cpu_start = self.cpu_stop = -1
+        self.resumed = self.suspend_start = start
+        self.suspended_time = 0
+        self.cpu_resumed = self.cpu_suspend_start = -1
+        self.cpu_suspended = 0
     def __repr__( self ):
         return '<%s for %s at index %s %ss:%ss>'%(
             self.__class__.__name__,
@@ -435,29 +997,52 @@ cdef class CallInfo:
         )
     cdef public uint32_t record_stop( self, uint32_t stop, long stop_index ):
         """Record a stop event (call has stopped) event"""
-        cdef uint32_t delta = stop - self.start 
+        cdef uint32_t delta = stop - self.start - self.suspended_time
         self.stop = stop
         self.stop_index = stop_index
         self.function.record_call(self.start)
         self.function.record_time_spent( delta )
+        self.function.record_memory( self )
+        self.function.record_latency( self, delta )
         return delta
     cdef public uint32_t record_stop_child( self, uint32_t delta, uint32_t child ):
         """Child has exited, record time spent in the child"""
         self.function.record_time_spent_child( child, delta )
         
+    cdef record_memory( self, long long delta ):
+        """Record memory allocated/freed while this call was running (on its current line)"""
+        if delta > 0:
+            self.allocated += delta
+            self.local_allocated += delta
+        else:
+            self.freed -= delta
+            self.local_freed -= delta
+        if self.last_line_time != self.start:
+            # only once we have seen line events (i.e. line tracing is on)
+            self.function.record_line_memory( self.last_line, delta )
+    cdef record_child_memory( self, CallInfo child ):
+        """Child has exited, include its memory in our (cumulative) totals"""
+        self.allocated += child.allocated
+        self.freed += child.freed
     cdef uint32_t record_line( self, uint16_t new_line, uint32_t stop ):
         """Record time spent on a given line"""
-        cdef FunctionLineInfo current = self.function.line_map.get( self.last_line, None )
         cdef uint32_t delta = stop-self.last_line_time
-        if current is None:
-            self.function.line_map[self.last_line] = current = FunctionLineInfo( self.last_line )
-        current.add_time( delta, 0 )
+        self.function.record_line_time( self.last_line, delta )
         self.last_line = new_line 
         self.last_line_time = stop 
         return delta
     @property 
     def time( self ):
-        return self.stop - self.start 
+        """Time the call was running (excluding time suspended, for generators)"""
+        return self.stop - self.start - self.suspended_time
+    @property 
+    def cpu( self ):
+        """CPU time in seconds for the call (0.0 if not recorded)"""
+        if self.cpu_start >= 0 and self.cpu_stop >= self.cpu_start:
+            return (
+                self.cpu_stop - self.cpu_start - self.cpu_suspended
+            ) * self.function.loader.cpu_timer_unit
+        return 0.0
     @property 
     def empty( self ):
         if self.time > self.child_time:
@@ -670,5 +1255,41 @@ cdef class ModuleInfo( PackageInfo ):
         return []
 
 cdef class Annotation( Grouping ):
-    """Grouping of calls/records with a given annotation"""
+    """Grouping of calls/records with a given annotation
+    
+    Attributes:
+    
+        key/name -- the annotation value
+        
+        children -- CallInfo records for every call started while this 
+            annotation was the current annotation (of its thread)
+        
+        functions -- id:FunctionInfo records with the function/line totals 
+            for calls/lines run while this annotation was current
+        
+        spans -- [(thread,start,stop,start_index,stop_index),...] for each 
+            time the annotation was pushed onto (and popped from) a thread's 
+            annotation stack, stop_index is -1 if it was never popped
+    """
+    def __init__( self, key, str name, LoaderInfo loader ):
+        Grouping.__init__( self, key, name, loader )
+        self.functions = {}
+        self.spans = []
+    cdef FunctionInfo scoped_function( self, FunctionInfo function_info ):
+        """Retrieve (creating if necessary) our copy of function_info"""
+        cdef FunctionInfo local = self.functions.get( function_info.key )
+        if local is None:
+            self.functions[function_info.key] = local = function_info.scoped_copy()
+        return local
+    cdef record_span( self, uint16_t thread, uint32_t start, uint32_t stop, long start_index, long stop_index ):
+        """Record a single (closed) span of the annotation"""
+        self.spans.append( (thread,start,stop,start_index,stop_index) )
+    def calculate_totals( self ):
+        """Calculate our totals from our spans"""
+        self.calls = len( self.spans )
+        self.cumulative = sum([ span[2]-span[1] for span in self.spans ], 0) * self.loader.timer_unit
+        self.cumulativePer = self.cumulative / float( self.calls or 1 )
+    def rows( self ):
+        """Produce the set of all (per-annotation) function rows"""
+        return self.functions.values()
     
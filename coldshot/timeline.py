@@ -0,0 +1,211 @@
+"""Per-thread run timelines and GIL contention analysis
+
+The events in a (shared) calls file are written while the writing thread
+holds the GIL, so the interleaving of thread ids in the event stream shows
+which thread was running when.  The :py:class:`coldshot.loader.Loader`
+records each thread's "runs" (intervals between switching to and away from
+the thread) in :py:attr:`coldshot.stack.Stack.runs`, from which this module
+calculates:
+
+    busy -- time during which the thread was running
+
+    others -- time during the thread's lifetime during which other threads
+        were running (i.e. the GIL was held by others)
+
+    switches -- number of times the thread was switched back in
+
+Profiles recorded with ``per_thread=True`` have no shared event stream, so
+each data-file appears as a single run of its thread and the busy/others
+figures only reflect the thread lifetimes.
+
+.. code:: python
+
+    from coldshot import loader, timeline
+    info = loader.Loader( 'test.profile' ).load()
+    print timeline.Timeline( info ).report()
+"""
+import bisect
+
+__all__ = ('Timeline','ThreadTimeline')
+
+class ThreadTimeline( object ):
+    """Timeline of the runs of a single thread (times in seconds)
+
+    Attributes:
+
+        thread -- 16-bit thread id
+
+        runs -- [(start,stop),...] timer-unit timestamps of each run
+
+        start/stop -- first and last timestamp for the thread (seconds)
+
+        busy -- time spent running
+
+        others -- time within start/stop during which other threads ran
+
+        switches -- number of context switches back into the thread
+    """
+    def __init__( self, stack, timer_unit ):
+        self.thread = stack.thread
+        runs = stack.runs
+        self.runs = list( zip( runs[::2], runs[1::2] ))
+        self.timer_unit = timer_unit
+        self.switches = stack.context_switches
+        if self.runs:
+            self.first = self.runs[0][0]
+            self.last = self.runs[-1][1]
+        else:
+            self.first = self.last = stack.start
+        self.busy_raw = sum([ stop-start for (start,stop) in self.runs ], 0)
+        self.others_raw = 0
+    @property
+    def start( self ):
+        return self.first * self.timer_unit
+    @property
+    def stop( self ):
+        return self.last * self.timer_unit
+    @property
+    def duration( self ):
+        return (self.last - self.first) * self.timer_unit
+    @property
+    def busy( self ):
+        return self.busy_raw * self.timer_unit
+    @property
+    def others( self ):
+        return self.others_raw * self.timer_unit
+    @property
+    def waiting( self ):
+        """Time within our lifetime during which we were not running"""
+        return max( (0.0, self.duration - self.busy) )
+    def __repr__( self ):
+        return '<%s %s busy=%0.6fs others=%0.6fs switches=%s>'%(
+            self.__class__.__name__, self.thread, self.busy, self.others, self.switches,
+        )
+
+class Timeline( object ):
+    """Timeline of all threads in a loaded profile
+
+    info -- :py:class:`coldshot.stack.LoaderInfo` from a full load
+    """
+    def __init__( self, info ):
+        self.info = info
+        self.threads = [
+            ThreadTimeline( stack, info.timer_unit )
+            for (key,stack) in sorted( info.threads.items() )
+        ]
+        runs = []
+        for thread in self.threads:
+            runs.extend( thread.runs )
+        runs.sort()
+        self.starts = [start for (start,stop) in runs]
+        self.stops = [stop for (start,stop) in runs]
+        # prefix sums of run durations for range queries...
+        self.totals = [0]
+        for start,stop in runs:
+            self.totals.append( self.totals[-1] + (stop-start) )
+        for thread in self.threads:
+            thread.others_raw = max( (0, self.busy_between( thread.first, thread.last ) - thread.busy_raw ))
+        if runs:
+            self.first = min( self.starts )
+            self.last = max( self.stops )
+        else:
+            self.first = self.last = 0
+
+    def busy_between( self, start, stop ):
+        """Total run time of all threads within [start,stop] (timer units)"""
+        # runs do not overlap, as they are derived from a single serial stream
+        low = bisect.bisect_left( self.stops, start )
+        high = bisect.bisect_right( self.starts, stop )
+        if high <= low:
+            return 0
+        total = self.totals[high] - self.totals[low]
+        # clip the partially-covered runs at either end
+        if self.starts[low] < start:
+            total -= min( (start,self.stops[low]) ) - self.starts[low]
+        if self.stops[high-1] > stop:
+            total -= self.stops[high-1] - max( (stop,self.starts[high-1]) )
+        return max( (0,total) )
+
+    def buckets( self, thread, count ):
+        """Calculate busy fraction of thread for count equal time-buckets"""
+        span = float( (self.last - self.first) or 1 )
+        result = [0.0] * count
+        width = span / count
+        for start,stop in thread.runs:
+            position = start
+            while position < stop:
+                index = min( (int( (position - self.first) / width ), count-1) )
+                bucket_end = self.first + (index+1) * width
+                end = min( (stop,bucket_end) )
+                if end <= position:
+                    end = stop
+                result[index] += (end - position) / width
+                position = end
+        return [min( (1.0,value) ) for value in result]
+
+    STRIP = ' .:+#'
+    def strip( self, thread, width=60 ):
+        """ASCII-art strip showing when the thread was running"""
+        characters = self.STRIP
+        return ''.join([
+            characters[int(round( value * (len(characters)-1) ))] if value else characters[0]
+            for value in self.buckets( thread, width )
+        ])
+
+    def report( self, width=60 ):
+        """Produce a textual report with per-thread statistics and strips"""
+        header = '%6s %10s %10s %10s %10s %8s  %s'%(
+            'Thread','Start','Busy','Waiting','Others','Switches','Timeline',
+        )
+        report = [ header, '' ]
+        for thread in self.threads:
+            report.append( '%6d % 10.4f % 10.4f % 10.4f % 10.4f % 8d  |%s|'%(
+                thread.thread, thread.start - self.first * self.info.timer_unit,
+                thread.busy, thread.waiting, thread.others, thread.switches,
+                self.strip( thread, width ),
+            ))
+        return '\n'.join( report )
+
+    def html( self, width=800, row_height=16 ):
+        """Produce a stand-alone HTML document with an SVG timeline"""
+        rows = []
+        label_width = 80
+        for i,thread in enumerate( self.threads ):
+            y = i * row_height
+            rows.append(
+                '<text x="0" y="%d" font-size="%d">%s</text>'%(
+                    y + row_height - 4, row_height - 4, thread.thread,
+                )
+            )
+            for j,value in enumerate( self.buckets( thread, width )):
+                if value:
+                    rows.append(
+                        '<rect x="%d" y="%d" width="1" height="%d" fill="#c03000" fill-opacity="%0.2f"/>'%(
+                            label_width + j, y + 1, row_height - 2, value,
+                        )
+                    )
+        table = [
+            '<tr><td>%s</td><td>%0.4f</td><td>%0.4f</td><td>%0.4f</td><td>%0.4f</td><td>%d</td></tr>'%(
+                thread.thread, thread.duration, thread.busy, thread.waiting,
+                thread.others, thread.switches,
+            )
+            for thread in self.threads
+        ]
+        return '\n'.join([
+            '<!DOCTYPE html>',
+            '<html><head><title>Coldshot Thread Timeline</title></head><body>',
+            '<h1>Thread Timeline</h1>',
+            '<p>Profile duration: %0.4fs</p>'%(
+                (self.last - self.first) * self.info.timer_unit,
+            ),
+            '<svg width="%d" height="%d">'%(
+                label_width + width, row_height * len(self.threads),
+            ),
+        ] + rows + [
+            '</svg>',
+            '<table border="1"><tr><th>Thread</th><th>Lifetime</th><th>Busy</th>'
+            '<th>Waiting</th><th>Others</th><th>Switches</th></tr>',
+        ] + table + [
+            '</table>',
+            '</body></html>',
+        ])
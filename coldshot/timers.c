@@ -66,3 +66,48 @@ hpTimerUnit(void)
 
 #endif  /* MS_WINDOWS */
 
+
+/*** Per-thread CPU-time clock (for dual wall/CPU clock profiles) ***/
+
+#ifdef MS_WINDOWS
+
+PY_LONG_LONG
+cpuTimer(void)
+{
+        FILETIME creation, exit, kernel, user;
+        if (!GetThreadTimes(GetCurrentThread(), &creation, &exit, &kernel, &user))
+                return -1;
+        return (((PY_LONG_LONG)kernel.dwHighDateTime << 32) | kernel.dwLowDateTime) +
+               (((PY_LONG_LONG)user.dwHighDateTime << 32) | user.dwLowDateTime);
+}
+
+double
+cpuTimerUnit(void)
+{
+        return 0.0000001; /* 100ns FILETIME units */
+}
+
+#else  /* !MS_WINDOWS */
+
+#include <time.h>
+
+PY_LONG_LONG
+cpuTimer(void)
+{
+#if defined(CLOCK_THREAD_CPUTIME_ID)
+        struct timespec ts;
+        if (clock_gettime(CLOCK_THREAD_CPUTIME_ID, &ts) != 0)
+                return -1;
+        return ((PY_LONG_LONG)ts.tv_sec) * 1000000000 + ts.tv_nsec;
+#else
+        return -1;
+#endif
+}
+
+double
+cpuTimerUnit(void)
+{
+        return 0.000000001;
+}
+
+#endif  /* MS_WINDOWS */
@@ -2,3 +2,5 @@
 
 PY_LONG_LONG hpTimer(void);
 double hpTimerUnit(void);
+PY_LONG_LONG cpuTimer(void);
+double cpuTimerUnit(void);
@@ -0,0 +1,495 @@
+"""Local web viewer for Coldshot profiles (``coldshot-serve``)
+
+Serves a profile directory over HTTP, so profiles can be browsed from a
+headless profiling machine without a desktop GUI.  The server is built on
+:py:class:`coldshot.query.Query`: the index is read up-front, the function
+totals are computed (or read from the aggregates cache) in a background
+thread and individual calls are only scanned when asked for.
+
+All sorting, filtering and pagination happens in the server, the browser
+only ever receives a single page of JSON rows:
+
+    /api/status -- loading progress, profile meta-data
+
+    /api/functions?sort=-cumulative&offset=0&limit=50&search=text
+        -- page of the function table (search matches module or name)
+
+    /api/function?key=<id>&limit=50 -- a function's totals with its
+        callers, callees (each with the time spent in the edge) and
+        lines (with source text)
+
+    /api/calls?key=<id>&sort=-duration&offset=0&limit=50 -- page of the
+        individual calls of a function
+
+    /api/children?call_file=&start_index=&stop_index=&thread=&offset=&limit=
+        -- page of the calls made directly by a call
+
+.. code:: bash
+
+    $> coldshot-serve --port=8080 test.profile
+"""
+import json, threading, logging
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+from . import query, reporter
+log = logging.getLogger( __name__ )
+
+__all__ = ('ProfileView','ProfileServer','ProfileHandler','make_server','serve','FUNCTION_COLUMNS','CALL_COLUMNS')
+
+DEFAULT_PAGE = 50
+MAX_PAGE = 500
+
+# columns of the function table (sortable, see reporter.COLUMNS)
+FUNCTION_COLUMNS = (
+    'module','name','filename','line','calls','cumulative','local',
+    'cumulativePer','localPer','exceptions','p50','p99','slowest',
+)
+# sortable columns of the call tables
+CALL_COLUMNS = ('start','duration','thread','start_index')
+
+class NotFound( KeyError ):
+    """Requested function/call is not in the profile"""
+
+class ProfileView( object ):
+    """JSON-compatible (paginated) views of a profile
+
+    directory -- profile directory (as written by the Profiler)
+    use_cache -- read (and write) the aggregates cache, see
+        :py:mod:`coldshot.aggregates`
+
+    Each view method returns a dictionary, pages have the form
+    ``{'total':count,'offset':offset,'limit':limit,'rows':[...]}``
+    """
+    def __init__( self, directory, use_cache=True ):
+        self.directory = directory
+        self.query = query.Query( directory, use_cache=use_cache )
+        self.info = self.query.info
+        self.root = self.info.roots['functions']
+        self.source = reporter.SourceCache()
+        self.source_lock = threading.Lock()
+        self.progress = (0,0)
+    def start( self ):
+        """Start computing the function totals in the background"""
+        return self.query.start( progress=self.on_progress )
+    def on_progress( self, done, total ):
+        self.progress = (done,total)
+
+    def status( self ):
+        """Loading state and profile meta-data"""
+        return {
+            'directory': self.directory,
+            'ready': self.query.ready.is_set(),
+            'error': str( self.query.error ) if self.query.error else None,
+            'progress': list( self.progress ),
+            'timer_unit': self.info.timer_unit,
+            'functions': len( self.info.functions ) - 1,
+            'call_files': len( self.query.loader.call_files ),
+            'columns': FUNCTION_COLUMNS,
+            'call_columns': CALL_COLUMNS,
+        }
+
+    def functions( self, sort='-cumulative', offset=0, limit=DEFAULT_PAGE, search=None ):
+        """Page of the function table
+
+        sort -- column (see :py:data:`FUNCTION_COLUMNS`), prefix with '-' for
+            descending, ties are broken by module and name
+        search -- if provided, only functions whose module or name contain
+            the text are included
+        """
+        column = sort.lstrip( '-' )
+        if column not in FUNCTION_COLUMNS:
+            raise ValueError( 'Unknown function column %r, expected one of %s'%( column, FUNCTION_COLUMNS ))
+        offset,limit = check_page( offset, limit )
+        report = reporter.Reporter(
+            self.query.loader, sort=(sort,'module','name'), limit=offset+limit,
+            columns=FUNCTION_COLUMNS,
+        )
+        rows = [row for row in report.functions() if row[1] is not self.root]
+        if search:
+            rows = [
+                row for row in rows
+                if search in row[1].module or search in row[1].name
+            ]
+        table = report.table( rows, FUNCTION_COLUMNS, report.function_value )
+        return page( len( rows ), offset, limit, [
+            self.function_row( row[1] ) for (row,values) in table[offset:]
+        ])
+    def function_row( self, function ):
+        """Summary of a single function"""
+        result = dict([
+            (name,getattr( function, name, 0 ))
+            for name in FUNCTION_COLUMNS
+        ])
+        result['key'] = function.key
+        return result
+    def get_function( self, key ):
+        """Retrieve the FunctionInfo for key, raise NotFound if not present"""
+        function = self.info.functions.get( int( key ))
+        if function is None or function is self.root:
+            raise NotFound( key )
+        return function
+
+    def function( self, key, limit=DEFAULT_PAGE ):
+        """Totals of a function with its callers, callees and lines
+
+        Callers and callees are sorted by the time spent in the call-edge,
+        the ``limit`` largest of each are reported, lines are in line order.
+        """
+        function = self.get_function( key )
+        limit = check_page( 0, limit )[1]
+        callers = [
+            (parent.child_map[function.key],parent)
+            for parent in self.info.parents_of( function )
+            if parent is not self.root and parent is not function
+        ]
+        callees = [
+            (delta,self.info.functions.get( child ))
+            for (child,delta) in function.child_map.items()
+            if child != function.key
+        ]
+        result = self.function_row( function )
+        result['path'] = function.path
+        result['callers'] = self.edges( callers, limit )
+        result['callees'] = self.edges( callees, limit )
+        result['lines'] = self.lines( function )
+        return result
+    def edges( self, edges, limit ):
+        """Page of call-edges [(delta,function),...] ordered by descending time"""
+        timer_unit = self.info.timer_unit
+        edges = [(delta,other) for (delta,other) in edges if other is not None]
+        edges.sort( key=lambda edge: edge[0], reverse=True )
+        rows = []
+        for delta,other in edges[:limit]:
+            row = self.function_row( other )
+            row['time'] = delta * timer_unit
+            rows.append( row )
+        return page( len( edges ), 0, limit, rows )
+    def lines( self, function ):
+        """Per-line timings for a function, with the line's source"""
+        timer_unit = self.info.timer_unit
+        rows = []
+        with self.source_lock:
+            for line,line_info in sorted( function.line_map.items() ):
+                rows.append( {
+                    'line': line,
+                    'calls': line_info.calls,
+                    'time': line_info.time * timer_unit,
+                    'allocated': line_info.allocated,
+                    'freed': line_info.freed,
+                    'source': self.source.line( function.path, line ),
+                } )
+        return rows
+
+    def calls( self, key, sort='-duration', offset=0, limit=DEFAULT_PAGE ):
+        """Page of the individual calls of a function"""
+        function = self.get_function( key )
+        return self.call_page( self.query.calls( function ), sort, offset, limit )
+    def children( self, call_file, start_index, stop_index, thread, sort='start', offset=0, limit=DEFAULT_PAGE ):
+        """Page of the calls made directly by a call (identified as in a call row)"""
+        call_file = int( call_file )
+        if not 0 <= call_file < len( self.query.loader.call_files ):
+            raise NotFound( call_file )
+        call = query.CallNode(
+            None, int( thread ), call_file, int( start_index ), int( stop_index ), 0, 0,
+        )
+        return self.call_page( self.query.children( call ), sort, offset, limit )
+    def call_page( self, nodes, sort, offset, limit ):
+        """Sort and paginate a list of CallNodes"""
+        column = sort.lstrip( '-' )
+        if column not in CALL_COLUMNS:
+            raise ValueError( 'Unknown call column %r, expected one of %s'%( column, CALL_COLUMNS ))
+        offset,limit = check_page( offset, limit )
+        if column == 'duration':
+            key = lambda node: node.stop - node.start
+        else:
+            key = lambda node: getattr( node, column )
+        nodes = sorted( nodes, key=key, reverse=sort.startswith( '-' ))
+        return page( len( nodes ), offset, limit, [
+            self.call_row( node ) for node in nodes[offset:offset+limit]
+        ])
+    def call_row( self, node ):
+        """Summary of a single call (CallNode)"""
+        timer_unit = self.info.timer_unit
+        return {
+            'key': node.function.key,
+            'module': node.function.module,
+            'name': node.function.name,
+            'thread': node.thread,
+            'call_file': node.call_file,
+            'start_index': node.start_index,
+            'stop_index': node.stop_index,
+            'start': node.start * timer_unit,
+            'duration': node.time * timer_unit,
+            'complete': node.complete,
+            'may_have_children': node.may_have_children,
+        }
+
+def check_page( offset, limit ):
+    """Validate pagination parameters, limit is capped at MAX_PAGE"""
+    offset,limit = int( offset ),int( limit )
+    if offset < 0 or limit < 1:
+        raise ValueError( 'Invalid page offset=%s limit=%s'%( offset, limit ))
+    return offset,min( limit, MAX_PAGE )
+def page( total, offset, limit, rows ):
+    return {'total':total,'offset':offset,'limit':limit,'rows':rows}
+
+class ProfileServer( ThreadingMixIn, HTTPServer ):
+    """HTTP server for a single ProfileView"""
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__( self, address, view ):
+        HTTPServer.__init__( self, address, ProfileHandler )
+        self.view = view
+
+class ProfileHandler( BaseHTTPRequestHandler ):
+    """Serves the viewer page and the JSON API of the server's ProfileView"""
+    # path: (view method, required parameters, optional parameters)
+    ROUTES = {
+        '/api/status': ('status',(),()),
+        '/api/functions': ('functions',(),('sort','offset','limit','search')),
+        '/api/function': ('function',('key',),('limit',)),
+        '/api/calls': ('calls',('key',),('sort','offset','limit')),
+        '/api/children': (
+            'children',
+            ('call_file','start_index','stop_index','thread'),
+            ('sort','offset','limit'),
+        ),
+    }
+    def do_GET( self ):
+        url = urlparse( self.path )
+        if url.path in ('/','/index.html'):
+            return self.respond( 200, PAGE, 'text/html; charset=utf-8' )
+        route = self.ROUTES.get( url.path )
+        if route is None:
+            return self.respond_json( 404, {'error':'Unknown path %s'%( url.path, )} )
+        method,required,optional = route
+        parameters = dict([
+            (name,values[-1])
+            for (name,values) in parse_qs( url.query ).items()
+            if name in required or name in optional
+        ])
+        missing = [name for name in required if name not in parameters]
+        if missing:
+            return self.respond_json( 400, {'error':'Missing parameters: %s'%( ', '.join( missing ), )} )
+        try:
+            result = getattr( self.server.view, method )( **parameters )
+        except NotFound as err:
+            return self.respond_json( 404, {'error':'Not found: %s'%( err.args[0], )} )
+        except ValueError as err:
+            return self.respond_json( 400, {'error':str( err )} )
+        return self.respond_json( 200, result )
+    def respond_json( self, status, result ):
+        return self.respond( status, json.dumps( result ), 'application/json' )
+    def respond( self, status, body, content_type ):
+        if not isinstance( body, bytes ):
+            body = body.encode( 'utf-8' )
+        self.send_response( status )
+        self.send_header( 'Content-Type', content_type )
+        self.send_header( 'Content-Length', str( len( body )))
+        self.send_header( 'Cache-Control', 'no-cache' )
+        self.end_headers()
+        self.wfile.write( body )
+    def log_message( self, format, *args ):
+        log.debug( '%s %s', self.address_string(), format%args )
+
+def make_server( directory, host='127.0.0.1', port=8000, use_cache=True ):
+    """Create a ProfileServer for the profile directory and start loading it
+
+    port -- TCP port on which to listen, 0 to choose a free port (see
+        ``server.server_address``)
+
+    returns ProfileServer, call serve_forever() to handle requests
+    """
+    view = ProfileView( directory, use_cache=use_cache )
+    server = ProfileServer( (host,port), view )
+    view.start()
+    return server
+
+def serve( directory, host='127.0.0.1', port=8000, use_cache=True ):
+    """Serve the profile directory until interrupted"""
+    server = make_server( directory, host, port, use_cache )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Coldshot</title>
+<style>
+body { font-family: sans-serif; font-size: 13px; margin: 1em; }
+table { border-collapse: collapse; margin-bottom: 1em; }
+th { cursor: pointer; background: #eee; text-align: left; }
+td, th { padding: 2px 6px; border-bottom: 1px solid #ddd; }
+td.n { text-align: right; font-family: monospace; }
+tr.link { cursor: pointer; }
+tr.link:hover { background: #ffd; }
+pre { margin: 0; }
+#status { color: #666; }
+</style></head><body>
+<h1>Coldshot <span id="status"></span></h1>
+<div id="main"></div>
+<script>
+var state = {sort: '-cumulative', offset: 0, limit: 50, search: ''};
+function $(id) { return document.getElementById(id); }
+function esc(text) {
+    return String(text).replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;');
+}
+function fmt(value) {
+    return (typeof value == 'number' && value % 1) ? value.toFixed(6) : esc(value);
+}
+function get(path, params, callback) {
+    var query = [];
+    for (var name in params) {
+        query.push(name + '=' + encodeURIComponent(params[name]));
+    }
+    var request = new XMLHttpRequest();
+    request.onload = function() {
+        var result = JSON.parse(request.responseText);
+        if (result.error) { alert(result.error); } else { callback(result); }
+    };
+    request.open('GET', path + '?' + query.join('&'));
+    request.send();
+}
+function table(columns, rows, onclick, onsort) {
+    var html = ['<table><tr>'];
+    columns.forEach(function(column) {
+        html.push('<th data-column="' + column + '">' + column + '</th>');
+    });
+    html.push('</tr>');
+    rows.forEach(function(row, i) {
+        html.push('<tr class="' + (onclick ? 'link' : '') + '" data-row="' + i + '">');
+        columns.forEach(function(column) {
+            var value = row[column];
+            html.push('<td class="' + (typeof value == 'number' ? 'n' : '') + '">' +
+                (column == 'source' ? '<pre>' + esc(value) + '</pre>' : fmt(value)) + '</td>');
+        });
+        html.push('</tr>');
+    });
+    html.push('</table>');
+    var node = document.createElement('div');
+    node.innerHTML = html.join('');
+    if (onclick) {
+        Array.prototype.forEach.call(node.querySelectorAll('tr.link'), function(tr) {
+            tr.onclick = function() { onclick(rows[tr.getAttribute('data-row')]); };
+        });
+    }
+    if (onsort) {
+        Array.prototype.forEach.call(node.querySelectorAll('th'), function(th) {
+            th.onclick = function() { onsort(th.getAttribute('data-column')); };
+        });
+    }
+    return node;
+}
+function pager(result, onpage) {
+    var node = document.createElement('div');
+    var last = Math.min(result.offset + result.limit, result.total);
+    node.innerHTML = (result.offset + 1) + '-' + last + ' of ' + result.total + ' ';
+    [['&laquo; prev', result.offset - result.limit], ['next &raquo;', result.offset + result.limit]].forEach(function(link) {
+        if (link[1] >= 0 && link[1] < result.total) {
+            var a = document.createElement('a');
+            a.href = '#';
+            a.innerHTML = link[0] + ' ';
+            a.onclick = function() { onpage(link[1]); return false; };
+            node.appendChild(a);
+        }
+    });
+    return node;
+}
+function section(title) {
+    var node = document.createElement('div');
+    node.innerHTML = '<h2>' + esc(title) + '</h2>';
+    return node;
+}
+function showFunctions() {
+    get('/api/functions', state, function(result) {
+        var main = $('main');
+        main.innerHTML = '<input id="search" placeholder="search module/name"> ';
+        $('search').value = state.search;
+        $('search').onchange = function() {
+            state.search = this.value; state.offset = 0; showFunctions();
+        };
+        main.appendChild(pager(result, function(offset) { state.offset = offset; showFunctions(); }));
+        main.appendChild(table(COLUMNS, result.rows, function(row) { showFunction(row.key); },
+            function(column) {
+                state.sort = (state.sort == '-' + column) ? column : '-' + column;
+                state.offset = 0;
+                showFunctions();
+            }));
+    });
+}
+function showFunction(key) {
+    get('/api/function', {key: key}, function(result) {
+        var main = $('main');
+        main.innerHTML = '<a href="#" id="back">&laquo; functions</a>';
+        $('back').onclick = function() { showFunctions(); return false; };
+        main.appendChild(section(result.module + '.' + result.name + ' (' + result.path + ':' + result.line + ')'));
+        main.appendChild(table(COLUMNS, [result]));
+        var edgeColumns = ['module', 'name', 'time', 'calls'];
+        [['Callers', result.callers], ['Callees', result.callees]].forEach(function(edges) {
+            main.appendChild(section(edges[0] + ' (' + edges[1].total + ')'));
+            main.appendChild(table(edgeColumns, edges[1].rows, function(row) { showFunction(row.key); }));
+        });
+        main.appendChild(section('Lines'));
+        main.appendChild(table(['line', 'calls', 'time', 'source'], result.lines));
+        var calls = section('Calls');
+        main.appendChild(calls);
+        showCalls(calls, '/api/calls', {key: key, sort: '-duration', offset: 0, limit: 20});
+    });
+}
+function showCalls(node, path, params) {
+    get(path, params, function(result) {
+        var content = document.createElement('div');
+        content.style.marginLeft = '1em';
+        content.appendChild(pager(result, function(offset) {
+            node.removeChild(content);
+            params.offset = offset;
+            showCalls(node, path, params);
+        }));
+        content.appendChild(table(['module', 'name', 'thread', 'start', 'duration', 'complete'], result.rows,
+            function(row) {
+                if (!row.may_have_children) { return; }
+                var children = section('Calls made by ' + row.name + ' at ' + row.start_index);
+                content.appendChild(children);
+                showCalls(children, '/api/children', {
+                    call_file: row.call_file, start_index: row.start_index,
+                    stop_index: row.stop_index, thread: row.thread,
+                    sort: 'start', offset: 0, limit: 20
+                });
+            },
+            function(column) {
+                if (CALL_COLUMNS.indexOf(column) < 0) { return; }
+                params.sort = (params.sort == '-' + column) ? column : '-' + column;
+                params.offset = 0;
+                node.removeChild(content);
+                showCalls(node, path, params);
+            }));
+        node.appendChild(content);
+    });
+}
+var COLUMNS = [], CALL_COLUMNS = [];
+function poll() {
+    get('/api/status', {}, function(status) {
+        COLUMNS = status.columns;
+        CALL_COLUMNS = status.call_columns;
+        if (status.error) {
+            $('status').innerHTML = esc('failed: ' + status.error);
+        } else if (status.ready) {
+            $('status').innerHTML = esc(status.directory);
+            showFunctions();
+        } else {
+            $('status').innerHTML = 'loading ' + status.progress[0] + '/' + status.progress[1];
+            setTimeout(poll, 500);
+        }
+    });
+}
+poll();
+</script></body></html>
+"""
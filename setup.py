@@ -122,6 +122,10 @@ if __name__ == "__main__":
                 'coldshot = coldshot.externals:profile_main',
                 'coldshot-report = coldshot.externals:report_main',
                 'coldshot-events = coldshot.externals:raw_events_main',
+                'coldshot-diff = coldshot.externals:diff_main',
+                'coldshot-timeline = coldshot.externals:timeline_main',
+                'coldshot-index = coldshot.externals:index_main',
+                'coldshot-serve = coldshot.externals:serve_main',
             ]
         },
         **extraArguments
@@ -0,0 +1,281 @@
+"""Benchmark suite for recording overhead and loader throughput
+
+Each workload is run without profiling and under the profiler, and the
+resulting profile is then loaded (in a child process, so that the peak
+memory of the loader can be measured).  For each workload we report:
+
+    slowdown -- profiled/unprofiled wall-clock time (best of --repeat runs)
+    events_per_second -- events recorded per second of profiled time
+    bytes_per_event -- total profile size (data-files and index) per event
+    loader_records_per_second -- records processed per second by the Loader
+    loader_peak_kb -- peak resident memory of the loading process
+
+Results can be written as JSON and compared against a previous run
+(e.g. from the previous commit) to track regressions:
+
+    $ python -m tests.benchmark -o before.json
+    $ python -m tests.benchmark -o after.json
+    $ python -m tests.benchmark --compare before.json after.json
+"""
+import os, sys, time, json, threading, tempfile, shutil, optparse
+import subprocess, runpy
+from coldshot import profiler, controller
+
+HERE = os.path.dirname( os.path.abspath( __file__ ))
+
+def leaf( value ):
+    return value + 1
+def worker( calls ):
+    total = 0
+    values = []
+    for i in range( calls ):
+        total = leaf( total )
+        values.append( total )
+    return total
+
+def threaded( threads=8, calls=20000 ):
+    """Multithreaded workload, many small Python and C calls in each thread"""
+    pool = [
+        threading.Thread( target = worker, args=(calls,) )
+        for i in range( threads )
+    ]
+    for thread in pool:
+        thread.start()
+    # the calling thread takes part as well
+    worker( calls )
+    for thread in pool:
+        thread.join()
+
+def recurse( depth ):
+    if depth:
+        return recurse( depth - 1 ) + 1
+    return 0
+def deep_recursion( depth=500, repeat=200 ):
+    """Deeply nested Python calls"""
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit( max( limit, depth + 100 ))
+    try:
+        for i in range( repeat ):
+            recurse( depth )
+    finally:
+        sys.setrecursionlimit( limit )
+
+def builtin_heavy( count=100000 ):
+    """Mostly calls to builtins (C_CALL/C_RETURN events)"""
+    values = []
+    for i in range( count ):
+        values.append( abs( -i ))
+        len( values )
+    return max( values )
+
+def script( name ):
+    """Create a workload which runs one of our test scripts as __main__"""
+    def run_script():
+        stdout = sys.stdout
+        sys.stdout = open( os.devnull, 'w' )
+        try:
+            runpy.run_path( os.path.join( HERE, name ), run_name='__main__' )
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+    run_script.__doc__ = 'Test script %s'%( name, )
+    return run_script
+
+WORKLOADS = [
+    ('threaded', threaded, {'all_threads': True}),
+    ('deep_recursion', deep_recursion, {}),
+    ('builtin_heavy', builtin_heavy, {}),
+    # cost of measuring callback time, compare with builtin_heavy
+    ('instrumented', builtin_heavy, {'instrument': True}),
+    ('errors_script', script( 'errors.py' ), {}),
+    ('threaded_script', script( 'threadedscript.py' ), {'all_threads': True}),
+]
+# metrics compared when tracking regressions (others are informational)
+LOWER_IS_BETTER = ('slowdown','bytes_per_event','loader_peak_kb')
+HIGHER_IS_BETTER = ('events_per_second','loader_records_per_second')
+
+LOAD_SCRIPT = """
+import os, sys, time, json, resource
+from coldshot import loader
+load = loader.Loader( sys.argv[1] )
+start = time.time()
+load.load()
+duration = time.time() - start
+records = sum([ os.path.getsize( f ) for f in load.call_files if os.path.exists( f )], 0)//12
+json.dump( {
+    'seconds': duration,
+    'records': records,
+    'peak_kb': resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss,
+}, sys.stdout )
+"""
+
+def timed( function, directory=None, **named ):
+    """Run function (under a Profiler writing to directory if given)
+
+    returns (seconds,profiler or None)
+    """
+    if directory is None:
+        start = time.time()
+        function()
+        return time.time() - start, None
+    prof = profiler.Profiler( directory, **named )
+    start = time.time()
+    with prof:
+        function()
+    duration = time.time() - start
+    prof.close()
+    return duration, prof
+
+def load_stats( directory ):
+    """Load the profile in directory in a child process, returns stats dictionary"""
+    output = subprocess.check_output(
+        [sys.executable, '-c', LOAD_SCRIPT, directory],
+        cwd = os.path.dirname( HERE ),
+    )
+    return json.loads( output )
+
+def measure( function, repeat=3, lines=False, **named ):
+    """Measure a single workload, returns a dictionary of metrics"""
+    baseline = min([ timed( function )[0] for i in range( repeat )])
+    best = None
+    for i in range( repeat ):
+        directory = tempfile.mkdtemp( prefix='coldshot-bench' )
+        duration,prof = timed( function, directory, lines=lines, **named )
+        if best is None or duration < best[0]:
+            if best is not None:
+                shutil.rmtree( best[2], True )
+            best = (duration,prof.events,directory)
+        else:
+            shutil.rmtree( directory, True )
+    duration,events,directory = best
+    try:
+        size = controller.directory_size( directory )
+        loaded = load_stats( directory )
+    finally:
+        shutil.rmtree( directory, True )
+    return {
+        'baseline_seconds': baseline,
+        'profiled_seconds': duration,
+        'slowdown': duration / (baseline or 1e-9),
+        'events': events,
+        'events_per_second': events / (duration or 1e-9),
+        'bytes_per_event': size / float( events or 1 ),
+        'loader_seconds': loaded['seconds'],
+        'loader_records_per_second': loaded['records'] / (loaded['seconds'] or 1e-9),
+        'loader_peak_kb': loaded['peak_kb'],
+    }
+
+def revision():
+    """Current git revision of the source tree (if available)"""
+    try:
+        with open( os.devnull, 'w' ) as null:
+            return subprocess.check_output(
+                ['git','rev-parse','HEAD'], cwd=HERE, stderr=null,
+            ).strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def run_suite( names=None, repeat=3, lines=False ):
+    """Run the (selected) workloads, returns results dictionary"""
+    results = {
+        'revision': revision(),
+        'python': sys.version.split()[0],
+        'timestamp': time.time(),
+        'lines': lines,
+        'workloads': {},
+    }
+    for name,function,named in WORKLOADS:
+        if names and name not in names:
+            continue
+        results['workloads'][name] = measure(
+            function, repeat=repeat, lines=lines, **named
+        )
+    return results
+
+def compare( before, after, threshold=0.10 ):
+    """Compare two results dictionaries
+
+    returns [(workload,metric,before,after,ratio,regressed),...]
+    """
+    rows = []
+    for name in sorted( after['workloads'] ):
+        old = before['workloads'].get( name )
+        if old is None:
+            continue
+        new = after['workloads'][name]
+        for metric in sorted( new ):
+            if metric not in old or not old[metric]:
+                continue
+            ratio = new[metric] / float( old[metric] )
+            if metric in LOWER_IS_BETTER:
+                regressed = ratio > 1 + threshold
+            elif metric in HIGHER_IS_BETTER:
+                regressed = ratio < 1 - threshold
+            else:
+                regressed = False
+            rows.append( (name,metric,old[metric],new[metric],ratio,regressed) )
+    return rows
+
+def options():
+    parser = optparse.OptionParser(
+        usage = '%prog [-o results.json] [--compare before.json after.json]',
+    )
+    parser.add_option(
+        '-w','--workload', dest='workloads', action='append', default=[],
+        help='Workload to run (repeatable, default all): %s'%(
+            ', '.join([ w[0] for w in WORKLOADS ]),
+        ),
+    )
+    parser.add_option(
+        '-r','--repeat', dest='repeat', type='int', default=3,
+        help='Number of runs of each variant (best is reported)',
+    )
+    parser.add_option(
+        '-l','--lines', dest='lines', action='store_true', default=False,
+        help='Record line events as well',
+    )
+    parser.add_option(
+        '-o','--output', dest='output', default=None,
+        help='Write the results as JSON to this file',
+    )
+    parser.add_option(
+        '-c','--compare', dest='compare', action='store_true', default=False,
+        help='Compare two JSON results files rather than running the suite',
+    )
+    parser.add_option(
+        '-t','--threshold', dest='threshold', type='float', default=0.10,
+        help='Relative change considered a regression when comparing',
+    )
+    return parser
+
+def main():
+    parser = options()
+    options_,args = parser.parse_args()
+    if options_.compare:
+        if len(args) != 2:
+            parser.error( 'Need two results files to compare' )
+        before,after = [json.load( open( filename )) for filename in args]
+        rows = compare( before, after, options_.threshold )
+        print '%-16s %-26s %14s %14s %8s'%( 'Workload','Metric','Before','After','Ratio' )
+        for name,metric,old,new,ratio,regressed in rows:
+            print '%-16s %-26s %14.4f %14.4f %7.2fx%s'%(
+                name, metric, old, new, ratio, ' REGRESSION' if regressed else '',
+            )
+        return 1 if [row for row in rows if row[-1]] else 0
+    results = run_suite( options_.workloads, options_.repeat, options_.lines )
+    print '%-16s %9s %12s %10s %12s %10s'%(
+        'Workload','Slowdown','Events/s','Bytes/ev','Records/s','Peak KB',
+    )
+    for name,metrics in sorted( results['workloads'].items() ):
+        print '%-16s %8.2fx %12.0f %10.2f %12.0f %10d'%(
+            name, metrics['slowdown'], metrics['events_per_second'],
+            metrics['bytes_per_event'], metrics['loader_records_per_second'],
+            metrics['loader_peak_kb'],
+        )
+    if options_.output:
+        with open( options_.output, 'w' ) as fh:
+            json.dump( results, fh, indent=2, sort_keys=True )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit( main() )
@@ -0,0 +1,73 @@
+"""Benchmark the import time of coldshot entry points
+
+Each import is timed in a fresh interpreter (best of --repeat runs) and
+reports the number of coldshot (and total) modules it loaded.  The "all
+tools" row forces every name the package used to import eagerly, i.e.
+the cost every import paid before the package became lazy.
+
+    $ python -m tests.importtime --repeat=20
+"""
+import sys, json, subprocess, optparse, os
+
+HERE = os.path.dirname( os.path.abspath( __file__ ))
+
+CASES = [
+    ('interpreter', 'pass'),
+    ('import coldshot', 'import coldshot'),
+    ('start recorder', 'from coldshot import Profiler'),
+    ('decorator', 'from coldshot.decorator import profile'),
+    ('runctx', 'from coldshot.externals import runctx'),
+    ('loader', 'from coldshot import Loader'),
+    ('all tools', 'from coldshot import *; import coldshot.reporter'),
+]
+
+MEASURE = """
+import sys, time, json
+before = set( sys.modules )
+start = time.time()
+exec( sys.argv[1] )
+duration = time.time() - start
+loaded = [name for name in set( sys.modules ) - before if sys.modules[name] is not None]
+json.dump( {
+    'seconds': duration,
+    'modules': len( loaded ),
+    'coldshot': sorted([ name for name in loaded if name.startswith( 'coldshot' )]),
+}, sys.stdout )
+"""
+
+def measure( statement, repeat=10 ):
+    """Time statement in repeat fresh interpreters, returns best result"""
+    results = []
+    for i in range( repeat ):
+        output = subprocess.check_output(
+            [sys.executable, '-c', MEASURE, statement],
+            cwd = os.path.dirname( HERE ),
+        )
+        results.append( json.loads( output ))
+    return min( results, key=lambda result: result['seconds'] )
+
+def options():
+    parser = optparse.OptionParser()
+    parser.add_option(
+        '-r','--repeat', dest='repeat', type='int', default=10,
+        help='Number of interpreters to start for each import (best is reported)',
+    )
+    parser.add_option(
+        '-v','--verbose', dest='verbose', action='store_true', default=False,
+        help='List the coldshot modules loaded by each import',
+    )
+    return parser
+
+def main():
+    options_,args = options().parse_args()
+    print '%-16s %10s %8s %8s'%( 'Import','ms','Modules','Coldshot' )
+    for name,statement in CASES:
+        result = measure( statement, options_.repeat )
+        print '%-16s %10.2f %8d %8d'%(
+            name, result['seconds']*1000, result['modules'], len(result['coldshot']),
+        )
+        if options_.verbose and result['coldshot']:
+            print '    %s'%( ', '.join( result['coldshot'] ), )
+
+if __name__ == "__main__":
+    main()
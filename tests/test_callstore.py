@@ -0,0 +1,101 @@
+from unittest import TestCase
+from coldshot import profiler, loader, callstore
+import tempfile, shutil, os, time
+
+def leaf( value ):
+    return value + 1
+def branch( count ):
+    return [leaf( i ) for i in range( count )]
+def counter( count ):
+    for i in range( count ):
+        yield leaf( i )
+def trunk():
+    for i in range( 3 ):
+        branch( 4 )
+    time.sleep( .01 )
+    return list( counter( 3 ))
+
+class TestCallStore( TestCase ):
+    def setUp( self ):
+        self.test_dir = tempfile.mkdtemp( prefix = 'coldshot-test' )
+        prof = profiler.Profiler( self.test_dir, lines=True, segment_size=1024 )
+        with prof:
+            prof.annotation( 'request' )
+            trunk()
+            prof.annotation( None )
+        prof.close()
+        self.store = callstore.build( self.test_dir, batch=7 )
+        self.loader = loader.Loader( self.test_dir )
+        self.loader.load()
+    def tearDown( self ):
+        self.store.close()
+        shutil.rmtree( self.test_dir, True )
+    
+    def test_counts_match_loader( self ):
+        # several segments, stacks are carried from one to the next
+        assert len( self.loader.call_files ) > 1, self.loader.call_files
+        root = self.loader.info.roots['functions']
+        expected = dict([
+            (key,function.calls) for (key,function) in self.loader.info.functions.items()
+            if function.calls and function is not root
+        ])
+        found = dict( self.store.query( 
+            'SELECT function, count(*) FROM calls WHERE complete GROUP BY function' 
+        ))
+        assert found == expected, (found, expected)
+        assert self.store.meta()['calls'] == sum( found.values() ) + len( 
+            self.store.query( 'SELECT id FROM calls WHERE NOT complete' )
+        )
+    
+    def test_times( self ):
+        trunk_id = self.store.function_id( 'tests.test_callstore', 'trunk' )
+        trunk_func = self.loader.info.functions[trunk_id]
+        ((duration,self_time,depth,parent,annotation),) = self.store.query(
+            'SELECT duration, self_time, depth, parent, annotation FROM calls WHERE function = ?',
+            (trunk_id,),
+        )
+        assert duration == trunk_func.time, (duration, trunk_func.time)
+        assert self_time == trunk_func.time - trunk_func.child_time, (self_time, trunk_func)
+        assert depth == 0 and parent is None, (depth, parent)
+        assert self.store.query( 
+            'SELECT value FROM annotations WHERE id = ?', (annotation,) 
+        ) == [('request',)]
+    
+    def test_generator_merged( self ):
+        counter_id = self.store.function_id( 'tests.test_callstore', 'counter' )
+        rows = self.store.calls( function=counter_id )
+        assert len( rows ) == 1, rows
+        assert rows[0][-1] == 1, rows
+    
+    def test_children( self ):
+        trunk_id = self.store.function_id( 'tests.test_callstore', 'trunk' )
+        branch_id = self.store.function_id( 'tests.test_callstore', 'branch' )
+        trunk_call = self.store.calls( function=trunk_id )[0]
+        branches = [
+            child for child in self.store.children( trunk_call )
+            if child[1] == branch_id
+        ]
+        assert len( branches ) == 3, branches
+        leaf_id = self.store.function_id( 'tests.test_callstore', 'leaf' )
+        for branch in branches:
+            children = self.store.calls( parent=branch[0], order='-duration' )
+            leaves = [row for row in children if row[1] == leaf_id]
+            assert len( leaves ) == 4, children
+            assert [row[6] for row in leaves] == [2]*4, leaves
+    
+    def test_filters( self ):
+        slow = self.store.calls( min_duration=.01, order='start' )
+        names = set([ 
+            self.store.query( 'SELECT name FROM functions WHERE id = ?', (row[1],))[0][0]
+            for row in slow
+        ])
+        assert 'sleep' in names and 'trunk' in names, names
+        assert 'leaf' not in names, names
+        top = self.store.functions( limit=2 )
+        assert len( top ) == 2 and top[0][4] >= top[1][4], top
+        self.assertRaises( ValueError, self.store.calls, order='nonsense' )
+    
+    def test_is_current( self ):
+        assert callstore.is_current( self.test_dir )
+        os.utime( self.loader.index_filename, (time.time() + 10,) * 2 )
+        assert not callstore.is_current( self.test_dir )
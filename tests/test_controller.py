@@ -0,0 +1,189 @@
+from unittest import TestCase
+from coldshot import profiler, loader, controller
+import tempfile, shutil, os, sys, time, glob, threading
+
+def busy( count ):
+    for i in range( count ):
+        leaf()
+def leaf():
+    return True
+def fresh( count, prefix='fresh' ):
+    """Call count newly-compiled functions (each one a new index declaration)"""
+    for i in range( count ):
+        namespace = {'__name__':__name__}
+        exec( compile( 'def %s_%d():\n    return True\n'%( prefix, i ), __file__, 'exec' ), namespace )
+        namespace['%s_%d'%( prefix, i )]()
+
+class TestSegments( TestCase ):
+    def setUp( self ):
+        self.test_dir = tempfile.mkdtemp( prefix = 'coldshot-test' )
+    def tearDown( self ):
+        shutil.rmtree( self.test_dir, True )
+
+    def test_rotation( self ):
+        prof = profiler.Profiler( self.test_dir, lines=False, segment_size=1200 )
+        with prof:
+            busy( 500 )
+        prof.close()
+        segments = glob.glob( os.path.join( self.test_dir, 'coldshot-*.data' ))
+        assert len(segments) > 2, segments
+        load = loader.Loader( self.test_dir )
+        load.load()
+        assert len(load.call_files) == len(segments), load.call_files
+        leaf_info = load.info.function_names[('tests.test_controller','leaf')]
+        assert leaf_info.calls == 500, leaf_info.calls
+
+    def test_disk_budget( self ):
+        prof = profiler.Profiler( 
+            self.test_dir, lines=False, segment_size=1200, disk_budget=4000,
+        )
+        with prof:
+            busy( 500 )
+        prof.close()
+        segments = glob.glob( os.path.join( self.test_dir, 'coldshot-*.data' ))
+        total = sum([ os.stat( segment ).st_size for segment in segments ])
+        assert total <= 4000 + 1200, total
+        load = loader.Loader( self.test_dir )
+        load.load()
+        assert len(load.call_files) > len(segments), (load.call_files,segments)
+        leaf_info = load.info.function_names[('tests.test_controller','leaf')]
+        assert 0 < leaf_info.calls < 500, leaf_info.calls
+
+    def test_max_events( self ):
+        prof = profiler.Profiler( self.test_dir, lines=False, max_events=100 )
+        prof.start()
+        busy( 500 )
+        assert not prof.active
+        prof.stop()
+        prof.close()
+        assert prof.events == 100, prof.events
+        load = loader.Loader( self.test_dir )
+        load.load()
+        leaf_info = load.info.function_names[('tests.test_controller','leaf')]
+        assert leaf_info.calls < 100, leaf_info.calls
+
+class TestController( TestCase ):
+    def setUp( self ):
+        self.test_dir = tempfile.mkdtemp( prefix = 'coldshot-test' )
+        self.control = controller.Controller( 
+            self.test_dir, 
+            socket_path=os.path.join( self.test_dir, 'control.sock' ),
+            duration=None,
+        ).install()
+    def tearDown( self ):
+        self.control.uninstall()
+        shutil.rmtree( self.test_dir, True )
+
+    def test_start_stop( self ):
+        capture = self.control.start()
+        assert self.control.active
+        busy( 10 )
+        assert self.control.stop() == capture
+        assert not self.control.active
+        load = loader.Loader( capture )
+        load.load()
+        assert load.info.function_names[('tests.test_controller','leaf')].calls == 10
+
+    def test_duration( self ):
+        capture = self.control.start( duration=0.05 )
+        time.sleep( 0.2 )
+        assert not self.control.active
+        assert os.path.exists( os.path.join( capture, profiler.Profiler.INDEX_FILENAME ))
+
+    def test_duration_threaded( self ):
+        """The timer thread stops the capture while other threads are busy"""
+        from io import BytesIO
+        stop = threading.Event()
+        failures = []
+        def worker():
+            try:
+                while not stop.is_set():
+                    fresh( 100, threading.current_thread().name.replace( '-', '_' ))
+            except Exception as err:
+                failures.append( err )
+        # exceptions within the profile callback are written to stderr
+        stderr,sys.stderr = sys.stderr,BytesIO()
+        try:
+            workers = [threading.Thread( target=worker ) for i in range( 3 )]
+            for thread in workers:
+                thread.start()
+            capture = self.control.start( duration=0.05 )
+            end = time.time() + 0.3
+            while time.time() < end:
+                busy( 10 )
+                fresh( 100 )
+            stop.set()
+            for thread in workers:
+                thread.join()
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        assert not self.control.active
+        assert not failures, failures
+        assert not errors, errors
+        load = loader.Loader( capture )
+        load.load()
+        assert load.info.function_names[('tests.test_controller','leaf')].calls > 0
+
+    def test_signal_toggle( self ):
+        os.kill( os.getpid(), self.control.signum )
+        assert self.control.active
+        capture = self.control.capture
+        busy( 5 )
+        os.kill( os.getpid(), self.control.signum )
+        assert not self.control.active
+        load = loader.Loader( capture )
+        load.load()
+        assert load.info.function_names[('tests.test_controller','leaf')].calls == 5
+
+    def test_commands( self ):
+        status = self.control.command( 'status' )
+        assert not status['active'], status
+        assert 'error' in self.control.command( 'bogus' )
+
+    def test_prune( self ):
+        for name in ('capture-20000101-000000','capture-20000101-000001'):
+            os.makedirs( os.path.join( self.test_dir, name ))
+            with open( os.path.join( self.test_dir, name, 'data' ), 'w' ) as fh:
+                fh.write( 'x' * 1000 )
+        self.control.disk_budget = 1500
+        self.control.prune()
+        remaining = [os.path.basename( path ) for path in self.control.captures()]
+        assert remaining == ['capture-20000101-000001'], remaining
+
+    def test_capture_budget( self ):
+        """A new capture only gets the budget the kept captures do not use"""
+        for name in ('capture-20000101-000000','capture-20000101-000001'):
+            os.makedirs( os.path.join( self.test_dir, name ))
+            with open( os.path.join( self.test_dir, name, 'data' ), 'w' ) as fh:
+                fh.write( 'x' * 1000 )
+        self.control.disk_budget = 4000
+        self.control.segment_size = 1200
+        self.control.all_threads = False
+        capture = self.control.start()
+        assert self.control.profiler.disk_budget == 2000, self.control.profiler.disk_budget
+        busy( 500 )
+        self.control.stop()
+        assert len( self.control.captures() ) == 3, self.control.captures()
+        segments = glob.glob( os.path.join( capture, 'coldshot-*.data' ))
+        total = sum([ os.stat( segment ).st_size for segment in segments ])
+        assert total <= 2000 + 1200, total
+        # old captures are pruned to leave room for a segment of the next one
+        self.control.disk_budget = 2500
+        self.control.prune( reserve=1200 )
+        remaining = [os.path.basename( path ) for path in self.control.captures()]
+        assert 'capture-20000101-000000' not in remaining, remaining
+    
+    def test_socket_all_threads( self ):
+        import socket, json
+        client = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        client.connect( self.control.socket_path )
+        client.sendall( b'start\n' )
+        status = json.loads( client.makefile().readline() )
+        client.close()
+        assert status['active'], status
+        busy( 7 )
+        capture = self.control.stop()
+        load = loader.Loader( capture )
+        load.load()
+        assert load.info.function_names[('tests.test_controller','leaf')].calls == 7
@@ -0,0 +1,102 @@
+from unittest import TestCase
+from coldshot import profiler, loader, aggregates, diff
+import tempfile, os, shutil, time
+
+def steady():
+    time.sleep( 0.001 )
+
+def slow( t ):
+    time.sleep( t )
+
+def workload( t ):
+    steady()
+    slow( t )
+
+class TestDiff( TestCase ):
+    slow_key = ('tests.test_diff','slow')
+    def setUp( self ):
+        self.before_dir = tempfile.mkdtemp( prefix = 'coldshot-test' )
+        self.after_dir = tempfile.mkdtemp( prefix = 'coldshot-test' )
+        for directory,t in [(self.before_dir,0.001),(self.after_dir,0.02)]:
+            prof = profiler.Profiler( directory )
+            with prof:
+                workload( t )
+            prof.close()
+    def tearDown( self ):
+        shutil.rmtree( self.before_dir, True )
+        shutil.rmtree( self.after_dir, True )
+
+    def test_cache_roundtrip( self ):
+        full = loader.Loader( self.after_dir ).load()
+        info = aggregates.load( self.after_dir )
+        assert os.path.exists( os.path.join( self.after_dir, aggregates.CACHE_FILENAME ))
+        cached = aggregates.load( self.after_dir )
+        for key,function in full.function_names.items():
+            other = cached.function_names[key]
+            assert other.calls == function.calls, (key, other.calls, function.calls)
+            assert other.time == function.time, (key, other.time, function.time)
+            assert other.child_map == function.child_map, key
+            assert sorted(other.line_map) == sorted(function.line_map), key
+
+    def test_regression( self ):
+        deltas = diff.diff( self.before_dir, self.after_dir )
+        keys = [delta.key[:2] for delta in deltas]
+        assert self.slow_key in keys, keys
+        regressed = [delta.key[:2] for delta in diff.regressions( deltas )]
+        assert self.slow_key in regressed, regressed
+        assert ('tests.test_diff','steady') not in regressed, regressed
+
+    def test_unicode_directory( self ):
+        directory = self.after_dir
+        if isinstance( directory, bytes ):
+            directory = directory.decode( 'utf-8' )
+        stats = diff.aggregate( directory )
+        assert [key for key in stats if key[:2] == self.slow_key], stats
+    
+    def test_no_change( self ):
+        deltas = diff.diff( self.before_dir, self.before_dir )
+        assert not deltas, deltas
+
+    def test_moved_function( self ):
+        before = diff.aggregate( self.before_dir )
+        after = diff.aggregate( self.after_dir )
+        moved = {}
+        for key,stats in after.items():
+            stats.line += 10
+            moved[stats.key] = stats
+        deltas = diff.diff( before, moved )
+        assert not [delta for delta in deltas if delta.before is None], deltas
+
+    def test_json( self ):
+        import json
+        deltas = diff.diff( self.before_dir, self.after_dir )
+        decoded = json.loads( diff.report( deltas, format='json' ))
+        assert len(decoded) == len(deltas), decoded
+        assert decoded[0]['after'], decoded[0]
+
+    def test_text_columns( self ):
+        deltas = diff.diff( self.before_dir, self.after_dir )
+        lines = diff.report( deltas ).splitlines()
+        header = lines[0]
+        assert header.split()[:3] == ['Namespace','Line','Name'], header
+        for delta,row in zip( deltas, lines[2:] ):
+            # each value ends where its header ends
+            assert len(row) == len(header), (header, row)
+            assert row.split()[1:3] == [str(delta.key[2]),delta.key[1]], (delta, row)
+    
+    def test_no_cache( self ):
+        """coldshot-diff --no-cache leaves the profile directories unchanged"""
+        import sys
+        from io import BytesIO
+        from coldshot import externals
+        contents = [sorted( os.listdir( d )) for d in (self.before_dir,self.after_dir)]
+        argv,stdout = sys.argv,sys.stdout
+        sys.argv = ['coldshot-diff','--no-cache',self.before_dir,self.after_dir]
+        sys.stdout = BytesIO()
+        try:
+            externals.diff_main()
+        finally:
+            sys.argv,sys.stdout = argv,stdout
+        after = [sorted( os.listdir( d )) for d in (self.before_dir,self.after_dir)]
+        assert after == contents, (contents, after)
+        assert aggregates.CACHE_FILENAME not in after[0], after
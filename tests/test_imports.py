@@ -0,0 +1,45 @@
+from unittest import TestCase
+import sys, os, json, subprocess
+
+LOADED = """
+import sys, json
+exec( sys.argv[1] )
+json.dump( sorted([
+    name for name in sys.modules 
+    if name.startswith( 'coldshot' ) and sys.modules[name] is not None
+]), sys.stdout )
+"""
+
+def loaded( statement ):
+    """Run statement in a fresh interpreter, return the coldshot modules loaded"""
+    return json.loads( subprocess.check_output( 
+        [sys.executable, '-c', LOADED, statement],
+        cwd = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ))),
+    ))
+
+class TestLazyImports( TestCase ):
+    def test_package_only( self ):
+        modules = loaded( 'import coldshot' )
+        assert modules == ['coldshot'], modules
+    def test_profiler_only( self ):
+        modules = loaded( 'from coldshot import Profiler' )
+        assert modules == ['coldshot','coldshot.profiler'], modules
+        modules = loaded( 'from coldshot.externals import runctx' )
+        assert 'coldshot.loader' not in modules, modules
+        assert 'coldshot.reporter' not in modules, modules
+    def test_lazy_names( self ):
+        import coldshot
+        from coldshot import loader, profiler
+        assert coldshot.Loader is loader.Loader
+        assert coldshot.Profiler is profiler.Profiler
+        assert coldshot.reporter.Reporter
+        assert 'Loader' in dir( coldshot )
+        self.assertRaises( AttributeError, getattr, coldshot, 'no_such_name' )
+    def test_names_cover_all( self ):
+        import coldshot
+        from coldshot import profiler, loader, externals, decorator
+        for module in (profiler, loader, externals, decorator):
+            source = module.__name__.split( '.' )[-1]
+            for name in module.__all__:
+                assert coldshot.LAZY_NAMES.get( name ) == source, (source, name)
+                assert getattr( coldshot, name ) is getattr( module, name ), (source, name)
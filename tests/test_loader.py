@@ -1,5 +1,5 @@
 from unittest import TestCase
-from coldshot import profiler, loader 
+from coldshot import profiler, loader, stack
 import tempfile, os, shutil, time
 
 def first_level():
@@ -79,6 +79,19 @@ class TestLoader( TestLoaderBase ):
         for key,value in function.line_map.items():
             assert value.line == key, (value.line,key)
 
+    def test_function_before_file( self ):
+        """Declarations written out of order by concurrent threads still load"""
+        index = os.path.join( self.test_dir, profiler.Profiler.INDEX_FILENAME )
+        lines = open( index ).readlines()
+        files = [line for line in lines if line.startswith( 'F ' )]
+        others = [line for line in lines if not line.startswith( 'F ' )]
+        with open( index, 'w' ) as fh:
+            fh.writelines( others + files )
+        load = self.create_loader()
+        assert self.first_key in load.info.function_names
+        first = load.info.function_names[ self.first_key ]
+        assert first.filename == 'test_loader.py', first.filename
+
 class TestLoaderIndividual( TestLoaderBase ):
     def create_loader( self ):
         load = loader.Loader( self.test_dir, individual_calls=set([  
@@ -103,3 +116,103 @@ class TestLoaderIndividual( TestLoaderBase ):
                 assert 0.002 > grandchild.cumulative > 0.001, grandchild.cumulative
                 for greatgrandchild in grandchild.children:
                     assert len(greatgrandchild.children) == 0 # time.sleep
+
+def variable( duration ):
+    time.sleep( duration )
+def latencies():
+    for i in range( 19 ):
+        variable( 0.001 )
+    variable( 0.02 )
+def quick():
+    return True
+def spans_segments():
+    for i in range( 1000 ):
+        quick()
+def segmented():
+    spans_segments()
+
+class TestLatency( TestCase ):
+    variable_key = ('tests.test_loader','variable')
+    def setUp( self ):
+        self.test_dir = tempfile.mkdtemp( prefix = 'coldshot-test' )
+        prof = profiler.Profiler( self.test_dir )
+        with prof:
+            latencies()
+        prof.close()
+        self.loader = loader.Loader( self.test_dir, latency_edges=True )
+        self.loader.load()
+    def tearDown( self ):
+        shutil.rmtree( self.test_dir, True )
+    
+    def test_buckets( self ):
+        histogram = stack.LatencyHistogram()
+        for value in range( 1, 101 ):
+            histogram.add( stack.bucket_of( value ), 1 )
+        histogram.max = 100
+        for bucket in range( stack.LATENCY_BUCKETS - 1 ):
+            low,high = stack.bucket_bounds( bucket )
+            assert high + 1 == stack.bucket_bounds( bucket + 1 )[0], bucket
+            # sub-buckets are within 1/8th of their lower bound
+            assert high - low <= max( (low // 8, 0) ), (bucket, low, high)
+        assert histogram.count == 100
+        assert 50 <= histogram.percentile( 50 ) <= 50 * 1.125, histogram.percentile( 50 )
+        assert 99 <= histogram.percentile( 99 ) <= 100, histogram.percentile( 99 )
+        assert histogram.percentile( 100 ) == 100
+    
+    def test_percentiles( self ):
+        function = self.loader.info.function_names[ self.variable_key ]
+        assert function.latency.count == function.calls == 20, function.latency
+        assert .001 <= function.p50 < .005, function.p50
+        assert function.p90 < .005, function.p90
+        assert function.slowest >= .02, function.slowest
+        assert function.p99 == function.slowest, (function.p99, function.slowest)
+        seconds,call_file,index,thread = function.slowest_calls[0]
+        assert seconds == function.slowest
+        assert call_file == 0 and index == function.slowest_index
+        assert len( function.slowest_calls ) == stack.SLOWEST_CALLS
+        # the index is that of the slow call's start event
+        scanned = self.loader.scan_calls( self.loader.call_files[call_file], start=index, stop=index+1 )
+        assert scanned and scanned[0][0] == function.key, scanned
+    
+    def test_segmented( self ):
+        directory = tempfile.mkdtemp( prefix = 'coldshot-test' )
+        try:
+            prof = profiler.Profiler( directory, segment_size=12000 )
+            with prof:
+                segmented()
+            prof.close()
+            load = loader.Loader( directory, latency_edges=True )
+            load.load()
+            assert len( load.call_files ) > 1, load.call_files
+            caller = load.info.function_names[ ('tests.test_loader','segmented') ]
+            function = load.info.function_names[ ('tests.test_loader','spans_segments') ]
+            seconds,call_file,index,thread = function.slowest_calls[0]
+            edge = caller.edge_latency[function.key].slowest[0]
+            # both locate the call event, in the file in which the call started
+            assert edge[1:3] == (call_file,index), (edge, call_file, index)
+            scanned = load.scan_calls( load.call_files[call_file], start=index, stop=index+1 )
+            assert scanned and scanned[0][0] == function.key, (call_file, index, scanned)
+        finally:
+            shutil.rmtree( directory, True )
+    
+    def test_edges( self ):
+        caller = self.loader.info.function_names[ ('tests.test_loader','latencies') ]
+        function = self.loader.info.function_names[ self.variable_key ]
+        histogram = caller.edge_latency[function.key]
+        assert histogram.count == 20, histogram
+        assert histogram.max == function.latency.max
+    
+    def test_cache( self ):
+        from coldshot import aggregates
+        filename = os.path.join( self.test_dir, 'test.aggregates' )
+        aggregates.save( self.loader.info, filename )
+        fresh = loader.Loader( self.test_dir )
+        fresh.process_index( fresh.index_filename )
+        aggregates.read( filename, fresh.info )
+        original = self.loader.info.function_names[ self.variable_key ]
+        function = fresh.info.function_names[ self.variable_key ]
+        assert function.latency.buckets() == original.latency.buckets()
+        assert function.latency.slowest == original.latency.slowest
+        assert (function.p50,function.p99) == (original.p50,original.p99)
+        caller = fresh.info.function_names[ ('tests.test_loader','latencies') ]
+        assert caller.edge_latency[function.key].count == 20
@@ -1,6 +1,6 @@
 from unittest import TestCase
 from coldshot import profiler, loader, eventsfile
-import tempfile, os, shutil, time
+import tempfile, os, shutil, time, threading
 
 def blah():
     return True
@@ -14,6 +14,54 @@ def slow_lines():
     time.sleep( .001 )
     time.sleep( .01 )
     time.sleep( .1 )
+def allocate():
+    """Allocate a (large, so it is mmap-ed) buffer"""
+    blah()
+    buffer = bytearray( 10 * 1024 * 1024 )
+    blah()
+    return buffer
+def spin( duration ):
+    """Burn duration seconds of CPU (more wall-clock time if the machine is busy)"""
+    clock = getattr( time, 'process_time', None ) or time.clock
+    start = clock()
+    while clock() - start < duration:
+        pass
+def spin_and_wait():
+    spin( .05 )
+    sleep( .05 )
+def counter( count ):
+    for i in range( count ):
+        sleep( .001 )
+        yield i
+def consume_generator():
+    return [sleep( .002 ) for i in counter( 5 )]
+def raises():
+    raise ValueError( 'expected' )
+def annotated_raises( prof ):
+    """Switch to a new annotation, then raise"""
+    prof.annotation( 'inner' )
+    raise ValueError( 'expected' )
+def catches():
+    for i in range( 3 ):
+        try:
+            raises()
+        except ValueError as err:
+            pass
+    try:
+        {}.pop( 'missing' )
+    except KeyError as err:
+        pass
+def grow():
+    """Allocate (mmap-ed) buffers on many lines without making any calls"""
+    chunks = []
+    for i in range( 20 ):
+        chunks += [bytearray( 1024 * 1024 )]
+    return chunks
+def churn():
+    """Allocate and free the buffer"""
+    buffer = allocate()
+    del buffer
+    blah()
 def slow_calls():
     """Each line here should have ~ the time assigned in the parameter"""
     sleep( .001 )
@@ -104,6 +152,53 @@ class TestProfiler( TestCase ):
         this_key = ('tests.test_profiler','test_load_byteswapped')
         assert this_key in load.info.function_names 
     
+    def test_load_foreign_endian( self ):
+        """Profiles written with the other byte-order load identically"""
+        import struct, sys
+        self.profiler.start()
+        consume_generator()
+        self.profiler.stop()
+        native = loader.Loader( self.test_dir )
+        native.load()
+        
+        foreign_dir = tempfile.mkdtemp( prefix='coldshot-foreign' )
+        self.addCleanup( shutil.rmtree, foreign_dir, True )
+        foreign_order = '>' if sys.byteorder == 'little' else '<'
+        for name in os.listdir( self.test_dir ):
+            source = os.path.join( self.test_dir, name )
+            target = os.path.join( foreign_dir, name )
+            if name == 'index.coldshot':
+                content = open( source ).read().replace(
+                    'bigendian=%s'%( sys.byteorder == 'big', ),
+                    'bigendian=%s'%( sys.byteorder != 'big', ),
+                ).replace( self.test_dir, foreign_dir )
+                open( target, 'w' ).write( content )
+            elif name.endswith( '.data' ):
+                content = open( source, 'rb' ).read()
+                count = len( content )//12
+                fields = struct.unpack( '=' + 'HHII'*count, content )
+                open( target, 'wb' ).write(
+                    struct.pack( foreign_order + 'HHII'*count, *fields )
+                )
+        foreign = loader.Loader( foreign_dir )
+        foreign.load()
+        assert foreign.info.swapendian
+        assert not native.info.swapendian
+        
+        for key,function in native.info.functions.items():
+            other = foreign.info.functions[key]
+            assert function.name == other.name, (function,other)
+            assert function.calls == other.calls, (function,other)
+            assert function.time == other.time, (function,other)
+        this_key = ('tests.test_profiler','sleep')
+        assert foreign.info.function_names[this_key].calls == 10
+        # the source data-files are left untouched
+        data = [name for name in os.listdir( foreign_dir ) if name.endswith( '.data' )]
+        data_file = eventsfile.EventsFile( os.path.join( foreign_dir, data[0] ))
+        swapped = eventsfile.EventsFile( os.path.join( foreign_dir, data[0] ), True )
+        assert data_file[0]['function'] == eventsfile.byteswap_32( swapped[0]['function'] )
+        assert data_file[0]['function'] != swapped[0]['function']
+    
     def test_byteswap( self ):
         assert eventsfile.byteswap_16( 0xff00 ) == 0xff,  eventsfile.byteswap_16( 0xff00 )
         assert eventsfile.byteswap_16( 0x00ff ) == 0xff00, eventsfile.byteswap_16( 0x00ff )
@@ -134,7 +229,395 @@ class TestProfiler( TestCase ):
         assert 'hello \n' in load.info.annotation_notes
         assert 'world' in load.info.annotation_notes 
         hello = load.info.annotation_notes['hello \n']
-        assert len(hello.children) == 2, hello.children # blah and annotation expected
+        # blah, annotation and (after world is popped) blah again
+        assert len(hello.children) == 3, hello.children
     
         assert hello.key == 'hello \n', hello.key
+    
+    def test_annotation_aggregation( self ):
+        with self.profiler:
+            self.profiler.annotation( 'request-1' )
+            blah()
+            self.profiler.annotation( 'request-2' )
+            slow_calls()
+            blah()
+            self.profiler.annotation( None )
+            blah()
+            self.profiler.annotation( None )
+        self.profiler.close()
+        load = loader.Loader( self.test_dir )
+        load.load()
+        first = load.info.annotation_notes['request-1']
+        second = load.info.annotation_notes['request-2']
+        
+        blah_key = load.info.function_names[('tests.test_profiler','blah')].key
+        assert first.functions[blah_key].calls == 2, first.functions[blah_key]
+        assert second.functions[blah_key].calls == 1, second.functions[blah_key]
+        sleep = load.info.function_names[('tests.test_profiler','sleep')]
+        assert sleep.key not in first.functions, first.functions
+        assert second.functions[sleep.key].calls == 3
+        assert second.functions[sleep.key].line_map, "Expected per-annotation line timings"
+        
+        assert len(first.spans) == 1 and len(second.spans) == 1, (first.spans,second.spans)
+        slowest = load.info.slowest_spans( 2 )
+        assert [x[1] for x in slowest] == [first,second], slowest
+        assert slowest[1][0] > 0.1, slowest
+        slowest = load.info.slowest_spans( 5, annotations=['request-2'] )
+        assert len(slowest) == 1 and slowest[0][1] is second, slowest
+        # nested span is contained within the outer span
+        assert first.spans[0][1] <= second.spans[0][1] <= second.spans[0][2] <= first.spans[0][2]
+        
+    
+    def test_all_threads( self ):
+        started = threading.Event()
+        go = threading.Event()
+        def existing():
+            started.set()
+            go.wait()
+            for i in range( 5 ):
+                blah()
+        def new():
+            for i in range( 3 ):
+                blah()
+        before = threading.Thread( target=existing )
+        before.start()
+        started.wait()
+        prof = profiler.Profiler( self.test_dir, lines=False, all_threads=True )
+        with prof:
+            after = threading.Thread( target=new )
+            after.start()
+            after.join()
+            go.set()
+            before.join()
+        prof.close()
+        # threads started after stop are not profiled
+        late = threading.Thread( target=new )
+        late.start()
+        late.join()
+        load = loader.Loader( self.test_dir )
+        load.load()
+        blah_func = load.info.function_names[('tests.test_profiler','blah')]
+        assert blah_func.calls == 8, blah_func.calls
+        assert len(load.info.threads) >= 3, load.info.threads
+        new_func = load.info.function_names[('tests.test_profiler','new')]
+        assert new_func.calls == 1, new_func.calls
+    
+    def test_per_thread( self ):
+        go = threading.Event()
+        def worker():
+            # keep the threads alive together (thread ids are re-used)
+            go.wait()
+            for i in range( 4 ):
+                blah()
+        prof = profiler.Profiler( 
+            self.test_dir, lines=True, all_threads=True, per_thread=True,
+        )
+        with prof:
+            threads = [threading.Thread( target=worker ) for i in range( 3 )]
+            for thread in threads:
+                thread.start()
+            go.set()
+            for thread in threads:
+                thread.join()
+            blah()
+        prof.close()
+        load = loader.Loader( self.test_dir )
+        load.load()
+        assert len(load.call_files) == len(prof.writers) >= 4, load.call_files
+        for filename in load.call_files:
+            threads = set([ 
+                record['thread'] 
+                for record in eventsfile.EventsFile( filename )
+            ])
+            assert len(threads) == 1, (filename,threads)
+        blah_func = load.info.function_names[('tests.test_profiler','blah')]
+        assert blah_func.calls == 13, blah_func.calls
+        assert len(load.info.threads) == len(load.call_files), load.info.threads
+    
+    def test_per_thread_zero( self ):
+        # an extractor may legitimately map the first thread to id 0
+        extractor = profiler.ThreadExtractor()
+        extractor.members[threading.current_thread().ident] = 0
+        prof = profiler.Profiler( 
+            self.test_dir, per_thread=True, thread_extractor=extractor,
+        )
+        with prof:
+            blah()
+        prof.close()
+        load = loader.Loader( self.test_dir )
+        load.load()
+        assert list( load.info.threads ) == [0], load.info.threads
+        blah_func = load.info.function_names[('tests.test_profiler','blah')]
+        assert blah_func.calls == 1, blah_func.calls
+    
+    def test_memory( self ):
+        from coldshot import aggregates
+        prof = profiler.Profiler( self.test_dir, lines=True, memory=True )
+        with prof:
+            churn()
+        prof.close()
+        load = loader.Loader( self.test_dir )
+        load.load()
+        allocator = load.info.function_names[('tests.test_profiler','allocate')]
+        assert allocator.allocated >= 10 * 1024 * 1024, allocator.allocated
+        assert allocator.local_allocated >= 10 * 1024 * 1024, allocator.local_allocated
+        assert allocator.allocatedPer == allocator.allocated, allocator.allocatedPer
+        lines = [
+            line for line in allocator.line_map.values() 
+            if line.allocated >= 10 * 1024 * 1024
+        ]
+        assert len(lines) == 1, allocator.line_map
+        
+        blah_func = load.info.function_names[('tests.test_profiler','blah')]
+        assert blah_func.allocated < 1024 * 1024, blah_func.allocated
+        
+        churner = load.info.function_names[('tests.test_profiler','churn')]
+        assert churner.local_freed >= 10 * 1024 * 1024, churner.local_freed
+        assert churner.allocated >= allocator.allocated, churner.allocated
+        
+        # round-trip through the aggregate cache
+        filename = os.path.join( self.test_dir, 'test.aggregates' )
+        aggregates.save( load.info, filename )
+        fresh = loader.Loader( self.test_dir )
+        fresh.process_index( fresh.index_filename )
+        aggregates.read( filename, fresh.info )
+        restored = fresh.info.function_names[('tests.test_profiler','allocate')]
+        assert restored.allocated == allocator.allocated
+        assert restored.local_freed == allocator.local_freed
+        assert restored.line_map[lines[0].line].allocated == lines[0].allocated
+    
+    def test_memory_sampling( self ):
+        prof = profiler.Profiler( self.test_dir, lines=True, memory=True )
+        with prof:
+            grow()
+        prof.close()
+        stats = prof.stats()
+        # line events do not sample memory...
+        assert stats['line_events'] > 20, stats
+        assert stats['counter_events'] <= stats['call_events'] + stats['return_events'], stats
+    
+    def test_cpu( self ):
+        from coldshot import aggregates
+        prof = profiler.Profiler( self.test_dir, lines=False, cpu=True )
+        with prof:
+            spin_and_wait()
+        prof.close()
+        load = loader.Loader( self.test_dir )
+        load.load()
+        spinner = load.info.function_names[('tests.test_profiler','spin')]
+        sleeper = load.info.function_names[('tests.test_profiler','sleep')]
+        both = load.info.function_names[('tests.test_profiler','spin_and_wait')]
+        assert spinner.cpu > .04, spinner.cpu
+        # time spent waiting for the CPU depends on the machine's load
+        assert spinner.cpu > sleeper.cpu * 2, (spinner.cpu, sleeper.cpu)
+        assert sleeper.cpu < .01, sleeper.cpu
+        assert sleeper.waiting > .04, sleeper.waiting
+        assert both.cpu >= spinner.cpu, (both.cpu, spinner.cpu)
+        assert both.cpu_local < .01, both.cpu_local
+        assert abs( both.cpu - (spinner.cpu + sleeper.cpu) ) < .01
         
+        filename = os.path.join( self.test_dir, 'test.aggregates' )
+        aggregates.save( load.info, filename )
+        fresh = loader.Loader( self.test_dir )
+        fresh.process_index( fresh.index_filename )
+        aggregates.read( filename, fresh.info )
+        restored = fresh.info.function_names[('tests.test_profiler','spin')]
+        assert restored.cpu == spinner.cpu, (restored.cpu, spinner.cpu)
+    
+    def test_generators( self ):
+        with self.profiler:
+            consume_generator()
+        self.profiler.close()
+        load = loader.Loader( self.test_dir )
+        load.load()
+        generator = load.info.function_names[('tests.test_profiler','counter')]
+        consumer = load.info.function_names[('tests.test_profiler','consume_generator')]
+        # resumes are merged into a single logical call
+        assert generator.calls == 1, generator.calls
+        # the generator ran for ~5 x 1ms of the ~15ms, time suspended 
+        # (consumer sleeping 5 x 2ms) is excluded
+        assert generator.cumulative >= .005, generator.cumulative
+        assert consumer.cumulative >= .015, consumer.cumulative
+        assert generator.cumulative <= consumer.cumulative - .01, (generator, consumer)
+        assert consumer.child_map[generator.key] == generator.time, (consumer.child_map, generator.time)
+        assert consumer.local < .002, consumer.local
+    
+    def test_unfinished_generator( self ):
+        with self.profiler:
+            iterator = counter( 5 )
+            next( iterator )
+        self.profiler.close()
+        load = loader.Loader( self.test_dir )
+        load.load()
+        generator = load.info.function_names[('tests.test_profiler','counter')]
+        assert generator.calls == 1, generator.calls
+        assert generator.cumulative >= .001, generator.cumulative
+    
+    def test_exceptions( self ):
+        from coldshot import aggregates
+        with self.profiler:
+            catches()
+        self.profiler.close()
+        load = loader.Loader( self.test_dir )
+        load.load()
+        raiser = load.info.function_names[('tests.test_profiler','raises')]
+        catcher = load.info.function_names[('tests.test_profiler','catches')]
+        assert raiser.calls == 3 and raiser.exceptions == 3, raiser
+        assert catcher.calls == 1 and catcher.exceptions == 0, catcher
+        builtins = [
+            function for function in load.info.functions.values()
+            if function.name == 'pop'
+        ]
+        assert builtins and builtins[0].exceptions == 1, builtins
+        # the stack stays balanced after a builtin raises
+        assert catcher.child_map, catcher.child_map
+        
+        filename = os.path.join( self.test_dir, 'test.aggregates' )
+        aggregates.save( load.info, filename )
+        fresh = loader.Loader( self.test_dir )
+        fresh.process_index( fresh.index_filename )
+        aggregates.read( filename, fresh.info )
+        assert fresh.info.function_names[('tests.test_profiler','raises')].exceptions == 3
+    
+    def test_annotated_exception( self ):
+        with self.profiler:
+            self.profiler.annotation( 'outer' )
+            try:
+                annotated_raises( self.profiler )
+            except ValueError as err:
+                pass
+            self.profiler.annotation( None )
+            self.profiler.annotation( None )
+        self.profiler.close()
+        load = loader.Loader( self.test_dir )
+        load.load()
+        raiser = load.info.function_names[('tests.test_profiler','annotated_raises')]
+        assert raiser.exceptions == 1, raiser
+        outer = load.info.annotation_notes['outer']
+        inner = load.info.annotation_notes['inner']
+        # the exception is scoped with the call's time, to the call's annotation
+        assert outer.functions[raiser.key].calls == 1, outer.functions
+        assert outer.functions[raiser.key].exceptions == 1, outer.functions
+        assert raiser.key not in inner.functions or not inner.functions[raiser.key].exceptions
+    
+    def test_stats( self ):
+        self.profiler.instrument = True
+        with self.profiler:
+            blah()
+        stats = self.profiler.stats()
+        assert stats['call_events'] >= 1, stats
+        assert stats['return_events'] == stats['call_events'], stats
+        assert stats['line_events'], stats
+        assert stats['events'] == sum([ 
+            stats['%s_events'%( name, )] for name in profiler.EVENT_TYPES 
+            if name != 'counter'
+        ]), stats
+        assert stats['bytes_written'] == (
+            stats['events'] + stats['counter_events']
+        ) * profiler.CALL_INFO_SIZE, stats
+        assert stats['functions'] >= 2, stats
+        assert stats['files'] >= 1, stats
+        assert stats['flushes'] == 1, stats
+        assert not stats['write_errors'], stats
+        assert stats['callback_seconds'] >= stats['registration_seconds'], stats
+        self.profiler.close()
+        
+        load = loader.Loader( self.test_dir )
+        load.load()
+        assert load.info.profiler_stats == stats, (load.info.profiler_stats, stats)
+    
+    def test_stats_uninstrumented( self ):
+        with self.profiler:
+            blah()
+        stats = self.profiler.stats()
+        assert stats['call_events'] >= 1, stats
+        assert stats['callback_seconds'] == 0, stats
+    
+    def test_write_errors( self ):
+        self.profiler.start()
+        self.profiler.calls.close()
+        blah()
+        self.profiler.stop()
+        stats = self.profiler.stats()
+        assert stats['write_errors'], stats
+        assert stats['dropped_events'] == stats['write_errors'], stats
+    
+    def test_aggregate( self ):
+        def run( **named ):
+            directory = tempfile.mkdtemp( prefix = 'coldshot-test' )
+            prof = profiler.Profiler( directory, lines=True, **named )
+            with prof:
+                slow_calls()
+                consume_generator()
+                catches()
+            prof.close()
+            load = loader.Loader( directory )
+            load.load()
+            shutil.rmtree( directory, True )
+            return load.info
+        traced = run()
+        aggregated = run( aggregate=True )
+        for name in ('slow_calls','sleep','counter','consume_generator','raises','catches'):
+            expected = traced.function_names[('tests.test_profiler',name)]
+            function = aggregated.function_names[('tests.test_profiler',name)]
+            assert function.calls == expected.calls, (function, expected)
+            assert function.exceptions == expected.exceptions, (function, expected)
+            assert sorted( function.line_map ) == sorted( expected.line_map ), (
+                function, function.line_map, expected.line_map,
+            )
+            assert abs( function.cumulative - expected.cumulative ) < .005, (function, expected)
+        caller = aggregated.function_names[('tests.test_profiler','slow_calls')]
+        sleeper = aggregated.function_names[('tests.test_profiler','sleep')]
+        assert caller.child_map[sleeper.key] >= .1 / aggregated.timer_unit, caller.child_map
+        root = aggregated.roots['functions']
+        assert root.calls == 1 and root.child_time, root
+        assert aggregated.threads, aggregated.threads
+        thread = list( aggregated.threads.values() )[0]
+        assert thread.functions[sleeper.key].calls == sleeper.calls, thread.functions
+    
+    def test_aggregate_wraparound( self ):
+        directory = tempfile.mkdtemp( prefix = 'coldshot-test' )
+        try:
+            # an interval longer than the 32-bit timestamps can represent
+            prof = profiler.Profiler( directory, aggregate=True, snapshot_interval=5000 )
+            assert prof.snapshot_interval * profiler.TIMER_UNIT >= 4999, prof.snapshot_interval
+            # start the 32-bit timestamps just before they wrap
+            prof.internal_start = profiler.timer() - (2**32 - int( .02 / profiler.TIMER_UNIT ))
+            with prof:
+                sleep( .05 )
+            prof.close()
+            load = loader.Loader( directory )
+            load.load()
+            root = load.info.roots['functions']
+            assert .05 <= root.time * load.info.timer_unit < 5, root.time
+            thread = list( load.info.threads.values() )[0]
+            assert thread.stop > 2**32, thread.stop
+            assert .05 <= (thread.stop - thread.start) * load.info.timer_unit < 5, thread
+        finally:
+            shutil.rmtree( directory, True )
+    
+    def test_aggregate_snapshots( self ):
+        directory = tempfile.mkdtemp( prefix = 'coldshot-test' )
+        try:
+            prof = profiler.Profiler( directory, aggregate=True, snapshot_interval=.001 )
+            self.assertRaises( 
+                ValueError, profiler.Profiler, directory, aggregate=True, memory=True,
+            )
+            sizes = []
+            with prof:
+                for i in range( 5 ):
+                    counter_ = list( counter( 2 ))
+                    sizes.append( os.path.getsize( prof.snapshot_filename ))
+            prof.close()
+            assert prof.stats()['snapshots'] >= 5, prof.stats()
+            # only the (digits of the) totals change once every function is known
+            assert sizes[-1] - sizes[1] < 64, sizes
+            assert sorted( os.listdir( directory )) == [
+                profiler.Profiler.INDEX_FILENAME, profiler.Profiler.SNAPSHOT_FILENAME,
+            ], os.listdir( directory )
+            load = loader.Loader( directory )
+            load.load()
+            generator = load.info.function_names[('tests.test_profiler','counter')]
+            assert generator.calls == 5, generator
+        finally:
+            shutil.rmtree( directory, True )
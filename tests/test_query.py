@@ -0,0 +1,80 @@
+from unittest import TestCase
+from coldshot import profiler, loader, query
+import tempfile, shutil
+
+def leaf( value ):
+    return value + 1
+def branch( count ):
+    return [leaf( i ) for i in range( count )]
+def trunk():
+    for i in range( 3 ):
+        branch( 4 )
+
+class TestQuery( TestCase ):
+    def setUp( self ):
+        self.test_dir = tempfile.mkdtemp( prefix = 'coldshot-test' )
+        prof = profiler.Profiler( self.test_dir, lines=True )
+        with prof:
+            trunk()
+        prof.close()
+    def tearDown( self ):
+        shutil.rmtree( self.test_dir, True )
+    
+    def test_index_only( self ):
+        profile = query.Query( self.test_dir, use_cache=False )
+        trunk_func = profile.function( 'tests.test_query', 'trunk' )
+        assert trunk_func is not None
+        assert trunk_func in profile.functions()
+        # totals not yet loaded
+        assert trunk_func.calls == 0, trunk_func.calls
+    
+    def test_background_aggregates( self ):
+        progress = []
+        finished = []
+        profile = query.Query( self.test_dir, use_cache=False )
+        profile.start( 
+            progress=lambda done,total: progress.append( (done,total) ), 
+            done=finished.append,
+        )
+        assert profile.wait( 10 )
+        profile.thread.join( 10 )
+        assert finished == [profile], finished
+        assert not profile.error, profile.error
+        assert progress and progress[-1][0] == progress[-1][1], progress
+        
+        full = loader.Loader( self.test_dir ).load()
+        for key in [('tests.test_query','trunk'),('tests.test_query','leaf')]:
+            assert profile.info.function_names[key].calls == full.function_names[key].calls
+            assert profile.info.function_names[key].time == full.function_names[key].time
+    
+    def test_calls_and_children( self ):
+        profile = query.Query( self.test_dir, use_cache=False )
+        trunk_calls = profile.calls( profile.function( 'tests.test_query', 'trunk' ))
+        assert len( trunk_calls ) == 1, trunk_calls
+        trunk_call = trunk_calls[0]
+        assert trunk_call.complete
+        assert trunk_call.time >= 0
+        children = profile.children( trunk_call )
+        names = [child.function.name for child in children]
+        assert names.count( 'branch' ) == 3, names
+        branch_call = [child for child in children if child.function.name == 'branch'][0]
+        grandchildren = [child.function.name for child in profile.children( branch_call )]
+        assert grandchildren.count( 'leaf' ) == 4, grandchildren
+        assert 'range' in grandchildren, grandchildren
+        
+        leaf_calls = profile.calls( profile.function( 'tests.test_query', 'leaf' ))
+        assert len( leaf_calls ) == 12, leaf_calls
+        for call in leaf_calls:
+            assert not profile.children( call ), call
+        roots = [call.function.name for call in profile.roots()]
+        assert 'trunk' in roots, roots
+    
+    def test_lru( self ):
+        profile = query.Query( self.test_dir, cache_size=2, use_cache=False )
+        trunk_call = profile.calls( profile.function( 'tests.test_query', 'trunk' ))[0]
+        children = profile.children( trunk_call )
+        assert profile.children( trunk_call ) is children
+        for child in children[:3]:
+            profile.children( child )
+        assert len( profile.cache ) == 2, len( profile.cache )
+        assert profile.children( trunk_call ) is not children
@@ -0,0 +1,163 @@
+from unittest import TestCase
+from coldshot import profiler, loader, reporter
+import tempfile, shutil, time, json, threading, os
+
+def slow():
+    time.sleep( 0.01 )
+def fast():
+    return True
+def threaded():
+    slow()
+
+class TestReporter( TestCase ):
+    def setUp( self ):
+        self.test_dir = tempfile.mkdtemp( prefix = 'coldshot-test' )
+        prof = profiler.Profiler( self.test_dir )
+        with prof:
+            prof.annotation( 'request' )
+            slow()
+            prof.annotation( None )
+            for i in range( 20 ):
+                fast()
+        prof.close()
+        self.loader = loader.Loader( self.test_dir )
+        self.loader.load()
+    def tearDown( self ):
+        shutil.rmtree( self.test_dir, True )
+
+    def test_top_n( self ):
+        report = reporter.Reporter( self.loader, limit=2, format='json' )
+        rows = json.loads( report.report() )
+        assert len(rows) == 2, rows
+        assert rows[0]['cumulative'] >= rows[1]['cumulative'], rows
+
+    def test_full_sort_matches_top_n( self ):
+        full = reporter.Reporter( self.loader, sort=['-calls','name'], format='json' )
+        top = reporter.Reporter( self.loader, sort=['-calls','name'], limit=3, format='json' )
+        assert json.loads( full.report() )[:3] == json.loads( top.report() )
+
+    def test_columns_csv( self ):
+        report = reporter.Reporter( self.loader, columns=['name','calls'], format='csv' )
+        lines = report.report().splitlines()
+        assert lines[0] == 'name,calls', lines[0]
+        assert 'fast,20' in lines, lines
+
+    def test_module_filter( self ):
+        report = reporter.Reporter( self.loader, modules=['tests'], format='json' )
+        rows = json.loads( report.report() )
+        assert rows
+        for row in rows:
+            assert row['module'].startswith( 'tests.' ), row
+
+    def test_annotation_filter( self ):
+        report = reporter.Reporter( self.loader, annotations=['request'], format='json' )
+        names = [row['name'] for row in json.loads( report.report() )]
+        assert 'slow' in names, names
+        assert 'fast' not in names, names
+
+    def test_annotation_views( self ):
+        rows = json.loads( reporter.Reporter( self.loader, format='json' ).annotation_report() )
+        assert [row['annotation'] for row in rows] == ['request'], rows
+        assert rows[0]['calls'] == 1 and rows[0]['cumulative'] > 0.01, rows
+        spans = json.loads( reporter.Reporter( self.loader, format='json' ).span_report() )
+        assert len(spans) == 1 and spans[0]['duration'] > 0.01, spans
+
+    def test_thread_view( self ):
+        for stack in self.loader.info.threads.values():
+            assert not stack.functions, stack.functions
+        load = loader.Loader( self.test_dir, thread_functions=True )
+        load.load()
+        threads = list( load.info.threads )
+        report = reporter.Reporter( load, threads=threads, format='json' )
+        rows = json.loads( report.report() )
+        assert rows and rows[0]['thread'] in threads, rows
+        text = reporter.Reporter( load ).thread_report()
+        assert 'Switches' in text, text
+
+    def test_thread_lines( self ):
+        directory = tempfile.mkdtemp( prefix = 'coldshot-test' )
+        try:
+            prof = profiler.Profiler( directory, lines=True )
+            with prof:
+                slow()
+            prof.close()
+            load = loader.Loader( directory, thread_functions=True )
+            load.load()
+            function = load.info.function_names[('tests.test_reporter','slow')]
+            stack = list( load.info.threads.values() )[0]
+            local = stack.functions[function.key]
+            assert local.line_map, local
+            assert sorted( local.line_map ) == sorted( function.line_map ), local.line_map
+            text = reporter.Reporter( load, threads=[stack.thread], lines=True ).report()
+            assert '%5d'%( function.line + 1 ) in text, text
+        finally:
+            shutil.rmtree( directory, True )
+
+    def test_module_view( self ):
+        text = reporter.Reporter( self.loader ).module_report()
+        assert 'tests.test_reporter' in text, text
+
+    def test_cpu_columns( self ):
+        # profile without CPU time reports zeros rather than failing
+        report = reporter.Reporter( 
+            self.loader, columns=('name',)+reporter.CPU_COLUMNS, format='json',
+        )
+        rows = json.loads( report.report() )
+        assert rows and not any([ row['cpu'] or row['waiting'] for row in rows ]), rows
+
+    def test_latency_columns( self ):
+        report = reporter.Reporter( 
+            self.loader, columns=('name','calls')+reporter.LATENCY_COLUMNS, format='json',
+        )
+        rows = dict([ (row['name'],row) for row in json.loads( report.report() )])
+        assert rows['slow']['slowest'] >= .01, rows['slow']
+        assert rows['slow']['p50'] == rows['slow']['slowest'], rows['slow']
+        assert rows['fast']['p50'] <= rows['fast']['p99'] <= rows['fast']['slowest'], rows['fast']
+        assert rows['fast']['slowest_index'] >= 0, rows['fast']
+        datafile = os.path.basename( self.loader.call_files[0] )
+        assert rows['fast']['slowest_file'] == datafile, rows['fast']
+        text = reporter.Reporter( 
+            self.loader, columns=('name',)+reporter.LATENCY_COLUMNS,
+        ).report()
+        assert 'Slowest In' in text and datafile in text, text
+
+    def test_bad_column( self ):
+        self.assertRaises( ValueError, reporter.Reporter, self.loader, columns=['nonsense'] )
+
+def hot_lines():
+    time.sleep( 0.01 )
+    fast()
+    time.sleep( 0.001 )
+
+class TestLineReporter( TestCase ):
+    def setUp( self ):
+        self.test_dir = tempfile.mkdtemp( prefix = 'coldshot-test' )
+        prof = profiler.Profiler( self.test_dir, lines=True )
+        with prof:
+            hot_lines()
+        prof.close()
+        self.loader = loader.Loader( self.test_dir )
+        self.loader.load()
+    def tearDown( self ):
+        shutil.rmtree( self.test_dir, True )
+
+    def test_function_report( self ):
+        report = reporter.LineReporter( self.loader.info, limit=1 ).function_report()
+        assert 'Function: tests.test_reporter.hot_lines' in report, report
+        annotated = [line for line in report.splitlines() if 'time.sleep( 0.01 )' in line]
+        assert annotated, report
+        hits,seconds = annotated[0].split()[1:3]
+        assert hits == '1', annotated
+        assert float(seconds) >= 0.01, annotated
+
+    def test_file_report( self ):
+        report = reporter.LineReporter( self.loader.info, limit=None ).file_report()
+        assert 'test_reporter.py' in report, report
+        assert 'time.sleep( 0.001 )' in report, report
+
+    def test_source_cache( self ):
+        cache = reporter.SourceCache()
+        path = __file__.replace( '.pyc', '.py' )
+        assert cache.line( path, 1 ).startswith( 'from unittest' )
+        assert cache.lines( path ) is cache.lines( path )
+        assert cache.lines( '/this/does/not/exist.py' ) == []
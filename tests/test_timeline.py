@@ -0,0 +1,65 @@
+from unittest import TestCase
+from coldshot import profiler, loader, timeline
+import tempfile, shutil, time, threading
+
+def spin( duration ):
+    end = time.time() + duration
+    while time.time() < end:
+        pass
+
+class TestTimeline( TestCase ):
+    def setUp( self ):
+        self.test_dir = tempfile.mkdtemp( prefix = 'coldshot-test' )
+        prof = profiler.Profiler( self.test_dir )
+        prof.start()
+        # the profiler only hooks the current thread, so alternate work 
+        # between a worker (recorded via annotations) and ourselves
+        worker = threading.Thread( target=self.worker, args=(prof,) )
+        self.ready = threading.Event()
+        self.done = threading.Event()
+        worker.start()
+        for i in range( 3 ):
+            self.ready.wait()
+            self.ready.clear()
+            spin( 0.002 )
+            self.done.set()
+        worker.join()
+        prof.stop()
+        prof.close()
+        self.loader = loader.Loader( self.test_dir )
+        self.loader.load()
+    def worker( self, prof ):
+        for i in range( 3 ):
+            prof.annotation( 'worker-start' )
+            spin( 0.002 )
+            prof.annotation( 'worker-stop' )
+            self.ready.set()
+            self.done.wait()
+            self.done.clear()
+    def tearDown( self ):
+        shutil.rmtree( self.test_dir, True )
+
+    def test_runs( self ):
+        lines = timeline.Timeline( self.loader.info )
+        assert len(lines.threads) == 2, lines.threads
+        for thread in lines.threads:
+            assert thread.runs, thread
+            for start,stop in thread.runs:
+                assert stop >= start, thread.runs
+        main = [thread for thread in lines.threads if len(thread.runs) > 3][0]
+        assert main.switches >= 3, main
+        assert main.others > 0, main
+        assert main.busy <= main.duration + 1e-6, main
+
+    def test_busy_between( self ):
+        lines = timeline.Timeline( self.loader.info )
+        total = sum([ thread.busy_raw for thread in lines.threads ])
+        assert lines.busy_between( lines.first, lines.last ) == total
+        assert lines.busy_between( lines.last + 1, lines.last + 10 ) == 0
+
+    def test_reports( self ):
+        lines = timeline.Timeline( self.loader.info )
+        text = lines.report( width=20 )
+        assert 'Switches' in text, text
+        html = lines.html( width=100 )
+        assert '<svg' in html and '<rect' in html, html
@@ -0,0 +1,111 @@
+from unittest import TestCase
+from coldshot import profiler, webview
+import tempfile, shutil, threading, json
+try:
+    from urllib2 import urlopen, HTTPError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+
+def leaf( value ):
+    return value + 1
+def branch( count ):
+    return [leaf( i ) for i in range( count )]
+def trunk():
+    for i in range( 3 ):
+        branch( 4 )
+
+class TestWebView( TestCase ):
+    def setUp( self ):
+        self.test_dir = tempfile.mkdtemp( prefix = 'coldshot-test' )
+        prof = profiler.Profiler( self.test_dir, lines=True )
+        with prof:
+            trunk()
+        prof.close()
+        self.view = webview.ProfileView( self.test_dir, use_cache=False )
+        self.view.start()
+        assert self.view.query.wait( 10 )
+    def tearDown( self ):
+        shutil.rmtree( self.test_dir, True )
+    def key( self, name ):
+        return self.view.query.function( 'tests.test_webview', name ).key
+
+    def test_functions_pages( self ):
+        first = self.view.functions( sort='-calls', limit=1 )
+        assert first['total'] > 3, first
+        assert len( first['rows'] ) == 1
+        assert first['rows'][0]['name'] == 'leaf', first['rows'][0]
+        assert first['rows'][0]['calls'] == 12
+        second = self.view.functions( sort='-calls', offset=1, limit=1 )
+        assert second['rows'][0]['calls'] <= 12
+        assert second['rows'][0]['key'] != first['rows'][0]['key']
+        everything = self.view.functions( sort='calls', limit=1000 )
+        assert everything['limit'] == webview.MAX_PAGE
+        calls = [row['calls'] for row in everything['rows']]
+        assert calls == sorted( calls ), calls
+
+    def test_search( self ):
+        result = self.view.functions( search='branch' )
+        assert [row['name'] for row in result['rows']] == ['branch'], result
+        assert result['total'] == 1
+
+    def test_bad_parameters( self ):
+        self.assertRaises( ValueError, self.view.functions, sort='nonsense' )
+        self.assertRaises( ValueError, self.view.functions, offset=-1 )
+        self.assertRaises( webview.NotFound, self.view.function, 999999 )
+
+    def test_function_detail( self ):
+        detail = self.view.function( self.key( 'branch' ))
+        assert detail['calls'] == 3, detail
+        assert [row['name'] for row in detail['callers']['rows']] == ['trunk'], detail['callers']
+        assert 'leaf' in [row['name'] for row in detail['callees']['rows']], detail['callees']
+        assert detail['lines'], detail
+        assert 'leaf' in ''.join([line['source'] for line in detail['lines']])
+
+    def test_call_drilldown( self ):
+        trunk_calls = self.view.calls( self.key( 'trunk' ))
+        assert trunk_calls['total'] == 1, trunk_calls
+        call = trunk_calls['rows'][0]
+        children = self.view.children(
+            call['call_file'], call['start_index'], call['stop_index'], call['thread'],
+            limit=2,
+        )
+        assert children['total'] >= 3, children
+        assert len( children['rows'] ) == 2
+        starts = [row['start'] for row in children['rows']]
+        assert starts == sorted( starts ), starts
+        leaf_calls = self.view.calls( self.key( 'leaf' ), sort='-duration', limit=5 )
+        assert leaf_calls['total'] == 12, leaf_calls
+        durations = [row['duration'] for row in leaf_calls['rows']]
+        assert durations == sorted( durations, reverse=True ), durations
+
+    def test_http( self ):
+        server = webview.ProfileServer( ('127.0.0.1',0), self.view )
+        thread = threading.Thread( target=server.serve_forever )
+        thread.daemon = True
+        thread.start()
+        try:
+            base = 'http://127.0.0.1:%s'%( server.server_address[1], )
+            page = urlopen( base + '/' ).read()
+            assert b'coldshot' in page.lower()
+            status = json.loads( urlopen( base + '/api/status' ).read().decode( 'utf-8' ))
+            assert status['ready'], status
+            result = json.loads( urlopen(
+                base + '/api/functions?sort=-calls&limit=1'
+            ).read().decode( 'utf-8' ))
+            assert result['rows'][0]['name'] == 'leaf', result
+            for path,code in [
+                ('/api/functions?sort=nonsense',400),
+                ('/api/function',400),
+                ('/api/function?key=999999',404),
+                ('/missing',404),
+            ]:
+                try:
+                    urlopen( base + path )
+                except HTTPError as err:
+                    assert err.code == code, (path,err.code)
+                else:
+                    raise AssertionError( 'Expected error for %s'%( path, ))
+        finally:
+            server.shutdown()
+            server.server_close()